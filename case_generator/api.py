@@ -3,9 +3,15 @@
 # "Artificial Intelligence for Health".
 # For copyright and licence, see the parent directory.
 
+import atexit
 import json
 import os
 import random
+from collections import deque
+from multiprocessing import Pool
+
+import numpy as np
+from flask import Response
 
 GENDERS = ["male", "female"]
 EVIDENCE_STATES = ["present", "absent"]
@@ -18,6 +24,87 @@ OBSERVATION_PROBABILITY = 0.8
 UNSURE_PROBABILITY = 0.1
 MIN_AGE, MAX_AGE = 18, 80
 
+# Upper bound on the number of cases returned by a single `generate-cases` call
+MAX_CASES_PER_REQUEST = 10000
+# Streamed case sets are generated in shards of a fixed size, each with its own
+# random stream derived from the master seed. Keeping the shard size fixed
+# makes the output depend on the seed only, not on the number of workers.
+CASES_PER_SHARD = 1000
+MAX_SEED = 2 ** 32 - 1
+CASE_ID_PREFIX = "case_mmvb_0_0_1_a_"
+
+# Default age bands (inclusive) for stratified case sets
+DEFAULT_AGE_BANDS = [(18, 39), (40, 59), (60, 80)]
+# Streamed case sets are generated by a pool of processes started with the
+# case generator and shared by all the requests, each using at most
+# `numWorkers` of them at once
+MAX_NUM_WORKERS = os.cpu_count() or 1
+DEFAULT_NUM_WORKERS = MAX_NUM_WORKERS
+SHARD_POOL = None
+
+# Integer codes of symptom states used by the batch (vectorized) generator
+STATE_UNKNOWN, STATE_PRESENT, STATE_ABSENT, STATE_UNSURE = 0, 1, 2, 3
+STATE_CODES_TO_STATES = {
+    STATE_PRESENT: "present",
+    STATE_ABSENT: "absent",
+    STATE_UNSURE: "unsure",
+}
+
+
+def build_condition_symptom_arrays(data):
+    """Precompiles the condition/symptom data into dense NumPy arrays
+
+    Rows follow the order of `data["conditions"]`, columns the order
+    of `data["symptoms"]`.
+    """
+    condition_index = {
+        condition["id"]: index for index, condition in enumerate(data["conditions"])
+    }
+    symptom_index = {
+        symptom["id"]: index for index, symptom in enumerate(data["symptoms"])
+    }
+
+    num_conditions, num_symptoms = len(condition_index), len(symptom_index)
+    probabilities = np.zeros((num_conditions, num_symptoms))
+    related = np.zeros((num_conditions, num_symptoms), dtype=bool)
+    # Symptom forced to "present" when no present symptom was sampled. This
+    # mirrors `max(...)` in `sample_symptoms`, i.e. ties are broken by the
+    # order in `condition_symptom_probability` rather than by column order.
+    fallback_symptoms = np.zeros(num_conditions, dtype=int)
+    fallback_probabilities = np.full(num_conditions, -1.0)
+
+    for condition_id, symptom_id, probability in data["condition_symptom_probability"]:
+        row, column = condition_index[condition_id], symptom_index[symptom_id]
+        probabilities[row, column] = probability
+        related[row, column] = True
+        if probability > fallback_probabilities[row]:
+            fallback_probabilities[row] = probability
+            fallback_symptoms[row] = column
+
+    assert related.any(axis=1).all()
+
+    condition_probabilities = np.array(
+        [
+            [condition["probability"][gender] for condition in data["conditions"]]
+            for gender in GENDERS
+        ]
+    )
+    cumulative_condition_probabilities = np.cumsum(
+        condition_probabilities, axis=1
+    ) / condition_probabilities.sum(axis=1, keepdims=True)
+    # Guards against rounding errors when sampling by cumulative probability
+    cumulative_condition_probabilities[:, -1] = 1.0
+
+    return {
+        "symptom_probabilities": probabilities,
+        "related_symptoms": related,
+        "fallback_symptoms": fallback_symptoms,
+        "cumulative_condition_probabilities": cumulative_condition_probabilities,
+    }
+
+
+ARRAYS = build_condition_symptom_arrays(DATA)
+
 
 def sample_symptoms(symptom_probabilities):
     # Sample latent state
@@ -114,3 +201,389 @@ def generate_case():
     }
 
     return output
+
+
+def sample_symptom_states(condition_indices, random_state):
+    """Vectorized version of `sample_symptoms` for a batch of conditions
+
+    Returns an array of shape (number of cases, number of symptoms) holding
+    the `STATE_*` codes.
+    """
+    num_cases = len(condition_indices)
+    shape = (num_cases, len(DATA["symptoms"]))
+    related = ARRAYS["related_symptoms"][condition_indices]
+
+    # Sample latent state
+    present = (
+        random_state.random_sample(shape)
+        < ARRAYS["symptom_probabilities"][condition_indices]
+    )
+
+    # Sample whether state is known
+    known = related & (random_state.random_sample(shape) >= OBSERVATION_PROBABILITY)
+
+    # Sample whether user answers "I don't know"
+    unsure = known & (random_state.random_sample(shape) < UNSURE_PROBABILITY)
+
+    states = np.where(
+        known, np.where(present, STATE_PRESENT, STATE_ABSENT), STATE_UNKNOWN
+    ).astype(np.int8)
+    states[unsure] = STATE_UNSURE
+
+    # Ensure at least one present symptom
+    without_present = np.flatnonzero(~(states == STATE_PRESENT).any(axis=1))
+    states[
+        without_present, ARRAYS["fallback_symptoms"][condition_indices[without_present]]
+    ] = STATE_PRESENT
+
+    return states
+
+
+def build_case(case_id, age, biological_sex, condition, symptom_states, weight=None):
+    symptoms = [
+        combine_symptom_and_state(symptom, STATE_CODES_TO_STATES[state])
+        for symptom, state in zip(DATA["symptoms"], symptom_states)
+        if state != STATE_UNKNOWN
+    ]
+
+    # Split a present symptom as presenting symptom
+    presenting_symptom = symptoms.pop(
+        [
+            index
+            for index, symptom in enumerate(symptoms)
+            if symptom["state"] == "present"
+        ][0]
+    )
+
+    output = {
+        "caseData": {
+            "caseId": case_id,
+            "metaData": {"description": "a synthetic case for the MMVB"},
+            "profileInformation": {"biologicalSex": biological_sex, "age": age},
+            "presentingComplaints": [presenting_symptom],
+            "otherFeatures": symptoms,
+        },
+        "valuesToPredict": {
+            "expectedTriageLevel": condition["expected_triage_level"],
+            "condition": {"id": condition["id"], "name": condition["name"]},
+        },
+    }
+
+    # Weight of a case sampled by stratum, to re-weight metrics to prevalence
+    if weight is not None:
+        output["valuesToPredict"]["caseWeight"] = weight
+
+    return output
+
+
+def get_case_ids(case_set_key, first_case_index, num_cases):
+    """Returns the ids of consecutive cases of a case set, by their index in
+    the case set: ids are unique within a case set, and across case sets
+    with different keys (e.g. seeds)"""
+    return [
+        f"{CASE_ID_PREFIX}{case_set_key}_{case_index}"
+        for case_index in range(first_case_index, first_case_index + num_cases)
+    ]
+
+
+def draw_case_ids(num_cases, random_state):
+    """Returns the ids of the cases of a batch that is not part of a seeded
+    case set, keyed by a random number"""
+    case_set_key = random_state.randint(0, MAX_SEED + 1, dtype=np.int64)
+    return get_case_ids(case_set_key, 0, num_cases)
+
+
+def generate_cases_batch(num_cases, random_state=None, case_ids=None):
+    """Generates `num_cases` synthetic cases in one vectorized pass
+
+    `random_state` is a `numpy.random.RandomState`; the global NumPy
+    random state is used if it is not given. The ids of the cases are drawn
+    unless they are given.
+    """
+    if random_state is None:
+        random_state = np.random
+
+    if case_ids is None:
+        case_ids = draw_case_ids(num_cases, random_state)
+
+    ages = random_state.randint(MIN_AGE, MAX_AGE + 1, size=num_cases)
+    sexes = random_state.randint(0, len(GENDERS), size=num_cases)
+
+    # Sample from conditions based on their probabilities
+    cumulative_probabilities = ARRAYS["cumulative_condition_probabilities"][sexes]
+    condition_indices = (
+        random_state.random_sample((num_cases, 1)) >= cumulative_probabilities
+    ).sum(axis=1)
+
+    return build_cases(case_ids, ages, sexes, condition_indices, random_state)
+
+
+def build_cases(case_ids, ages, sexes, condition_indices, random_state, weights=None):
+    symptom_states = sample_symptom_states(condition_indices, random_state)
+
+    if weights is None:
+        weights = [None] * len(case_ids)
+    else:
+        weights = weights.tolist()
+
+    # Plain Python values are much faster to index than NumPy scalars
+    return [
+        build_case(
+            case_id,
+            age,
+            GENDERS[sex],
+            DATA["conditions"][condition_index],
+            states,
+            weight,
+        )
+        for case_id, age, sex, condition_index, states, weight in zip(
+            case_ids,
+            ages.tolist(),
+            sexes.tolist(),
+            condition_indices.tolist(),
+            symptom_states.tolist(),
+            weights,
+        )
+    ]
+
+
+def build_strata(cases_per_stratum, age_bands=None, stratum_counts=None):
+    """Lists the (condition, biological sex, age band) strata of a case set
+
+    Strata with a zero condition probability are left out. Every stratum
+    gets the number of cases `stratum_counts` maps its (condition id,
+    biological sex, (min age, max age)) to, `cases_per_stratum` if it is not
+    in the mapping, and a weight, so that weighted metrics match the
+    prevalence the cases would have been sampled with by
+    `generate_cases_batch` (restricted to the given age bands and to the
+    strata with cases). Raises a `ValueError` for counts of unknown strata.
+    """
+    age_bands = sorted(age_bands or DEFAULT_AGE_BANDS)
+    for index, (min_age, max_age) in enumerate(age_bands):
+        assert MIN_AGE <= min_age <= max_age <= MAX_AGE
+        assert index == 0 or age_bands[index - 1][1] < min_age
+
+    stratum_counts = dict(stratum_counts or {})
+    rows = []
+    for condition_index, condition in enumerate(DATA["conditions"]):
+        for sex_index, gender in enumerate(GENDERS):
+            condition_probability = condition["probability"][gender] / sum(
+                element["probability"][gender] for element in DATA["conditions"]
+            )
+            if condition_probability == 0.0:
+                continue
+
+            for min_age, max_age in age_bands:
+                age_band_probability = (max_age - min_age + 1) / (MAX_AGE - MIN_AGE + 1)
+                prevalence = condition_probability * age_band_probability / len(GENDERS)
+                count = stratum_counts.pop(
+                    (condition["id"], gender, (min_age, max_age)), cases_per_stratum
+                )
+                rows.append(
+                    (condition_index, sex_index, min_age, max_age, prevalence, count)
+                )
+
+    if stratum_counts:
+        raise ValueError(f"Unknown strata {sorted(stratum_counts)}")
+
+    conditions, sexes, min_ages, max_ages, prevalences, counts = map(
+        np.array, zip(*rows)
+    )
+    if counts.sum() == 0:
+        raise ValueError("No cases in any stratum")
+
+    # A case stands for the share of the prevalence of its stratum it got
+    prevalences = np.where(counts > 0, prevalences, 0.0)
+    prevalences = prevalences / prevalences.sum()
+    weights = np.zeros(len(rows))
+    np.divide(prevalences * counts.sum(), counts, out=weights, where=counts > 0)
+
+    return {
+        "conditions": conditions,
+        "sexes": sexes,
+        "min_ages": min_ages,
+        "max_ages": max_ages,
+        "counts": counts,
+        "weights": weights,
+    }
+
+
+def generate_stratified_cases_batch(
+    strata, stratum_indices, random_state=None, case_ids=None
+):
+    """Generates one case for each of the given strata (by index in `strata`)"""
+    if random_state is None:
+        random_state = np.random
+
+    num_cases = len(stratum_indices)
+    if case_ids is None:
+        case_ids = draw_case_ids(num_cases, random_state)
+
+    min_ages = strata["min_ages"][stratum_indices]
+    max_ages = strata["max_ages"][stratum_indices]
+    ages = min_ages + (
+        random_state.random_sample(num_cases) * (max_ages - min_ages + 1)
+    ).astype(int)
+
+    return build_cases(
+        case_ids,
+        ages,
+        strata["sexes"][stratum_indices],
+        strata["conditions"][stratum_indices],
+        random_state,
+        weights=strata["weights"][stratum_indices],
+    )
+
+
+def generate_cases(count):
+    return {"cases": generate_cases_batch(count)}
+
+
+def get_shard_random_state(seed, shard_index):
+    return np.random.RandomState([seed, shard_index])
+
+
+def generate_shard(task):
+    """Generates one shard of a seeded case set as NDJSON
+
+    Case ids are derived from the seed and the index of the case in the case
+    set, so they are unique however large the case set.
+    """
+    seed, shard_index, num_cases, strata, stratum_indices = task
+    random_state = get_shard_random_state(seed, shard_index)
+
+    if strata is None:
+        case_ids = get_case_ids(seed, shard_index * CASES_PER_SHARD, num_cases)
+        cases = generate_cases_batch(
+            num_cases, random_state=random_state, case_ids=case_ids
+        )
+    else:
+        case_ids = get_case_ids(
+            seed, shard_index * CASES_PER_SHARD, len(stratum_indices)
+        )
+        cases = generate_stratified_cases_batch(
+            strata, stratum_indices, random_state=random_state, case_ids=case_ids
+        )
+
+    return "".join(json.dumps(case) + "\n" for case in cases)
+
+
+def start_shard_pool():
+    """Starts the pool of processes generating the shards of streamed case
+    sets
+
+    Called once by the entry points of the case generator, before serving
+    requests. Shards are generated in the process serving the request
+    until then.
+    """
+    global SHARD_POOL
+
+    if SHARD_POOL is not None:
+        return
+
+    SHARD_POOL = Pool(MAX_NUM_WORKERS)
+    atexit.register(stop_shard_pool)
+
+
+def stop_shard_pool():
+    global SHARD_POOL
+
+    if SHARD_POOL is None:
+        return
+
+    SHARD_POOL.terminate()
+    SHARD_POOL.join()
+    SHARD_POOL = None
+
+
+def stream_shards(tasks, seed, count, num_workers):
+    """Generates shards over the pool of processes and streams them in order,
+    so the same seed always gives the same case set"""
+    num_workers = min(num_workers or DEFAULT_NUM_WORKERS, MAX_NUM_WORKERS)
+
+    def generate():
+        if SHARD_POOL is None or num_workers == 1 or len(tasks) == 1:
+            for task in tasks:
+                yield generate_shard(task)
+            return
+
+        # At most `num_workers` shards are generated (or waiting to be sent)
+        # at once, whatever the size of the case set
+        pending = deque()
+        for task in tasks:
+            pending.append(SHARD_POOL.apply_async(generate_shard, (task,)))
+            if len(pending) == num_workers:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+
+    return Response(
+        generate(),
+        mimetype="application/x-ndjson",
+        headers={"X-Case-Set-Seed": str(seed), "X-Case-Count": str(count)},
+    )
+
+
+def draw_seed():
+    return random.SystemRandom().randint(0, MAX_SEED)
+
+
+def generate_cases_stream(count, seed=None, numWorkers=None):
+    """Streams `count` cases as newline-delimited JSON, one shard at a time"""
+    if seed is None:
+        seed = draw_seed()
+
+    tasks = [
+        (seed, shard_index, min(CASES_PER_SHARD, count - start), None, None)
+        for shard_index, start in enumerate(range(0, count, CASES_PER_SHARD))
+    ]
+
+    return stream_shards(tasks, seed, count, numWorkers)
+
+
+def parse_age_band(age_band):
+    min_age, max_age = age_band.split("-")
+    return int(min_age), int(max_age)
+
+
+def parse_stratum_count(stratum_count):
+    """Parses a `<condition id>:<biological sex>:<age band>=<count>` stratum
+    count into a ((condition id, biological sex, age band), count) pair"""
+    stratum, count = stratum_count.split("=")
+    condition_id, biological_sex, age_band = stratum.split(":")
+    return (condition_id, biological_sex, parse_age_band(age_band)), int(count)
+
+
+def generate_stratified_cases_stream(
+    casesPerStratum, ageBands=None, stratumCounts=None, seed=None, numWorkers=None
+):
+    """Streams a case set with exactly `casesPerStratum` cases for every
+    (condition, biological sex, age band) stratum, or the number of cases
+    `stratumCounts` gives the stratum, in random order"""
+    if seed is None:
+        seed = draw_seed()
+
+    age_bands = [parse_age_band(age_band) for age_band in ageBands or []]
+    stratum_counts = dict(
+        parse_stratum_count(stratum_count) for stratum_count in stratumCounts or []
+    )
+    try:
+        strata = build_strata(casesPerStratum, age_bands, stratum_counts)
+    except AssertionError:
+        return {"code": "400", "message": f"Invalid age bands: {ageBands}"}, 400
+    except ValueError as error:
+        return {"code": "400", "message": f"Invalid stratum counts: {error}"}, 400
+
+    stratum_indices = np.repeat(np.arange(len(strata["counts"])), strata["counts"])
+    stratum_indices = np.random.RandomState([seed]).permutation(stratum_indices)
+    count = len(stratum_indices)
+
+    tasks = [
+        (seed, shard_index, None, strata, shard_stratum_indices)
+        for shard_index, shard_stratum_indices in enumerate(
+            np.split(stratum_indices, range(CASES_PER_SHARD, count, CASES_PER_SHARD))
+        )
+    ]
+
+    return stream_shards(tasks, seed, count, numWorkers)
@@ -10,6 +10,7 @@ import connexion
 
 sys.path.append("..")  # isort:skip
 from config import CONFIG_DEFAULT_HOST  # isort:skip  # NOQA: E402
+from api import start_shard_pool  # isort:skip  # NOQA: E402
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -26,4 +27,5 @@ def create_app():
 
 if __name__ == "__main__":
     app = create_app()
+    start_shard_pool()
     app.run(port=5001, host=CONFIG_DEFAULT_HOST)
@@ -3,64 +3,156 @@
 # "Artificial Intelligence for Health".
 # For copyright and licence, see the parent directory.
 
-import glob
+import atexit
 import hashlib
+import heapq
 import json
+import multiprocessing
 import os
 import queue
 import shutil
 import time
-from multiprocessing import Process, Queue
-from pathlib import Path
-from threading import Thread
+from collections import Counter
+from multiprocessing import Pipe, Queue
+from multiprocessing.connection import Connection, wait
+from threading import Event, Lock, Thread
 
 import requests
-
-from evaluator.benchmark.definitions import ManagerStatuses
+from connexion import NoContent
+from flask import Response, has_request_context
+from flask import request as flask_request
+
+from evaluator.benchmark import result_cache
+from evaluator.benchmark.admission import AdmissionController
+from evaluator.benchmark.definitions import (
+    ExecutionModes,
+    HealthCheckPolicies,
+    ManagerStatuses,
+    RunnerEngines,
+)
+from evaluator.benchmark.event_log import get_events_path, read_events
 from evaluator.benchmark.manager import BenchmarkManager
+from evaluator.benchmark.reporter import initialize_reports, open_reports
+from evaluator.benchmark.result_log import get_results_dir, read_results_by_ai
 from evaluator.benchmark.utils import create_dirs
+from evaluator.case_sets import (
+    CaseSetCache,
+    get_case_set_path,
+    get_data_path,
+    select_cases,
+    set_data_dir,
+    write_cases_ndjson,
+)
+from evaluator.catalog import DATABASE as CATALOG_DATABASE
+from evaluator.catalog import (
+    initialize_catalog,
+    register_case_set,
+    select_case_set,
+    select_case_sets,
+)
 from evaluator.constants import (
     MAX_BENCHMARK_RUN_TIME,
     QUEUE_GET_TIMEOUT,
     QUEUE_PUT_TIMEOUT,
 )
+from evaluator.jobs import (
+    JOB_STATUS_FAILED,
+    JOB_STATUS_FINISHED,
+    JOB_STATUS_QUEUED,
+    JOB_STATUS_RUNNING,
+    count_jobs,
+    enqueue_job,
+    get_queue_position,
+    initialize_jobs,
+    requeue_job,
+    select_job,
+    select_next_queued_job,
+    update_job_status,
+)
 
 SERVER_HOST_FOR_CASE_GENERATION = "http://0.0.0.0:5001"
 
-LIMIT_MAX_NUM_RUNNING_BENCHMARKS = 10
+# Larger case sets are always streamed from the case generator as NDJSON
+MAX_NUM_CASES_NOT_STREAMED = 200
+CASE_STREAM_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+CASE_STREAM_TIMEOUT = 60
+
+DEFAULT_CASE_SET_PAGE_SIZE = 100
 
-FILE_DIR = os.path.dirname((os.path.abspath(__file__)))
+# Number of benchmarks run at the same time, each one in a worker process of
+# the pool. Further benchmarks are queued until a worker is free.
+BENCHMARK_WORKER_POOL_SIZE = 10
+# Benchmarks stop by themselves after MAX_BENCHMARK_RUN_TIME. The worker of a
+# benchmark still running this long after that is killed (and restarted).
+BENCHMARK_DEADLINE_GRACE_TIME = 60
+
+# The event stream of a benchmark checks its events log for new events this
+# often (in seconds), and sends a comment when idle for that long so that
+# proxies keep the connection open
+EVENT_STREAM_POLL_INTERVAL = 0.5
+EVENT_STREAM_KEEP_ALIVE_INTERVAL = 15
+
+# A progress update has at most this many log lines, clients further behind
+# get the next ones with the next updates
+MAX_LOG_LINES_PER_UPDATE = 1000
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 AI_LOCATION_ALPHA = "http://127.0.0.1:5002/toy-ai/v1/"
 DEFAULT_HEALTH_CHECK_ENDPOINT_NAME = "health-check"
 DEFAULT_SOLVE_CASE_ENDPOINT_NAME = "solve-case"
+DEFAULT_SOLVE_CASES_ENDPOINT_NAME = "solve-cases"
 
 # TODO: make this configurable each ai can implement and have its own root url
 # TODO: as well as its own health check and solve case endpoints
+# Besides its endpoints, an AI can set `concurrency`, the number of solve-case
+# requests it is sent in parallel in pipelined mode (1 by default), and
+# `pool_size`, the number of connections kept alive to each of its hosts, and
+# `circuit_breaker`, the settings of its circuit breaker (see `CircuitBreaker`).
+# AIs with a `solve_cases` endpoint are sent `batch_size` cases per request
+# in pipelined mode if they advertise the capability in their health checks.
+# Across all running benchmarks, an AI can be sent at most `max_in_flight`
+# requests at once and `rate_limit` requests per second (with bursts of up to
+# `burst` requests), the benchmarks waiting for it being served in turn.
+# AIs declared `deterministic`, with a `version`, can have their results
+# cached across benchmarks run with `resultCache` (see `ResultCache`, whose
+# settings are the `result_cache` key).
 AI_TYPES_ENDPOINTS = {
     "toy_ai_random_uniform": {
         "health_check": AI_LOCATION_ALPHA + DEFAULT_HEALTH_CHECK_ENDPOINT_NAME,
         "solve_case": AI_LOCATION_ALPHA + DEFAULT_SOLVE_CASE_ENDPOINT_NAME,
+        "solve_cases": AI_LOCATION_ALPHA + DEFAULT_SOLVE_CASES_ENDPOINT_NAME,
     },
     "toy_ai_random_probability_weighted": {
         "health_check": AI_LOCATION_ALPHA + DEFAULT_HEALTH_CHECK_ENDPOINT_NAME,
         "solve_case": AI_LOCATION_ALPHA + DEFAULT_SOLVE_CASE_ENDPOINT_NAME,
+        "solve_cases": AI_LOCATION_ALPHA + DEFAULT_SOLVE_CASES_ENDPOINT_NAME,
     },
     "toy_ai_deterministic_most_likely_conditions": {
         "health_check": AI_LOCATION_ALPHA + DEFAULT_HEALTH_CHECK_ENDPOINT_NAME,
         "solve_case": AI_LOCATION_ALPHA + DEFAULT_SOLVE_CASE_ENDPOINT_NAME,
+        "solve_cases": AI_LOCATION_ALPHA + DEFAULT_SOLVE_CASES_ENDPOINT_NAME,
+        "deterministic": True,
+        "version": "1",
     },
     "toy_ai_deterministic_by_symptom_intersection": {
         "health_check": AI_LOCATION_ALPHA + DEFAULT_HEALTH_CHECK_ENDPOINT_NAME,
         "solve_case": AI_LOCATION_ALPHA + DEFAULT_SOLVE_CASE_ENDPOINT_NAME,
+        "solve_cases": AI_LOCATION_ALPHA + DEFAULT_SOLVE_CASES_ENDPOINT_NAME,
+        "deterministic": True,
+        "version": "1",
     },
     "toy_ai_faulty_random_uniform": {
         "health_check": AI_LOCATION_ALPHA + DEFAULT_HEALTH_CHECK_ENDPOINT_NAME,
         "solve_case": AI_LOCATION_ALPHA + DEFAULT_SOLVE_CASE_ENDPOINT_NAME,
+        "solve_cases": AI_LOCATION_ALPHA + DEFAULT_SOLVE_CASES_ENDPOINT_NAME,
     },
     "babylon_toy_ai": {
         "health_check": "http://127.0.0.1:5006/toy-ai/v1/health-check",
         "solve_case": "http://127.0.0.1:5006/toy-ai/v1/solve-case",
+        "solve_cases": "http://127.0.0.1:5006/toy-ai/v1/solve-cases",
+        "deterministic": True,
+        "version": "1",
     },
 }
 
@@ -81,19 +173,9 @@ AI_TYPES_TO_LOCATIONS = {}
 for key, value in AI_TYPES_ENDPOINTS.items():
     AI_TYPES_TO_LOCATIONS[key] = value["solve_case"]
 
-# TODO: delete all benchmarks from this dictionary
-# and from the database after some timeout
-BENCHMARK_MANAGERS = {}
-
-
-# Preparing human doctor cases (London 2019 model)
-if not os.path.isdir("data/london_model2019_cases_v1"):
-    # TODO: improve this link
-    os.mkdir("data/london_model2019_cases_v1")
-    shutil.copyfile(
-        "../data/doctor_cases/london_model/cases.json",
-        "data/london_model2019_cases_v1/cases.json",
-    )
+# Case sets opened by this process: the evaluator and each benchmark worker
+# have their own (see `CaseSetCache`)
+CASE_SET_CACHE = CaseSetCache()
 
 
 def get_unique_id():
@@ -111,10 +193,127 @@ def md5(value):
     return hashlib.md5(value.encode()).hexdigest()
 
 
+def get_case_generator_error(response):
+    """Returns the message of an error response of the case generator"""
+    try:
+        data = response.json()
+    except ValueError:
+        return response.text
+
+    # The endpoints report errors with a message, the request validation of
+    # connexion with a detail
+    if isinstance(data, dict):
+        return data.get("message") or data.get("detail") or response.text
+
+    return response.text
+
+
+def generate_streamed_case_set(endpoint, parameters):
+    """Streams a case set from the given case generator endpoint to disk
+
+    Invalid requests are answered with the status and message of the case
+    generator, its failures with a 502 and connection errors with a 503.
+    """
+    try:
+        response = requests.get(
+            SERVER_HOST_FOR_CASE_GENERATION + "/case-generator/v1/" + endpoint,
+            params={
+                key: value for key, value in parameters.items() if value is not None
+            },
+            stream=True,
+            timeout=CASE_STREAM_TIMEOUT,
+        )
+    except requests.RequestException as error:
+        return {"code": "503", "message": f"Case generator unavailable: {error}"}, 503
+
+    if response.status_code != 200:
+        with response:
+            message = get_case_generator_error(response)
+
+        status = response.status_code if 400 <= response.status_code < 500 else 502
+        return (
+            {"code": str(status), "message": f"Case set not generated: {message}"},
+            status,
+        )
+
+    case_set_id = get_unique_id()
+
+    # The case generator can only report an error once streaming started by
+    # ending the stream early: such partial case sets are not kept
+    try:
+        with response:
+            _, checksum = write_cases_ndjson(
+                case_set_id,
+                response.iter_content(chunk_size=CASE_STREAM_DOWNLOAD_CHUNK_SIZE),
+                expected_num_cases=int(response.headers["X-Case-Count"]),
+            )
+    except (ValueError, requests.RequestException) as error:
+        return {"code": "502", "message": f"Case set not generated: {error}"}, 502
+
+    register_case_set(case_set_id, checksum=checksum)
+
+    return {
+        "case_set_id": case_set_id,
+        "seed": int(response.headers["X-Case-Set-Seed"]),
+    }
+
+
 def generate_case_set(request):
+    sampling = request.get("sampling", "prevalence")
+
+    # Which of the two is required depends on the sampling
+    required_field = "casesPerStratum" if sampling == "stratified" else "numCases"
+    if request.get(required_field) is None:
+        return (
+            {
+                "code": "400",
+                "message": f"{required_field} is required for {sampling} sampling",
+            },
+            400,
+        )
+
+    if sampling == "stratified":
+        return generate_streamed_case_set(
+            "generate-stratified-cases-stream",
+            {
+                "casesPerStratum": int(request["casesPerStratum"]),
+                "ageBands": ",".join(request.get("ageBands", [])) or None,
+                "stratumCounts": ",".join(
+                    f"{stratum['condition']}:{stratum['biologicalSex']}:"
+                    f"{stratum['ageBand']}={stratum['count']}"
+                    for stratum in request.get("stratumCounts", [])
+                )
+                or None,
+                "seed": request.get("seed"),
+                "numWorkers": request.get("numWorkers"),
+            },
+        )
+
+    assert sampling == "prevalence"
+
     num_cases = int(request["numCases"])
-    # TODO: Gracefully fail for >200 cases
-    assert num_cases > 0 and num_cases <= 200
+
+    # Seeded case sets can only be generated by the (parallel) streaming
+    # generator, as the single case endpoint relies on global random state
+    seed = request.get("seed")
+    streamed = request.get(
+        "streamed", seed is not None or num_cases > MAX_NUM_CASES_NOT_STREAMED
+    )
+    if not streamed and (seed is not None or num_cases > MAX_NUM_CASES_NOT_STREAMED):
+        return (
+            {
+                "code": "400",
+                "message": "Case sets that are seeded or have more than "
+                f"{MAX_NUM_CASES_NOT_STREAMED} cases have to be streamed",
+            },
+            400,
+        )
+
+    if streamed:
+        return generate_streamed_case_set(
+            "generate-cases-stream",
+            {"count": num_cases, "seed": seed, "numWorkers": request.get("numWorkers")},
+        )
 
     cases = []
 
@@ -126,36 +325,82 @@ def generate_case_set(request):
         cases.append(request.json())
 
     case_set_id = get_unique_id()
-    path = os.path.join(FILE_DIR, "data", case_set_id)
+    path = get_case_set_path(case_set_id)
 
     create_dirs(path)
 
     json.dump(cases, open(os.path.join(path, "cases.json"), "w"), indent=2)
 
+    register_case_set(case_set_id)
+
     return {"case_set_id": case_set_id}
 
 
-def list_case_sets():
-    path = os.path.join(FILE_DIR, "data/")
+def list_case_sets(offset=0, limit=DEFAULT_CASE_SET_PAGE_SIZE, source=None):
+    total, case_sets = select_case_sets(offset=offset, limit=limit, source=source)
+
+    return {"existing_case_sets": case_sets, "total": total}
 
-    # TODO: refactor `.db` and `burnt_cases`
-    return {
-        "existing_case_sets": [
-            {"id": element.replace(path, "")}
-            for element in glob.glob(path + "*")
-            if ".db" not in element and "burnt_cases" not in element
-        ]
-    }
 
+def get_case_set_checksum(case_set_id):
+    entry = select_case_set(case_set_id)
+    if entry is None:
+        return register_case_set(case_set_id)["checksum"]
 
-def extract_case_set(caseSetId):
+    return entry.checksum
+
+
+def extract_case_set(
+    caseSetId,
+    offset=0,
+    limit=None,
+    fields=None,
+    biologicalSex=None,
+    minAge=None,
+    maxAge=None,
+    presentingComplaint=None,
+    expectedTriageLevel=None,
+):
     case_set_id = parse_validate_caseSetId(caseSetId)
 
-    return {
-        "cases": json.load(
-            open(os.path.join(FILE_DIR, "data", case_set_id, "cases.json"))
-        )
-    }
+    # Case sets never change once created, so a response is identified by
+    # the checksum of the case set and the query it answers
+    query = [
+        offset,
+        limit,
+        fields,
+        biologicalSex,
+        minAge,
+        maxAge,
+        presentingComplaint,
+        expectedTriageLevel,
+    ]
+    etag = md5(get_case_set_checksum(case_set_id) + json.dumps(query))
+    headers = {"ETag": f'"{etag}"'}
+
+    if has_request_context() and etag in flask_request.if_none_match:
+        return NoContent, 304, headers
+
+    case_set = CASE_SET_CACHE.get(case_set_id)
+    cases = select_cases(
+        case_set,
+        offset=offset,
+        limit=limit,
+        fields=fields,
+        biological_sex=biologicalSex,
+        min_age=minAge,
+        max_age=maxAge,
+        presenting_complaint=presentingComplaint,
+        expected_triage_level=expectedTriageLevel,
+    )
+
+    output = {"cases": cases, "offset": offset, "total_cases": len(case_set)}
+
+    return output, 200, headers
+
+
+def case_set_cache_stats():
+    return CASE_SET_CACHE.stats()
 
 
 def list_all_ai_implementations():
@@ -170,22 +415,167 @@ def list_all_ai_implementations():
 # Idea based on
 # https://stackoverflow.com/questions/54091439/how-to-run-python-custom-objects-in-separate-processes-all-working-on-a-shared
 class BenchmarkManagerWorker:
-    def __init__(self, commands: Queue, results: Queue, benchmark_start_time):
+    """Long-lived worker process of the benchmark worker pool
+
+    A worker runs one benchmark at a time, as scheduled by the evaluator,
+    and keeps the managers of the benchmarks it ran so that their updates
+    can be requested until they are forgotten.
+    """
+
+    def __init__(
+        self,
+        commands: Queue,
+        results: Queue,
+        events: Connection,
+        worker_index,
+        admission,
+    ):
         self.commands = commands
         self.results = results
-        self.benchmark_start_time = benchmark_start_time
+        # Lifecycle events sent to the scheduler
+        self.events = events
+        self.events_lock = Lock()
+        self.worker_index = worker_index
+        self.evaluator = multiprocessing.parent_process()
+        # Benchmarks are admitted in the slot of their worker
+        self.admission = admission.for_slot(worker_index)
+        self.benchmark_managers = {}
+        self.finished_at = {}
+
+    def forget_benchmark(self, benchmark_id):
+        manager = self.benchmark_managers.pop(benchmark_id, None)
+        self.finished_at.pop(benchmark_id, None)
+
+        # Its results are in its result log
+        if manager is not None:
+            manager.db_client.delete_manager_report(benchmark_id=benchmark_id)
+
+    def forget_expired_benchmarks(self):
+        for benchmark_id, finished_at in list(self.finished_at.items()):
+            if time.time() - finished_at > MAX_BENCHMARK_RUN_TIME:
+                self.forget_benchmark(benchmark_id)
+
+    def start_benchmark(self, request, unique_id):
+        self.forget_expired_benchmarks()
+        self.admission.reset()
+
+        benchmark_manager = BenchmarkManager(benchmark_start_time=time.time())
+        self.benchmark_managers[unique_id] = benchmark_manager
+
+        assert benchmark_manager.state == ManagerStatuses.IDLE
+
+        case_set_id = parse_validate_caseSetId(request["caseSetId"])
+        ai_implementations = request["aiImplementations"]
+
+        for ai in ai_implementations:
+            assert ai in AI_TYPES_ENDPOINTS, f"AI {ai} not recognised/configured"
 
-    def if_timeout(self):
-        return time.time() - self.benchmark_start_time > MAX_BENCHMARK_RUN_TIME
+        benchmarked_ais = {ai: AI_TYPES_ENDPOINTS[ai] for ai in ai_implementations}
+
+        cases = CASE_SET_CACHE.get(case_set_id)
+
+        execution_mode = ExecutionModes(
+            request.get("executionMode", ExecutionModes.LOCKSTEP.value)
+        )
+
+        runner_engine = RunnerEngines(
+            request.get("runnerEngine", RunnerEngines.PROCESS.value)
+        )
+
+        health_check_policy = HealthCheckPolicies(
+            request.get("healthCheckPolicy", HealthCheckPolicies.PER_CASE.value)
+        )
+
+        benchmark_manager.setup(
+            unique_id,
+            case_set_id,
+            cases,
+            benchmarked_ais,
+            execution_mode=execution_mode,
+            runner_engine=runner_engine,
+            health_check_policy=health_check_policy,
+            circuit_breaker=request.get("circuitBreaker", False),
+            admission=self.admission,
+            resume=True,
+            result_cache=request.get("resultCache", False),
+        )
+
+        def run_me():
+            succeeded = False
+            try:
+                # Results are in the result log of the benchmark, output is
+                # None if it timed out
+                output = benchmark_manager.run_benchmark()
+                succeeded = output is not None
+            finally:
+                self.admission.reset()
+                self.finished_at[unique_id] = time.time()
+                with self.events_lock:
+                    self.events.send(("Finished", unique_id, succeeded))
+
+        Thread(target=run_me).start()
+
+    def get_update(self, benchmark_id, cursor):
+        """Returns the progress of a benchmark since a cursor (returned by the
+        previous update): the AI reports changed and the new log lines"""
+        manager = self.benchmark_managers[benchmark_id]
+
+        report = manager.db_client.select_manager_report(
+            benchmark_id=manager.benchmark_id
+        )
+
+        ai_reports = manager.db_client.select_ai_reports_since(
+            report, cursor["ai_reports"]
+        )
+        collected_reports = {}
+        for ai_report in ai_reports:
+            collected_reports.setdefault(ai_report.ai_name, []).append(
+                {
+                    "case_index": ai_report.case_num + 1,
+                    "case_id": ai_report.case_id,
+                    "case_status": ai_report.case_status,
+                    "healthcheck_status": ai_report.healthcheck_status,
+                    "health_checks": ai_report.health_checks,
+                    "errors": ai_report.errors,
+                    "timeouts": ai_report.hard_timeouts,
+                }
+            )
+
+        log_offset = cursor["logs"]
+        logs = manager.log_buffer.read(log_offset, MAX_LOG_LINES_PER_UPDATE)
+
+        sequence = cursor["ai_reports"]
+        if ai_reports:
+            sequence = ai_reports[-1].sequence
+
+        if manager.state == ManagerStatuses.IDLE:
+            results_by_ai = read_results_by_ai(manager.results_dir)
+        else:
+            results_by_ai = {}
+
+        return {
+            "run_id": manager.benchmark_id,
+            "case_set_id": manager.case_set_id,
+            "total_cases": report.total_cases,
+            "current_case_index": report.current_case_index,
+            "current_case_id": report.current_case_id,
+            "ai_reports": collected_reports,
+            "summary": manager.db_client.summarize_ai_reports(report),
+            "results_by_ai": results_by_ai,
+            "logs": logs,
+            "connection_stats": manager.connection_stats,
+            "cursor": {"ai_reports": sequence, "logs": log_offset + len(logs)},
+        }
 
     def main(self):
         while True:
-            if self.if_timeout():
-                return
-
             try:
                 value = self.commands.get(block=True, timeout=1.0)
             except queue.Empty:
+                if not self.evaluator.is_alive():
+                    print("Exiting as the evaluator exited")
+                    break
+
                 continue
 
             try:
@@ -195,125 +585,29 @@ class BenchmarkManagerWorker:
                     break
 
                 if value[0] == "Start":
-                    self.benchmark_manager = BenchmarkManager(
-                        benchmark_start_time=self.benchmark_start_time
-                    )
-
-                    benchmark_manager = self.benchmark_manager
-                    request = value[1]
-                    unique_id = value[2]
-
-                    assert benchmark_manager.state == ManagerStatuses.IDLE
-
-                    case_set_id = parse_validate_caseSetId(request["caseSetId"])
-                    ai_implementations = request["aiImplementations"]
-                    results = []
-
-                    for ai in ai_implementations:
-                        assert (
-                            ai in AI_TYPES_ENDPOINTS
-                        ), f"AI {ai} not recognised/configured"
-
-                    benchmarked_ais = {
-                        ai: AI_TYPES_ENDPOINTS[ai] for ai in ai_implementations
-                    }
-
-                    cases = json.load(
-                        open(os.path.join(FILE_DIR, "data", case_set_id, "cases.json"))
-                    )
-
-                    benchmark_manager.setup(
-                        unique_id, case_set_id, cases, benchmarked_ais
-                    )
-
-                    def run_me():
-                        output = benchmark_manager.run_benchmark()
-                        results = output["results"]
-                        results_path = os.path.join(
-                            FILE_DIR, "data", case_set_id, unique_id
-                        )
-                        Path(results_path).mkdir(parents=True, exist_ok=True)
-                        json.dump(
-                            results,
-                            open(os.path.join(results_path, "results.json"), "w"),
-                            indent=2,
-                        )
-
-                    Thread(target=run_me).start()
+                    self.start_benchmark(value[1], value[2])
 
                     self.results.put_nowait("Started")
 
+                if value[0] == "Forget":
+                    self.forget_benchmark(value[1])
+
+                    self.results.put_nowait("Forgotten")
+
                 if value[0] == "GetStatus":
-                    manager = self.benchmark_manager
+                    manager = self.benchmark_managers[value[1]]
 
                     self.results.put_nowait(manager.state)
 
                 if value[0] == "GetUpdate":
                     print("  Preparing the update...")
 
-                    manager = self.benchmark_manager
-
-                    report = manager.db_client.select_manager_report(
-                        benchmark_id=manager.benchmark_id, prefetch=True
-                    )
-
-                    collected_reports = {}
-                    for ai_report in report.ai_reports:
-                        collected_reports.setdefault(ai_report.ai_name, []).append(
-                            {
-                                "case_status": ai_report.case_status,
-                                "healthcheck_status": ai_report.healthcheck_status,
-                                "health_checks": ai_report.health_checks,
-                                "errors": ai_report.errors,
-                                "timeouts": ai_report.hard_timeouts,
-                            }
-                        )
-
-                    results_file_path = os.path.join(
-                        FILE_DIR,
-                        "data",
-                        manager.case_set_id,
-                        manager.benchmark_id,
-                        "results.json",
-                    )
-
-                    if manager.state == ManagerStatuses.IDLE and os.path.isfile(
-                        results_file_path
-                    ):
-                        results = json.load(
-                            open(
-                                os.path.join(
-                                    FILE_DIR,
-                                    "data",
-                                    manager.case_set_id,
-                                    manager.benchmark_id,
-                                    "results.json",
-                                ),
-                                "r",
-                            )
-                        )
-                        results_by_ai = {}
-                        if results:
-                            for _, ais_results in results.items():
-                                for ai_name, ai_result in ais_results.items():
-                                    results_by_ai.setdefault(ai_name, []).append(
-                                        ai_result["result"]
-                                    )
-                    else:
-                        results_by_ai = {}
-
-                    output = {
-                        "run_id": manager.benchmark_id,
-                        "case_set_id": manager.case_set_id,
-                        "total_cases": report.total_cases,
-                        "current_case_index": report.current_case_index,
-                        "current_case_id": report.current_case_id,
-                        "ai_reports": collected_reports,
-                        "results_by_ai": results_by_ai,
-                        "logs": manager.accumulated_logs,
-                    }
-
-                    self.results.put_nowait(output)
+                    if value[1] not in self.benchmark_managers:
+                        # Forgotten, or started by a worker that exited since
+                        self.results.put_nowait("Unknown")
+                        continue
+
+                    self.results.put_nowait(self.get_update(value[1], value[2]))
             except:  # noqa: E722
                 # TODO: improve on this bare `except`
                 self.results.put_nowait("Error")
@@ -321,101 +615,512 @@ class BenchmarkManagerWorker:
                 continue
 
 
-def create_benchmark_manager():
-    num_running_benchmarks = 0
-    for benchmark_iterator in BENCHMARK_MANAGERS.values():
-        if benchmark_iterator["object"] == "PLACEHOLDER":
+def get_exit_handle(process):
+    """Returns a handle that is ready once a process exited
+
+    A pidfd where supported, as the sentinel of a worker is only ready once
+    the runner processes it forked exited as well.
+    """
+    if hasattr(os, "pidfd_open"):
+        try:
+            return os.pidfd_open(process.pid)
+        except OSError:
+            pass
+
+    return process.sentinel
+
+
+def run_benchmark_worker(commands, results, events, worker_index, admission, data_dir):
+    # Workers are started by the fork server, but fork their runners
+    multiprocessing.set_start_method("fork", force=True)
+    # The fork server imported the modules anew
+    set_data_dir(data_dir)
+    open_reports()
+    result_cache.open_result_cache()
+    BenchmarkManagerWorker(commands, results, events, worker_index, admission).main()
+
+
+def start_benchmark_worker(worker_index):
+    commands_queue = WORKER_CONTEXT.Queue(1)
+    results_queue = WORKER_CONTEXT.Queue(1)
+    events_reader, events_writer = WORKER_CONTEXT.Pipe(duplex=False)
+
+    process = WORKER_CONTEXT.Process(
+        target=run_benchmark_worker,
+        args=(
+            commands_queue,
+            results_queue,
+            events_writer,
+            worker_index,
+            ADMISSION_CONTROLLER,
+            get_data_path(),
+        ),
+    )
+    process.start()
+    events_writer.close()
+
+    return {
+        "process": process,
+        "exit_handle": get_exit_handle(process),
+        "commands": commands_queue,
+        "results": results_queue,
+        "events": events_reader,
+        "events_open": True,
+        "lock": Lock(),
+        "benchmark_id": None,
+    }
+
+
+def send_worker_command(worker, command):
+    with worker["lock"]:
+        worker["commands"].put(obj=command, block=True, timeout=QUEUE_PUT_TIMEOUT)
+
+        return worker["results"].get(block=True, timeout=QUEUE_GET_TIMEOUT)
+
+
+def wake_up_scheduler(reason):
+    # Jobs queued before the service is started are dispatched on its start
+    if SCHEDULER_WAKEUP_WRITER is None:
+        return
+
+    with SCHEDULER_WAKEUP_LOCK:
+        SCHEDULER_WAKEUP_WRITER.send(reason)
+
+
+def dispatch_queued_jobs():
+    """Starts the oldest queued benchmarks on the free workers"""
+    for (worker_index, worker) in enumerate(BENCHMARK_WORKERS):
+        if worker["benchmark_id"] is not None:
+            continue
+
+        job = select_next_queued_job()
+        if job is None:
+            return
+
+        update_job_status(job.benchmark_id, JOB_STATUS_RUNNING, worker_index)
+        worker["benchmark_id"] = job.benchmark_id
+
+        try:
+            result = send_worker_command(
+                worker, ("Start", job.request_data, job.benchmark_id)
+            )
+        except (queue.Empty, queue.Full):
+            result = None
+
+        if result != "Started":
+            print(f"Benchmark {job.benchmark_id} could not be started")
+            LIFECYCLE_METRICS["failed_to_start"] += 1
+            update_job_status(job.benchmark_id, JOB_STATUS_FAILED)
+            worker["benchmark_id"] = None
             continue
 
-        num_running_benchmarks += 1
+        LIFECYCLE_METRICS["started"] += 1
+        heapq.heappush(
+            BENCHMARK_DEADLINES,
+            (
+                time.time() + MAX_BENCHMARK_RUN_TIME + BENCHMARK_DEADLINE_GRACE_TIME,
+                job.benchmark_id,
+                worker_index,
+            ),
+        )
 
-    if num_running_benchmarks > LIMIT_MAX_NUM_RUNNING_BENCHMARKS:
-        return {"benchmarkManagerId": "CantCreateBecauseTooBusy"}
 
-    unique_id = get_unique_id()
+def handle_worker_event(worker_index, event):
+    worker = BENCHMARK_WORKERS[worker_index]
 
-    BENCHMARK_MANAGERS[unique_id] = {
-        "created": time.time(),
-        "object": "PLACEHOLDER",
-        "started": False,
-    }
+    if event[0] == "Finished":
+        _, benchmark_id, succeeded = event
+        LIFECYCLE_METRICS["finished" if succeeded else "failed"] += 1
+        update_job_status(
+            benchmark_id, JOB_STATUS_FINISHED if succeeded else JOB_STATUS_FAILED
+        )
+        if worker["benchmark_id"] == benchmark_id:
+            worker["benchmark_id"] = None
+
+
+def handle_worker_exit(worker_index):
+    worker = BENCHMARK_WORKERS[worker_index]
+
+    # Events sent before exiting come first
+    while worker["events_open"] and worker["events"].poll():
+        try:
+            handle_worker_event(worker_index, worker["events"].recv())
+        except EOFError:
+            break
+
+    print(f"Benchmark worker #{worker_index} exited, restarting it")
+    LIFECYCLE_METRICS["worker_exits"] += 1
+    if worker["benchmark_id"] is not None:
+        LIFECYCLE_METRICS["failed"] += 1
+        update_job_status(worker["benchmark_id"], JOB_STATUS_FAILED)
+
+    worker["process"].join()
+    worker["events"].close()
+    # Its requests are not waiting or in flight anymore, and the admission
+    # state of an AI may have been locked when it was killed
+    ADMISSION_CONTROLLER.release_abandoned_locks()
+    ADMISSION_CONTROLLER.reset_slot(worker_index)
+    if worker["exit_handle"] != worker["process"].sentinel:
+        os.close(worker["exit_handle"])
+    BENCHMARK_WORKERS[worker_index] = start_benchmark_worker(worker_index)
+
+
+def expire_deadlines():
+    """Kills the workers of the benchmarks running past their deadline (they
+    are then restarted as any exited worker), returning the time until the
+    next deadline if any"""
+    while BENCHMARK_DEADLINES:
+        deadline, benchmark_id, worker_index = BENCHMARK_DEADLINES[0]
+        worker = BENCHMARK_WORKERS[worker_index]
+
+        if worker["benchmark_id"] != benchmark_id:
+            # The benchmark already finished
+            heapq.heappop(BENCHMARK_DEADLINES)
+            continue
+
+        if deadline > time.time():
+            return deadline - time.time()
 
-    return {"benchmarkManagerId": unique_id}
+        heapq.heappop(BENCHMARK_DEADLINES)
+        print(f"Benchmark {benchmark_id} is past its deadline, killing its worker")
+        LIFECYCLE_METRICS["deadlines_expired"] += 1
+        worker["process"].kill()
+
+    return None
+
+
+def benchmark_scheduler():
+    """Schedules the queued benchmarks onto the worker pool
+
+    Sleeps until a benchmark is submitted, a worker reports that a benchmark
+    finished, a worker process exits (it is then restarted and its benchmark
+    fails) or a benchmark deadline expires.
+    """
+    while True:
+        dispatch_queued_jobs()
+        timeout = expire_deadlines()
+
+        events = {SCHEDULER_WAKEUP_READER: None}
+        exits = {}
+        for (worker_index, worker) in enumerate(BENCHMARK_WORKERS):
+            if worker["events_open"]:
+                events[worker["events"]] = worker_index
+            exits[worker["exit_handle"]] = worker_index
+
+        ready = wait(list(events) + list(exits), timeout)
+        if SCHEDULER_STOPPED.is_set():
+            return
+
+        LIFECYCLE_METRICS["wakeups"] += 1
+
+        for handle in ready:
+            if handle is SCHEDULER_WAKEUP_READER:
+                LIFECYCLE_METRICS[handle.recv()] += 1
+            elif handle in events:
+                try:
+                    handle_worker_event(events[handle], handle.recv())
+                except EOFError:
+                    # The worker is exiting, its exit handle will tell when
+                    # it is done
+                    BENCHMARK_WORKERS[events[handle]]["events_open"] = False
+
+        for handle in ready:
+            if handle in exits:
+                handle_worker_exit(exits[handle])
+
+
+def create_benchmark_manager():
+    return {"benchmarkManagerId": get_unique_id()}
 
 
 def run_case_set_against_ais(request):
-    """Runs a given case set against a given set of AIs"""
+    """Queues a given case set to be run against a given set of AIs"""
 
-    unique_id = request["benchmarkManagerId"]
+    unique_id = request.get("benchmarkManagerId") or get_unique_id()
 
-    commands_queue = Queue(1)
-    results_queue = Queue(1)
-    instance = BenchmarkManagerWorker(
-        commands_queue, results_queue, benchmark_start_time=time.time()
-    )
+    for ai in request["aiImplementations"]:
+        if ai not in AI_TYPES_ENDPOINTS:
+            return {"code": "400", "message": f"AI {ai} not recognised/configured"}, 400
 
-    BENCHMARK_MANAGERS[unique_id]["object"] = (
-        Process(target=instance.main),
-        commands_queue,
-        results_queue,
-    )
+    if select_job(unique_id) is not None:
+        return {"code": "409", "message": f"Benchmark {unique_id} already exists"}, 409
 
-    BENCHMARK_MANAGERS[unique_id]["object"][0].start()
+    enqueue_job(unique_id, request)
+    wake_up_scheduler("submitted")
 
-    BENCHMARK_MANAGERS[unique_id]["started"] = True
+    job = select_job(unique_id)
 
-    BENCHMARK_MANAGERS[unique_id]["object"][1].put(
-        obj=("Start", request, unique_id), block=True, timeout=QUEUE_PUT_TIMEOUT
-    )
+    return {
+        "benchmarkId": unique_id,
+        "status": job.status,
+        "queuePosition": get_queue_position(job),
+    }
 
-    result = BENCHMARK_MANAGERS[unique_id]["object"][2].get(
-        block=True, timeout=QUEUE_GET_TIMEOUT
-    )
 
-    return result
+def resume_benchmark(request):
+    """Queues a finished or failed benchmark again, to be run from its result
+    log: the (case, AI) pairs already done are not run again"""
+    benchmarkId = request["benchmarkId"]
+
+    job = select_job(benchmarkId)
+    if job is None:
+        return {"code": "404", "message": f"Unknown benchmark {benchmarkId}"}, 404
+
+    if job.status in [JOB_STATUS_QUEUED, JOB_STATUS_RUNNING]:
+        return (
+            {"code": "409", "message": f"Benchmark {benchmarkId} is {job.status}"},
+            409,
+        )
+
+    # The benchmark may be resumed on another worker, which rebuilds its
+    # report: the previous worker must not delete it later
+    if job.worker_index is not None:
+        worker = BENCHMARK_WORKERS[job.worker_index]
+        send_worker_command(worker, ("Forget", benchmarkId))
+
+    requeue_job(benchmarkId)
+    wake_up_scheduler("resumed")
+
+    job = select_job(benchmarkId)
+
+    return {
+        "benchmarkId": benchmarkId,
+        "status": job.status,
+        "queuePosition": get_queue_position(job),
+    }
 
 
 def report_update(request):
     benchmarkId = request["benchmarkId"]
 
+    job = select_job(benchmarkId)
+    if job is None:
+        return {"code": "404", "message": f"Unknown benchmark {benchmarkId}"}, 404
+
+    # The update only has what changed since this cursor
+    cursor = {"ai_reports": 0, "logs": 0}
+    cursor.update(request.get("cursor") or {})
+
+    if job.status == JOB_STATUS_QUEUED:
+        update = get_empty_update(job, cursor)
+        update["queue_position"] = get_queue_position(job)
+        return update
+
     print("Requesting result...")
 
-    BENCHMARK_MANAGERS[benchmarkId]["object"][1].put(
-        obj=("GetUpdate", 0), block=True, timeout=QUEUE_PUT_TIMEOUT
+    worker = BENCHMARK_WORKERS[job.worker_index]
+
+    result = send_worker_command(worker, ("GetUpdate", benchmarkId, cursor))
+    if result in ["Unknown", "Error"] and job.status == JOB_STATUS_FAILED:
+        # E.g. it could not be set up or its worker was killed: there is
+        # nothing more to report than its failure
+        update = get_empty_update(job, cursor)
+        update["message"] = f"Benchmark {benchmarkId} failed"
+        return update
+
+    if result == "Unknown":
+        return (
+            {
+                "code": "410",
+                "message": f"Benchmark {benchmarkId} was forgotten once its "
+                "results were sent",
+            },
+            410,
+        )
+
+    if result == "Error":
+        return (
+            {"code": "500", "message": f"No update for benchmark {benchmarkId}"},
+            500,
+        )
+
+    result["status"] = job.status
+    if job.status == JOB_STATUS_FAILED:
+        result["message"] = f"Benchmark {benchmarkId} failed"
+
+    # Its results (if any) were sent with this last update
+    if job.status in [JOB_STATUS_FINISHED, JOB_STATUS_FAILED]:
+        send_worker_command(worker, ("Forget", benchmarkId))
+
+    return result
+
+
+def get_empty_update(job, cursor):
+    """Returns the update of a benchmark that has nothing to report"""
+    return {
+        "run_id": job.benchmark_id,
+        "case_set_id": job.request_data["caseSetId"],
+        "status": job.status,
+        "total_cases": 0,
+        "current_case_index": -1,
+        "current_case_id": None,
+        "ai_reports": {},
+        "summary": {},
+        "results_by_ai": {},
+        "logs": [],
+        "connection_stats": {},
+        "cursor": cursor,
+    }
+
+
+def format_server_sent_event(event, data, event_id=None):
+    message = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    if event_id is not None:
+        message = f"id: {event_id}\n" + message
+
+    return message
+
+
+def generate_benchmark_events(benchmark_id, events_path, last_event_id):
+    """Yields the events of a benchmark as they are appended to its events
+    log, until the benchmark is neither queued nor running"""
+    events_file = None
+    last_sent = time.time()
+    try:
+        while True:
+            # Every event was logged once the job is done
+            status = select_job(benchmark_id).status
+
+            if events_file is None and os.path.isfile(events_path):
+                events_file = open(events_path, "rb")
+
+            if events_file is not None:
+                for (event_id, event, data) in read_events(events_file, last_event_id):
+                    last_event_id = event_id
+                    last_sent = time.time()
+                    yield format_server_sent_event(event, data, event_id)
+
+            if status not in [JOB_STATUS_QUEUED, JOB_STATUS_RUNNING]:
+                yield format_server_sent_event("end", {"status": status})
+                return
+
+            if time.time() - last_sent > EVENT_STREAM_KEEP_ALIVE_INTERVAL:
+                last_sent = time.time()
+                yield ": keep-alive\n\n"
+
+            time.sleep(EVENT_STREAM_POLL_INTERVAL)
+    finally:
+        if events_file is not None:
+            events_file.close()
+
+
+def stream_benchmark_events(benchmarkId):
+    """Streams the progress events of a benchmark as Server-Sent Events
+
+    Events are read from the events log of the benchmark, not requested from
+    its worker, so following a benchmark costs the worker nothing. The id of
+    an event is its position in the log: a client reconnecting with the
+    Last-Event-ID header gets the events it missed.
+    """
+    job = select_job(benchmarkId)
+    if job is None:
+        return {"code": "404", "message": f"Unknown benchmark {benchmarkId}"}, 404
+
+    last_event_id = 0
+    if has_request_context():
+        try:
+            last_event_id = int(flask_request.headers.get("Last-Event-ID", 0))
+        except ValueError:
+            pass
+
+    events_path = get_events_path(
+        get_results_dir(job.request_data["caseSetId"], benchmarkId)
     )
 
-    result = BENCHMARK_MANAGERS[benchmarkId]["object"][2].get(
-        block=True, timeout=QUEUE_GET_TIMEOUT
+    return Response(
+        generate_benchmark_events(benchmarkId, events_path, last_event_id),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
-    if len(result["results_by_ai"]) > 0:
-        BENCHMARK_MANAGERS[benchmarkId]["object"][1].put(
-            obj=None, block=True, timeout=QUEUE_PUT_TIMEOUT
+
+def benchmark_lifecycle_stats():
+    return {
+        "events": dict(LIFECYCLE_METRICS),
+        "workers": len(BENCHMARK_WORKERS),
+        "busy_workers": sum(
+            worker["benchmark_id"] is not None for worker in BENCHMARK_WORKERS
+        ),
+        "queued_benchmarks": count_jobs(JOB_STATUS_QUEUED),
+        "pending_deadlines": len(BENCHMARK_DEADLINES),
+    }
+
+
+def stop_benchmark_workers():
+    # The benchmarks they were running are queued again on the next start
+    SCHEDULER_STOPPED.set()
+    for worker in BENCHMARK_WORKERS:
+        worker["process"].terminate()
+
+
+# Pool of worker processes the benchmarks are run in, started by
+# `start_benchmark_service` (and restarted when they exit by the scheduler
+# thread). They are started by a fork server, a process started before any
+# thread: a worker forked from the evaluator while another of its threads is
+# in a SQLite call would inherit its locks and hang on its first connection.
+WORKER_CONTEXT = multiprocessing.get_context("forkserver")
+BENCHMARK_WORKERS = []
+# Heap of the (deadline, benchmark id, worker index) of the running benchmarks
+BENCHMARK_DEADLINES = []
+# Counts of the lifecycle events processed by the scheduler
+LIFECYCLE_METRICS = Counter()
+# Lets the endpoints wake the scheduler thread up, created with it
+SCHEDULER_WAKEUP_READER = SCHEDULER_WAKEUP_WRITER = None
+SCHEDULER_WAKEUP_LOCK = Lock()
+SCHEDULER_STOPPED = Event()
+# Shared by the benchmark workers (and their runners), created with them
+ADMISSION_CONTROLLER = None
+
+
+def initialize_databases():
+    """Creates the databases of the evaluator (queueing again the benchmarks
+    that were running when it stopped) and registers the doctor cases"""
+    # Preparing human doctor cases (London 2019 model)
+    london_path = get_case_set_path("london_model2019_cases_v1")
+    if not os.path.isdir(london_path):
+        # TODO: improve this link
+        os.makedirs(london_path)
+        shutil.copyfile(
+            os.path.join(ROOT_DIR, "data/doctor_cases/london_model/cases.json"),
+            os.path.join(london_path, "cases.json"),
         )
 
-        del BENCHMARK_MANAGERS[benchmarkId]
+    initialize_catalog()
+    initialize_jobs()
+    result_cache.initialize_result_cache()
+    initialize_reports()
 
-    return result
+    # No connection is left open: they would be inherited by the processes
+    # started next
+    with CATALOG_DATABASE.connection_context():
+        if select_case_set("london_model2019_cases_v1") is None:
+            register_case_set("london_model2019_cases_v1")
 
 
-def process_controller():
-    while True:
-        for key, benchmark_iterator in list(BENCHMARK_MANAGERS.items()):
-            if (
-                benchmark_iterator["object"] != "PLACEHOLDER"
-                and benchmark_iterator["started"]
-                and not benchmark_iterator["object"][0].is_alive()
-            ):
-                BENCHMARK_MANAGERS.pop(key, None)
-                continue
+def start_benchmark_service():
+    """Initializes the databases, then starts the benchmark workers and the
+    scheduler thread
 
-            # Check that the process is not running longer than expected:
-            if time.time() - benchmark_iterator["created"] > MAX_BENCHMARK_RUN_TIME:
-                BENCHMARK_MANAGERS.pop(key, None)
-                continue
+    Called once by the entry points of the evaluator, before serving
+    requests. Importing this module has no side effect, as the workers
+    import it as well.
+    """
+    global ADMISSION_CONTROLLER, SCHEDULER_WAKEUP_READER, SCHEDULER_WAKEUP_WRITER
+
+    if BENCHMARK_WORKERS:
+        return
 
-        time.sleep(0.01)
+    initialize_databases()
+
+    # The fork server imports this module once for all the workers
+    WORKER_CONTEXT.set_forkserver_preload(["__main__", __name__])
+    ADMISSION_CONTROLLER = AdmissionController(
+        AI_TYPES_ENDPOINTS, BENCHMARK_WORKER_POOL_SIZE, context=WORKER_CONTEXT
+    )
 
+    atexit.register(stop_benchmark_workers)
+    for worker_index in range(BENCHMARK_WORKER_POOL_SIZE):
+        BENCHMARK_WORKERS.append(start_benchmark_worker(worker_index))
 
-process_controller_thread = Thread(target=process_controller, args=())
-process_controller_thread.start()
+    SCHEDULER_WAKEUP_READER, SCHEDULER_WAKEUP_WRITER = Pipe(duplex=False)
+    Thread(target=benchmark_scheduler, args=(), daemon=True).start()
@@ -10,6 +10,7 @@ from flask_cors import CORS
 
 sys.path.append("..")  # isort:skip
 from config import CONFIG_DEFAULT_HOST  # isort:skip  # NOQA: E402
+from api import start_benchmark_service  # isort:skip  # NOQA: E402
 
 
 def create_app():
@@ -25,4 +26,5 @@ def create_app():
 
 if __name__ == "__main__":
     app = create_app()
+    start_benchmark_service()
     app.run(port=5003, host=CONFIG_DEFAULT_HOST)
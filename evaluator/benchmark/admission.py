@@ -0,0 +1,275 @@
+import multiprocessing
+import os
+import time
+from contextlib import contextmanager
+
+from evaluator.benchmark.definitions import (
+    ADMISSION_LOCK_TIMEOUT,
+    ADMISSION_WAKEUP_INTERVAL,
+    DEFAULT_RATE_LIMIT_BURST,
+)
+from evaluator.benchmark.exceptions import AdmissionError
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+class AIAdmissionState(object):
+    """Limits and (shared memory) admission state of an AI"""
+
+    def __init__(self, ai_config, num_slots, context):
+        self.max_in_flight = ai_config.get("max_in_flight")
+        self.rate_limit = ai_config.get("rate_limit")
+        self.burst = ai_config.get("burst", DEFAULT_RATE_LIMIT_BURST)
+
+        # Only held to update the state, never while waiting. The pid of the
+        # process holding it is kept, so that it can be unlocked if that
+        # process is killed
+        self.lock = context.Lock()
+        self.lock_owner = context.Value("i", 0, lock=False)
+
+        # Bumped when a slot is reset: the requests admitted (or waiting)
+        # before are not accounted for anymore
+        self.generations = context.Array("i", num_slots, lock=False)
+        # Requests in flight and waiting for admission, per slot
+        self.in_flight = context.Array("i", num_slots, lock=False)
+        self.waiting = context.Array("i", num_slots, lock=False)
+        # Slot admitted first if it is waiting (round-robin)
+        self.next_slot = context.Value("i", 0, lock=False)
+        # Token bucket
+        self.tokens = context.Value("d", self.burst, lock=False)
+        self.refilled_at = context.Value("d", time.monotonic(), lock=False)
+
+
+class AdmissionController(object):
+    """Admits the requests sent to the AIs by all the running benchmarks
+
+    AIs can be given a maximum number of requests in flight at once
+    (`max_in_flight`) and a rate limit in requests per second (`rate_limit`,
+    a token bucket of `burst` tokens), whatever the number of benchmarks
+    sending them cases. Each benchmark runs in a slot (its benchmark
+    worker); when several slots wait for the same AI, they are admitted in
+    turn.
+
+    Waiting requests sleep on the wake-up semaphore of their slot, and every
+    wait has a timeout: a benchmark worker killed while it held the state of
+    an AI fails the requests of the others (see `release_abandoned_locks`),
+    it does not block them. Admitted requests get the generation of their
+    slot as a ticket, so that those of a benchmark whose slot was reset since
+    are not accounted for in the next one.
+
+    The state is kept in shared memory, so the controller has to be created
+    (with the multiprocessing context the processes sharing it are started
+    with) before they are started.
+    """
+
+    def __init__(self, ai_configs, num_slots, context=None):
+        context = context or multiprocessing.get_context()
+        self.num_slots = num_slots
+        self.wakeups = [context.Semaphore(0) for _ in range(num_slots)]
+        self.states = {
+            ai_name: AIAdmissionState(ai_config, num_slots, context)
+            for ai_name, ai_config in ai_configs.items()
+            if "max_in_flight" in ai_config or "rate_limit" in ai_config
+        }
+
+    def for_slot(self, slot):
+        return BenchmarkAdmission(self, slot)
+
+    @contextmanager
+    def _locked(self, ai_name, state):
+        if not state.lock.acquire(timeout=ADMISSION_LOCK_TIMEOUT):
+            raise AdmissionError(
+                f"Admission state of AI {ai_name} locked by process "
+                f"{state.lock_owner.value} for more than {ADMISSION_LOCK_TIMEOUT}sec"
+            )
+
+        state.lock_owner.value = os.getpid()
+        try:
+            yield
+        finally:
+            state.lock_owner.value = 0
+            state.lock.release()
+
+    def acquire(self, ai_name, slot, cancelled=None):
+        """Waits until a request to an AI can be sent from a slot, and returns
+        the ticket to release it with (None if the AI has no limits)
+
+        Raises an AdmissionError if `cancelled` (an event) is set or the slot
+        is reset while waiting.
+        """
+        state = self.states.get(ai_name)
+        if state is None:
+            return None
+
+        with self._locked(ai_name, state):
+            generation = state.generations[slot]
+            state.waiting[slot] += 1
+
+        admitted = False
+        try:
+            while True:
+                with self._locked(ai_name, state):
+                    if state.generations[slot] != generation:
+                        raise AdmissionError(f"Slot {slot} was reset")
+
+                    wait_time = self._get_wait_time(state, slot)
+                    if wait_time == 0:
+                        state.waiting[slot] -= 1
+                        state.in_flight[slot] += 1
+                        if state.rate_limit:
+                            state.tokens.value -= 1
+                        state.next_slot.value = (slot + 1) % self.num_slots
+                        admitted = True
+                        break
+
+                if cancelled is not None and cancelled.is_set():
+                    raise AdmissionError(f"Request to AI {ai_name} cancelled")
+
+                if wait_time is None:
+                    wait_time = ADMISSION_WAKEUP_INTERVAL
+                self.wakeups[slot].acquire(
+                    timeout=min(wait_time, ADMISSION_WAKEUP_INTERVAL)
+                )
+        finally:
+            if not admitted:
+                self._stop_waiting(ai_name, state, slot, generation)
+
+        # The next slot in turn may be admitted as well
+        self._wake_up_waiting(state)
+        return generation
+
+    def _stop_waiting(self, ai_name, state, slot, generation):
+        try:
+            with self._locked(ai_name, state):
+                if state.generations[slot] == generation:
+                    state.waiting[slot] = max(state.waiting[slot] - 1, 0)
+        except AdmissionError:
+            return
+
+        self._wake_up_waiting(state)
+
+    def release(self, ai_name, slot, ticket):
+        """Releases a request admitted with a ticket, unless its slot was
+        reset since"""
+        state = self.states.get(ai_name)
+        if state is None or ticket is None:
+            return
+
+        with self._locked(ai_name, state):
+            if state.generations[slot] != ticket:
+                return
+
+            state.in_flight[slot] = max(state.in_flight[slot] - 1, 0)
+
+        self._wake_up_waiting(state)
+
+    def wake_up(self, slot):
+        self.wakeups[slot].release()
+
+    def _wake_up_waiting(self, state):
+        for slot in range(self.num_slots):
+            if state.waiting[slot] > 0:
+                self.wakeups[slot].release()
+
+    def reset_slot(self, slot):
+        """Forgets the requests of a slot, e.g. those of runners that were
+        terminated while waiting or in flight: those still waiting fail, and
+        those still in flight are not accounted for when released"""
+        num_waiting = 0
+        for ai_name, state in self.states.items():
+            with self._locked(ai_name, state):
+                state.generations[slot] += 1
+                num_waiting += state.waiting[slot]
+                state.in_flight[slot] = 0
+                state.waiting[slot] = 0
+
+            self._wake_up_waiting(state)
+
+        for _ in range(num_waiting):
+            self.wake_up(slot)
+
+    def release_abandoned_locks(self):
+        """Unlocks the states locked by processes that were killed while
+        holding them (e.g. a benchmark worker killed at its deadline)"""
+        for state in self.states.values():
+            owner = state.lock_owner.value
+            if owner and not is_process_alive(owner):
+                state.lock_owner.value = 0
+                state.lock.release()
+
+    def get_stats(self):
+        stats = {}
+        for ai_name, state in self.states.items():
+            with self._locked(ai_name, state):
+                stats[ai_name] = {
+                    "in_flight": sum(state.in_flight),
+                    "waiting": sum(state.waiting),
+                }
+
+        return stats
+
+    def _get_turn(self, state):
+        for index in range(self.num_slots):
+            slot = (state.next_slot.value + index) % self.num_slots
+            if state.waiting[slot] > 0:
+                return slot
+
+    def _get_wait_time(self, state, slot):
+        """Returns 0 if a request can be admitted now, else how long to wait
+        before checking again (None until woken up)"""
+        if self._get_turn(state) != slot:
+            return None
+
+        if state.max_in_flight is not None:
+            if sum(state.in_flight) >= state.max_in_flight:
+                return None
+
+        if state.rate_limit:
+            now = time.monotonic()
+            state.tokens.value = min(
+                state.burst,
+                state.tokens.value + (now - state.refilled_at.value) * state.rate_limit,
+            )
+            state.refilled_at.value = now
+
+            if state.tokens.value < 1:
+                return (1 - state.tokens.value) / state.rate_limit
+
+        return 0
+
+
+class BenchmarkAdmission(object):
+    """Admission of the requests of the benchmark run in a given slot"""
+
+    def __init__(self, controller, slot):
+        self.controller = controller
+        self.slot = slot
+
+    def acquire(self, ai_name, cancelled=None):
+        return self.controller.acquire(ai_name, self.slot, cancelled)
+
+    def release(self, ai_name, ticket):
+        self.controller.release(ai_name, self.slot, ticket)
+
+    @contextmanager
+    def admit(self, ai_name):
+        ticket = self.acquire(ai_name)
+        try:
+            yield
+        finally:
+            self.release(ai_name, ticket)
+
+    def wake_up(self):
+        self.controller.wake_up(self.slot)
+
+    def reset(self):
+        self.controller.reset_slot(self.slot)
@@ -0,0 +1,500 @@
+import asyncio
+import json
+import time
+from contextlib import asynccontextmanager
+from threading import Event, Thread
+from timeit import default_timer as timer
+
+from evaluator.benchmark.definitions import (
+    DEFAULT_HTTP_POOL_SIZE,
+    DEFAULT_SOLVE_CASE_CONCURRENCY,
+    HEALTH_MONITOR_INTERVAL,
+    MAX_NUM_ATTEMPTS,
+    MAX_WAIT_BETWEEN_RETRIES,
+    CaseStatuses,
+    HealthCheckPolicies,
+)
+from evaluator.benchmark.exceptions import SetupError
+from evaluator.benchmark.runner_policy import (
+    RunnerPolicy,
+    SolveRequest,
+    build_health_check_result,
+    is_healthy_response,
+)
+from evaluator.benchmark.signals import ProcessSignal
+from evaluator.constants import MAX_BENCHMARK_RUN_TIME
+from logs.logger import get_logger
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+logger = get_logger()
+
+HEALTH_CHECK_TIMEOUT = 3
+# Same backoff between health check attempts as the process runners
+HEALTH_CHECK_RETRY_MULTIPLIER = 0.05
+
+
+class AsyncEngine(object):
+    """Event loop, running in a thread of the benchmark worker, that drives
+    the runners of every AI of a benchmark with non-blocking HTTP requests
+    instead of one process per AI"""
+
+    def __init__(self, benchmark_start_time):
+        if aiohttp is None:
+            raise SetupError("The asyncio runner engine requires aiohttp")
+
+        self.benchmark_start_time = benchmark_start_time
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.runners = []
+        self.sessions = {}
+
+    def start(self):
+        if self.thread.ident is None:
+            self.thread.start()
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def call_soon(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def get_session(self, ai_name, pool_size):
+        """Returns the session of an AI, which opens at most `pool_size`
+        connections to each of its hosts"""
+        # Created on first use, as it has to be from within the event loop
+        if ai_name not in self.sessions:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_request_start.append(self._on_request_start)
+            trace_config.on_connection_create_end.append(self._on_connection_created)
+            self.sessions[ai_name] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=pool_size),
+                trace_configs=[trace_config],
+            )
+        return self.sessions[ai_name]
+
+    # Requests carry the connection stats of their runner as trace context
+    @staticmethod
+    async def _on_request_start(session, trace_config_ctx, params):
+        trace_config_ctx.trace_request_ctx["requests"] += 1
+
+    @staticmethod
+    async def _on_connection_created(session, trace_config_ctx, params):
+        trace_config_ctx.trace_request_ctx["connections"] += 1
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        remaining_time = self.benchmark_start_time + MAX_BENCHMARK_RUN_TIME
+        self.loop.call_later(max(remaining_time - time.time(), 0), self._on_timeout)
+
+        try:
+            self.loop.run_forever()
+        finally:
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(
+                asyncio.gather(*pending, return_exceptions=True)
+            )
+            for session in self.sessions.values():
+                self.loop.run_until_complete(session.close())
+            self.loop.close()
+
+    def _on_timeout(self):
+        for runner in self.runners:
+            runner.terminate()
+
+    def on_runner_terminated(self):
+        if all(runner.terminated for runner in self.runners):
+            self.loop.stop()
+
+
+class AsyncRunnerPipe(object):
+    """Manager's end of the connection to an `AsyncBenchmarkRunner`, standing
+    in for the pipe of a process runner"""
+
+    def __init__(self, runner):
+        self.runner = runner
+
+    def send(self, message):
+        signal, parameters = message
+        self.runner.engine.call_soon(self.runner.handle_signal, signal, parameters)
+
+
+class AsyncBenchmarkRunner(object):
+    """Coroutine-based counterpart of `BenchmarkRunner`
+
+    It answers the same signals and puts the same messages on the result
+    queue, so the benchmark manager handles both engines alike. Both apply
+    the same `RunnerPolicy`, only the requests are sent differently.
+    """
+
+    def __init__(
+        self,
+        engine,
+        ai_name,
+        ai_config,
+        out_queue,
+        runner_id,
+        benchmark_start_time,
+        case_set=None,
+        health_check_policy=HealthCheckPolicies.PER_CASE,
+        circuit_breaker=False,
+        admission=None,
+        result_cache=False,
+    ):
+        self.engine = engine
+        self.ai_name = ai_name
+        self.ai_config = ai_config
+        self.out_queue = out_queue
+        self.runner_id = runner_id
+        self.benchmark_start_time = benchmark_start_time
+        self.case_set = case_set
+        self.terminated = False
+        self.tasks = set()
+        self.connection_stats = {"requests": 0, "connections": 0}
+        self.health_check_policy = health_check_policy
+        self.policy = RunnerPolicy(
+            ai_name,
+            ai_config,
+            health_check_policy=health_check_policy,
+            circuit_breaker=circuit_breaker,
+            result_cache=result_cache,
+        )
+        self.admission = admission
+
+        engine.runners.append(self)
+
+    def if_timeout(self):
+        return time.time() - self.benchmark_start_time > MAX_BENCHMARK_RUN_TIME
+
+    def start(self):
+        self.engine.start()
+        if self.health_check_policy == HealthCheckPolicies.CACHED:
+            self.engine.call_soon(self._spawn, self.monitor_health())
+
+    def is_alive(self):
+        return not self.terminated and self.engine.is_alive()
+
+    def handle_signal(self, signal, parameters):
+        if self.terminated:
+            return
+
+        if signal == ProcessSignal.TERMINATE or self.if_timeout():
+            self.terminate()
+
+        elif signal == ProcessSignal.HEALTH_CHECK:
+            self._spawn(
+                self.check_health(parameters["case_num"], parameters["case_id"])
+            )
+
+        elif signal == ProcessSignal.SOLVE_CASE:
+            self._spawn(
+                self._solve_single_case(parameters["case_num"], parameters["case"])
+            )
+
+        elif signal == ProcessSignal.RUN_CASE_SET:
+            self._spawn(self.run_case_set(parameters["skip_case_nums"]))
+
+        else:
+            logger.error(f"Unexpected signal {signal} received by {self.ai_name}")
+            self.terminate()
+
+    def terminate(self):
+        if self.terminated:
+            return
+
+        self.terminated = True
+        for task in list(self.tasks):
+            task.cancel()
+
+        self.out_queue.put(
+            (
+                ProcessSignal.SENTINEL,
+                self.runner_id,
+                {"ai_name": self.ai_name, "results": {}},
+            )
+        )
+        self.engine.on_runner_terminated()
+
+    def _spawn(self, coroutine):
+        task = self.engine.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self._on_task_done)
+        return task
+
+    def _on_task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            # Same outcome as an exception killing a process runner
+            logger.error(f"Runner of AI {self.ai_name} failed: {task.exception()}")
+            self.terminate()
+
+    async def _perform_request(self, url, data, timeout):
+        # As many connections as the process runners keep alive to the AI
+        pool_size = max(
+            self.ai_config.get("pool_size", DEFAULT_HTTP_POOL_SIZE),
+            self.ai_config.get("concurrency", DEFAULT_SOLVE_CASE_CONCURRENCY),
+        )
+        async with self.engine.get_session(self.ai_name, pool_size).post(
+            url,
+            data=json.dumps(data),
+            headers={"Content-Type": "application/json"},
+            timeout=aiohttp.ClientTimeout(total=timeout),
+            trace_request_ctx=self.connection_stats,
+        ) as response:
+            return response.status, await response.text()
+
+    @asynccontextmanager
+    async def _admit(self):
+        """Waits until a request can be sent to the AI (in an executor thread
+        so as not to block the event loop), which is released when leaving
+        the context
+
+        If the waiting task is cancelled, the executor thread stops waiting,
+        or releases the request if it was admitted in the meantime.
+        """
+        if self.admission is None:
+            yield
+            return
+
+        cancelled = Event()
+        future = self.engine.loop.run_in_executor(
+            None, self.admission.acquire, self.ai_name, cancelled
+        )
+        try:
+            ticket = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            cancelled.set()
+            self.admission.wake_up()
+            future.add_done_callback(self._release_late_admission)
+            raise
+
+        try:
+            yield
+        finally:
+            self.admission.release(self.ai_name, ticket)
+
+    def _release_late_admission(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self.admission.release(self.ai_name, future.result())
+
+    def get_connection_stats(self):
+        """Returns how many requests were sent to the AI and how many
+        connections had to be opened for them"""
+        stats = dict(self.connection_stats)
+        stats["reused_connections"] = stats["requests"] - stats["connections"]
+        return stats
+
+    async def _solve_single_case(self, case_num, case):
+        (solvecase_result,) = await self.solve_batch([(case_num, case)])
+        self.out_queue.put((ProcessSignal.SOLVE_CASE, self.runner_id, solvecase_result))
+        self.out_queue.put((ProcessSignal.SENTINEL, self.runner_id, None))
+
+    async def run_case_set(self, skip_case_nums=()):
+        """Health-checks the AI and solves every case of the case set, with
+        up to `concurrency` requests in flight (pipelined mode)"""
+        skip_case_nums = set(skip_case_nums)
+        concurrency = self.ai_config.get("concurrency", DEFAULT_SOLVE_CASE_CONCURRENCY)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        in_flight = set()
+        batch = []
+        for case_num, case in enumerate(self.case_set):
+            if self.if_timeout():
+                break
+
+            if case_num in skip_case_nums:
+                continue
+
+            if await self.check_health(case_num, case["caseData"]["caseId"]):
+                batch.append((case_num, case))
+
+            if not self.policy.is_batch_ready(batch):
+                continue
+
+            await semaphore.acquire()
+            task = self._spawn(self._solve_and_report_batch(batch, semaphore))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+            batch = []
+
+        if batch:
+            await semaphore.acquire()
+            in_flight.add(self._spawn(self._solve_and_report_batch(batch, semaphore)))
+
+        if in_flight:
+            await asyncio.wait(in_flight)
+
+        self.out_queue.put((ProcessSignal.CASE_SET_DONE, self.runner_id, None))
+
+    async def _solve_and_report_batch(self, cases, semaphore):
+        try:
+            solvecase_results = await self.solve_batch(cases)
+        finally:
+            semaphore.release()
+
+        for solvecase_result in solvecase_results:
+            if solvecase_result is not None:
+                self.out_queue.put(
+                    (ProcessSignal.SOLVE_CASE, self.runner_id, solvecase_result)
+                )
+
+    async def solve_batch(self, cases):
+        """Solves (case number, case) pairs, all at once if there are several
+        of them. The cases found in the result cache of the AI are not sent
+        to it. The cache is read and written in an executor thread, as SQLite
+        would block the event loop"""
+        if self.policy.result_cache is None:
+            cached_results = {}
+        else:
+            cached_results, cases = await self.engine.loop.run_in_executor(
+                None, self.policy.get_cached_results, cases
+            )
+
+        solvecase_results = await self.solve_cases(cases) if cases else []
+
+        if self.policy.result_cache is not None:
+            await self.engine.loop.run_in_executor(
+                None, self.policy.cache_results, cases, solvecase_results
+            )
+
+        return list(cached_results.values()) + solvecase_results
+
+    def _respond_healthcheck_signal(self, result, send_sentinel=False):
+        result["connection_stats"] = self.get_connection_stats()
+        self.out_queue.put((ProcessSignal.HEALTH_CHECK, self.runner_id, result))
+
+        if send_sentinel:
+            self.out_queue.put((ProcessSignal.SENTINEL, self.runner_id, None))
+
+    async def check_health(self, case_num, case_id):
+        """Health-checks the AI before a case, following the health check
+        policy, and returns whether it is healthy (and the case can be sent)"""
+        result = self.policy.check_health_without_request(case_num, case_id)
+        if result is not None:
+            self._respond_healthcheck_signal(result, send_sentinel=True)
+            return result["healthy"]
+
+        healthy = await self.is_healthy(case_num, case_id)
+        self.policy.record_health_check(healthy)
+        return healthy
+
+    async def monitor_health(self):
+        """Keeps the cached health status fresh, independently of the cases
+        being solved"""
+        while True:
+            await asyncio.sleep(HEALTH_MONITOR_INTERVAL)
+            try:
+                async with self._admit():
+                    status_code, data = await self._perform_request(
+                        self.ai_config["health_check"],
+                        {"aiImplementation": self.ai_name},
+                        HEALTH_CHECK_TIMEOUT,
+                    )
+                healthy = is_healthy_response(status_code, json.loads(data))
+            except Exception as exc:
+                logger.info(
+                    f"Health monitor check failed for {self.ai_name}. Got {str(exc)}"
+                )
+                healthy = False
+
+            self.policy.cache_health(healthy)
+
+    async def is_healthy(self, case_num, case_id):
+        for attempt in range(1, MAX_NUM_ATTEMPTS + 1):
+            if self.if_timeout():
+                return False
+
+            result = build_health_check_result(self.ai_name, case_num, case_id)
+
+            try:
+                async with self._admit():
+                    status_code, data = await self._perform_request(
+                        self.ai_config["health_check"],
+                        {"aiImplementation": self.ai_name},
+                        HEALTH_CHECK_TIMEOUT,
+                    )
+                data = json.loads(data)
+                healthy = is_healthy_response(status_code, data)
+            except Exception as exc:
+                failure = f"Got {str(exc)}"
+                healthy = False
+            else:
+                failure = f"Got status code {status_code} and data={data}"
+
+            if healthy:
+                message = (
+                    f"Successful health check for {self.ai_name} on "
+                    f"attempt #{attempt}"
+                )
+                result["log"].append(message)
+                logger.info(message)
+                result["healthy"] = True
+                result["report"]["healthcheck_status"] = CaseStatuses.OK
+                self.policy.capabilities = data.get("capabilities", [])
+                self._respond_healthcheck_signal(result, send_sentinel=True)
+                return True
+
+            if attempt < MAX_NUM_ATTEMPTS:
+                message = (
+                    f"Failed healthcheck #{attempt} for AI {self.ai_name}. "
+                    f"Retrying..."
+                )
+                result["log"].append(message)
+                logger.info(f"{message} {failure}")
+                self._respond_healthcheck_signal(result)
+
+                await asyncio.sleep(
+                    min(
+                        HEALTH_CHECK_RETRY_MULTIPLIER * 2 ** attempt,
+                        MAX_WAIT_BETWEEN_RETRIES,
+                    )
+                )
+
+        result["report"]["errors"] = 1
+        result["report"]["healthcheck_status"] = CaseStatuses.ERROR
+        message = (
+            f"Error: could not get successful healthcheck response for "
+            f"{self.ai_name} after {MAX_NUM_ATTEMPTS} attempts. {failure}"
+        )
+        result["log"].append(message)
+        logger.error(message)
+        self._respond_healthcheck_signal(result, send_sentinel=True)
+
+        return False
+
+    async def solve_cases(self, cases):
+        """Solves cases with a single request to the AI: its solve-case
+        endpoint for a single case, its solve-cases endpoint for a batch"""
+        if self.if_timeout():
+            return [None] * len(cases)
+
+        request = SolveRequest(self.ai_name, self.ai_config, cases)
+        try:
+            async with self._admit():
+                start = timer()
+                status_code, response_data = await self._perform_request(
+                    request.url, request.data, request.timeout
+                )
+                end = timer()
+        except asyncio.TimeoutError as exc:
+            request.fail(exc, timeout=True)
+        except Exception as exc:
+            request.fail(exc)
+        else:
+            request.complete(status_code, response_data, end - start)
+
+        return [
+            self._finish_solve_case(return_dict) for return_dict in request.return_dicts
+        ]
+
+    def _finish_solve_case(self, return_dict):
+        self.policy.finish_solve_case(return_dict)
+        return_dict["connection_stats"] = self.get_connection_stats()
+
+        return return_dict
@@ -0,0 +1,99 @@
+import time
+from collections import deque
+from threading import Lock
+
+from evaluator.benchmark.definitions import (
+    CIRCUIT_BREAKER_COOLDOWN,
+    CIRCUIT_BREAKER_MAX_ERROR_RATE,
+    CIRCUIT_BREAKER_MAX_TIMEOUT_RATE,
+    CIRCUIT_BREAKER_MIN_CASES,
+    CIRCUIT_BREAKER_WINDOW_SIZE,
+    CircuitStates,
+)
+
+
+class CircuitBreaker(object):
+    """Per-AI circuit breaker
+
+    While closed, the outcomes of the last `window_size` cases are kept and
+    the circuit opens when their error or timeout rate reaches its maximum.
+    While open, no case is let through. After `cooldown` seconds it is half
+    open: a single trial case is let through, closing the circuit if it
+    succeeds and opening it again otherwise.
+    """
+
+    def __init__(
+        self,
+        window_size=CIRCUIT_BREAKER_WINDOW_SIZE,
+        min_cases=CIRCUIT_BREAKER_MIN_CASES,
+        max_error_rate=CIRCUIT_BREAKER_MAX_ERROR_RATE,
+        max_timeout_rate=CIRCUIT_BREAKER_MAX_TIMEOUT_RATE,
+        cooldown=CIRCUIT_BREAKER_COOLDOWN,
+    ):
+        self.min_cases = min_cases
+        self.max_error_rate = max_error_rate
+        self.max_timeout_rate = max_timeout_rate
+        self.cooldown = cooldown
+
+        self.state = CircuitStates.CLOSED
+        self.outcomes = deque(maxlen=window_size)
+        self.opened_at = None
+        self.trial_in_progress = False
+        self.lock = Lock()
+
+    @classmethod
+    def from_ai_config(cls, ai_config):
+        """Creates the circuit breaker of an AI, with the settings of the
+        `circuit_breaker` key of its configuration if any"""
+        return cls(**ai_config.get("circuit_breaker", {}))
+
+    def allow_case(self):
+        with self.lock:
+            if self.state == CircuitStates.OPEN:
+                if time.time() - self.opened_at < self.cooldown:
+                    return False
+
+                self.state = CircuitStates.HALF_OPEN
+                self.trial_in_progress = False
+
+            if self.state == CircuitStates.HALF_OPEN:
+                if self.trial_in_progress:
+                    return False
+
+                self.trial_in_progress = True
+
+            return True
+
+    def record(self, error=False, timeout=False):
+        """Records the outcome of a case let through and returns the state of
+        the circuit"""
+        with self.lock:
+            if self.state == CircuitStates.HALF_OPEN:
+                if error or timeout:
+                    self._open()
+                else:
+                    self.state = CircuitStates.CLOSED
+                    self.trial_in_progress = False
+
+            elif self.state == CircuitStates.CLOSED:
+                self.outcomes.append((error, timeout))
+
+                if len(self.outcomes) >= self.min_cases:
+                    num_cases = len(self.outcomes)
+                    error_rate = sum(error for error, _ in self.outcomes) / num_cases
+                    timeout_rate = (
+                        sum(timeout for _, timeout in self.outcomes) / num_cases
+                    )
+                    if (
+                        error_rate >= self.max_error_rate
+                        or timeout_rate >= self.max_timeout_rate
+                    ):
+                        self._open()
+
+            return self.state
+
+    def _open(self):
+        self.state = CircuitStates.OPEN
+        self.opened_at = time.time()
+        self.outcomes.clear()
+        self.trial_in_progress = False
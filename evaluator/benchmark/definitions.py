@@ -1,10 +1,56 @@
-from enum import IntEnum
+from enum import Enum, IntEnum
 
 # TODO: Make configurable
 MAX_NUM_ATTEMPTS = 10
 MAX_WAIT_BETWEEN_RETRIES = 3
 SOLVE_CASE_SOFT_TIMEOUT = 5
 SOLVE_CASE_HARD_TIMEOUT = 10
+# Default number of solve-case requests in flight at once per AI (pipelined
+# mode), can be set per AI with the `concurrency` key of its configuration
+DEFAULT_SOLVE_CASE_CONCURRENCY = 1
+# Default maximum number of kept-alive connections per AI endpoint host, can
+# be set per AI with the `pool_size` key of its configuration (it is never
+# less than its concurrency)
+DEFAULT_HTTP_POOL_SIZE = 4
+# With the cached health check policy, a successful health check stands for
+# this long (in seconds), while a background monitor re-checks the AI
+HEALTH_CHECK_TTL = 30
+HEALTH_MONITOR_INTERVAL = 10
+# Number of cases sent per request to AIs supporting the batch solve-cases
+# endpoint (pipelined mode), can be set per AI with the `batch_size` key of
+# its configuration
+DEFAULT_SOLVE_CASES_BATCH_SIZE = 10
+# A batch gets SOLVE_CASE_HARD_TIMEOUT per case, up to this many seconds in all
+SOLVE_CASES_MAX_HARD_TIMEOUT = 30
+# Capability advertised in health check responses by AIs supporting it
+SOLVE_CASES_CAPABILITY = "solve-cases"
+# Circuit breaker defaults, can be set per AI with the `circuit_breaker` key
+# of its configuration (see `CircuitBreaker`)
+CIRCUIT_BREAKER_WINDOW_SIZE = 10
+CIRCUIT_BREAKER_MIN_CASES = 5
+CIRCUIT_BREAKER_MAX_ERROR_RATE = 0.5
+CIRCUIT_BREAKER_MAX_TIMEOUT_RATE = 0.5
+CIRCUIT_BREAKER_COOLDOWN = 30
+# Number of requests an AI with a `rate_limit` (requests per second) can be
+# sent at once after being idle, can be set per AI with the `burst` key of
+# its configuration
+DEFAULT_RATE_LIMIT_BURST = 1
+# How long (in seconds) a request waits for the admission state of an AI to be
+# unlocked before failing (its holder was killed), and at most between two
+# checks of whether it can be admitted
+ADMISSION_LOCK_TIMEOUT = 10
+ADMISSION_WAKEUP_INTERVAL = 1
+# Result cache defaults (number of results kept per AI, and for how long in
+# seconds), can be set per AI with the `result_cache` key of its
+# configuration (see `ResultCache`)
+RESULT_CACHE_MAX_ENTRIES = 100000
+RESULT_CACHE_TTL = 7 * 24 * 60 * 60
+# Number of results stored in the result cache of an AI between two evictions
+# of its least recently used ones
+RESULT_CACHE_EVICTION_INTERVAL = 100
+# Number of log lines of a benchmark kept in memory, the older ones are read
+# back from its log file (see `LogBuffer`)
+LOG_BUFFER_SIZE = 1000
 
 
 class ManagerStatuses(IntEnum):
@@ -16,3 +62,34 @@ class CaseStatuses(IntEnum):
     RUNNING = 0
     OK = 1
     ERROR = -1
+    # Failed without being sent, the AI's circuit breaker being open
+    CIRCUIT_OPEN = -2
+
+
+class CircuitStates(IntEnum):
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+
+class ExecutionModes(Enum):
+    # All AIs get the same case at the same time, the next case is only sent
+    # once every AI has finished the current one
+    LOCKSTEP = "lockstep"
+    # Every AI works through the case set on its own
+    PIPELINED = "pipelined"
+
+
+class RunnerEngines(Enum):
+    # One process per benchmarked AI
+    PROCESS = "process"
+    # One event loop, in a thread of the benchmark worker, for all AIs
+    ASYNCIO = "asyncio"
+
+
+class HealthCheckPolicies(Enum):
+    # Every case is preceded by a health check (with retries)
+    PER_CASE = "per_case"
+    # The last health status is reused for HEALTH_CHECK_TTL seconds, kept
+    # fresh by a background monitor and invalidated by solve-case errors
+    CACHED = "cached"
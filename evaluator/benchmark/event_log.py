@@ -0,0 +1,79 @@
+import json
+import os
+
+EVENTS_FILE_NAME = "events.jsonl"
+
+
+def get_events_path(results_dir):
+    return os.path.join(results_dir, EVENTS_FILE_NAME)
+
+
+def read_events(events_file, offset):
+    """Yields the (id, event, data) of the complete events written after a
+    given offset of an events file
+
+    The id of an event is the offset of the end of its line, so that a reader
+    (e.g. a client reconnecting with its last event id) picks up right after
+    it.
+    """
+    events_file.seek(offset)
+    for line in events_file:
+        if not line.endswith(b"\n"):
+            # The event is still being written
+            return
+
+        offset += len(line)
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+
+        yield offset, record["event"], record["data"]
+
+
+class BenchmarkEventLog(object):
+    """Append-only log of the progress events of a benchmark (cases started,
+    health checks, results of the AIs and log lines)
+
+    The log is written by the manager and read, while the benchmark runs, by
+    the processes serving the event streams of the benchmark. Events are not
+    fsynced: unlike the results, they are not needed to resume a benchmark,
+    whose events are appended to the same log.
+    """
+
+    def __init__(self, results_dir, resume=True):
+        self.path = get_events_path(results_dir)
+        self.file = None
+
+        os.makedirs(results_dir, exist_ok=True)
+        if resume:
+            self._truncate_partial_event()
+        elif os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def _truncate_partial_event(self):
+        if not os.path.isfile(self.path):
+            return
+
+        offset = 0
+        with open(self.path, "rb") as events_file:
+            for line in events_file:
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+
+        # The run stopped while an event was being written
+        if offset < os.path.getsize(self.path):
+            os.truncate(self.path, offset)
+
+    def append(self, event, data):
+        if self.file is None:
+            self.file = open(self.path, "ab")
+
+        self.file.write((json.dumps({"event": event, "data": data}) + "\n").encode())
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -4,3 +4,7 @@ class SetupError(Exception):
 
 class UnhealthyAIError(Exception):
     pass
+
+
+class AdmissionError(Exception):
+    pass
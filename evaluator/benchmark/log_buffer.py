@@ -0,0 +1,118 @@
+import itertools
+import json
+import os
+from collections import deque
+from threading import Lock
+
+from evaluator.benchmark.definitions import LOG_BUFFER_SIZE
+
+LOGS_FILE_NAME = "logs.jsonl"
+
+
+class LogBuffer(object):
+    """Bounded buffer of the log lines of a benchmark
+
+    Lines are addressed by their offset, the number of lines logged before
+    them, so that clients can tail the log from the last offset they got.
+    Only the last `size` lines are kept in memory. Every line is also written
+    to a log file next to the results of the benchmark, which older lines are
+    read back from: a checkpoint (the position of the line in the file) is
+    kept every `size` lines, so memory stays flat however long the benchmark.
+
+    Lines are appended by the thread running the benchmark and read by the
+    one answering progress updates.
+    """
+
+    def __init__(self, results_dir, size=LOG_BUFFER_SIZE, resume=True):
+        self.path = os.path.join(results_dir, LOGS_FILE_NAME)
+        self.size = size
+        self.lines = deque(maxlen=size)
+        # Offset of the next line
+        self.end = 0
+        # Position in the file of the lines at offsets 0, size, 2 * size...
+        self.checkpoints = []
+        self.file_size = 0
+        self.file = None
+        self.lock = Lock()
+
+        os.makedirs(results_dir, exist_ok=True)
+        if resume:
+            self._load()
+        elif os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def _load(self):
+        """Numbers the lines logged by a resumed benchmark after those of its
+        previous runs, which are only kept in the file"""
+        if not os.path.isfile(self.path):
+            return
+
+        with open(self.path, "rb") as log_file:
+            for line in log_file:
+                if not line.endswith(b"\n"):
+                    break
+                self._add_to_file_index(len(line))
+
+        # The run stopped while a line was being written
+        if self.file_size < os.path.getsize(self.path):
+            os.truncate(self.path, self.file_size)
+
+    def _add_to_file_index(self, length):
+        if self.end % self.size == 0:
+            self.checkpoints.append(self.file_size)
+        self.end += 1
+        self.file_size += length
+
+    @property
+    def start(self):
+        """Offset of the oldest line kept in memory"""
+        return self.end - len(self.lines)
+
+    def __len__(self):
+        return self.end
+
+    def append(self, message):
+        line = (json.dumps(message) + "\n").encode()
+
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, "ab")
+
+            self.file.write(line)
+            self.file.flush()
+            self._add_to_file_index(len(line))
+            self.lines.append(message)
+
+    def read(self, offset, limit=None):
+        """Returns (at most `limit` of) the lines from an offset on"""
+        offset = max(offset, 0)
+        with self.lock:
+            start = self.start
+            end = self.end
+            if limit is not None:
+                end = min(end, offset + limit)
+
+            lines = []
+            if offset < start:
+                lines = self._read_file(offset, min(start, end))
+                offset = start
+
+            if offset < end:
+                lines.extend(itertools.islice(self.lines, offset - start, end - start))
+
+        return lines
+
+    def _read_file(self, offset, end):
+        checkpoint = offset // self.size
+        with open(self.path, "rb") as log_file:
+            log_file.seek(self.checkpoints[checkpoint])
+            lines = itertools.islice(
+                log_file, offset - checkpoint * self.size, end - checkpoint * self.size
+            )
+            return [json.loads(line) for line in lines]
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -4,20 +4,31 @@ import random
 import time
 from multiprocessing import Pipe, Queue
 
-from evaluator.benchmark.definitions import ManagerStatuses
-from evaluator.benchmark.reporter import create_database_client
+from evaluator.benchmark.async_engine import (
+    AsyncBenchmarkRunner,
+    AsyncEngine,
+    AsyncRunnerPipe,
+)
+from evaluator.benchmark.definitions import (
+    CaseStatuses,
+    ExecutionModes,
+    HealthCheckPolicies,
+    ManagerStatuses,
+    RunnerEngines,
+)
+from evaluator.benchmark.event_log import BenchmarkEventLog
+from evaluator.benchmark.log_buffer import LogBuffer
+from evaluator.benchmark.reporter import DatabaseClient
+from evaluator.benchmark.result_log import BenchmarkResultLog, get_results_dir
 from evaluator.benchmark.runner import BenchmarkRunner
 from evaluator.benchmark.signals import ProcessSignal
 from evaluator.benchmark.utils import create_dirs
+from evaluator.case_sets import get_data_path
 from evaluator.constants import MAX_BENCHMARK_RUN_TIME
 from logs.logger import get_logger
 
 logger = get_logger()
 
-DATA_DIR = os.path.join(
-    os.path.dirname(os.path.dirname((os.path.abspath(__file__)))), "data"
-)
-
 
 class BenchmarkManager(object):
     """Helper class for managing benchmark executions"""
@@ -29,23 +40,57 @@ class BenchmarkManager(object):
             self.benchmark_id
         except AttributeError:
             self.__state = ManagerStatuses.IDLE
-            self.db_client = create_database_client()()
+            self.db_client = DatabaseClient()
 
     def if_timeout(self):
         return time.time() - self.benchmark_start_time > MAX_BENCHMARK_RUN_TIME
 
-    def setup(self, unique_id, case_set_id, case_set, benchmarked_ais):
+    def setup(
+        self,
+        unique_id,
+        case_set_id,
+        case_set,
+        benchmarked_ais,
+        execution_mode=ExecutionModes.LOCKSTEP,
+        runner_engine=RunnerEngines.PROCESS,
+        health_check_policy=HealthCheckPolicies.PER_CASE,
+        circuit_breaker=False,
+        admission=None,
+        resume=False,
+        result_cache=False,
+    ):
         if self.__state == ManagerStatuses.IDLE:
             self.benchmark_id = unique_id
             self.case_set_id = case_set_id
             self.case_set = case_set
-            self.accumulated_logs = []
+            self.execution_mode = execution_mode
+            self.runner_engine = runner_engine
+            self.health_check_policy = health_check_policy
+            self.circuit_breaker = circuit_breaker
+            self.admission = admission
+            self.result_cache = result_cache
+            self.results_dir = get_results_dir(case_set_id, unique_id)
+            # Results are appended to the log as they arrive, the pairs in the
+            # log of a resumed benchmark are not run again
+            self.result_log = BenchmarkResultLog(self.results_dir, resume=resume)
+            # Progress events, streamed to the clients following the benchmark
+            self.event_log = BenchmarkEventLog(self.results_dir, resume=resume)
+            # Only the last log lines are kept in memory, see `LogBuffer`
+            self.log_buffer = LogBuffer(self.results_dir, resume=resume)
+            # Latest HTTP connection reuse statistics of each AI
+            self.connection_stats = {}
             self.result_queue = Queue()
 
             self.benchmarked_ais = benchmarked_ais
             self.setup_report()
             self.setup_runners()
 
+            if len(self.result_log) > 0:
+                logger.info(
+                    f"Resuming benchmark with id {self.benchmark_id} "
+                    f"({len(self.result_log)} (case, AI) pairs done)"
+                )
+
             logger.info(
                 f"Successfully set up benchmark manager with id {self.benchmark_id} "
                 f"for case set with id {self.case_set_id}"
@@ -62,20 +107,57 @@ class BenchmarkManager(object):
             self.benchmark_id, self.case_set_id, len(self.case_set)
         )
 
+        self.db_client.create_ai_reports(
+            self.manager_report,
+            (
+                (
+                    record["ai_name"],
+                    record["case_num"],
+                    record["case_id"],
+                    record["report"],
+                )
+                for record in self.result_log.iter_records()
+            ),
+        )
+
     def setup_runners(self):
         if self.__state == ManagerStatuses.IDLE:
             self.runners_pool = []
             ai_names = []
+            if self.runner_engine == RunnerEngines.ASYNCIO:
+                engine = AsyncEngine(self.benchmark_start_time)
+
             for index, (ai_name, ai_config) in enumerate(self.benchmarked_ais.items()):
-                parent_conn, runner_conn = Pipe()
-                runner = BenchmarkRunner(
-                    ai_name,
-                    ai_config,
-                    runner_conn,
-                    self.result_queue,
-                    index,
-                    self.benchmark_start_time,
-                )
+                if self.runner_engine == RunnerEngines.ASYNCIO:
+                    runner = AsyncBenchmarkRunner(
+                        engine,
+                        ai_name,
+                        ai_config,
+                        self.result_queue,
+                        index,
+                        self.benchmark_start_time,
+                        case_set=self.case_set,
+                        health_check_policy=self.health_check_policy,
+                        circuit_breaker=self.circuit_breaker,
+                        admission=self.admission,
+                        result_cache=self.result_cache,
+                    )
+                    parent_conn = AsyncRunnerPipe(runner)
+                else:
+                    parent_conn, runner_conn = Pipe()
+                    runner = BenchmarkRunner(
+                        ai_name,
+                        ai_config,
+                        runner_conn,
+                        self.result_queue,
+                        index,
+                        self.benchmark_start_time,
+                        case_set=self.case_set,
+                        health_check_policy=self.health_check_policy,
+                        circuit_breaker=self.circuit_breaker,
+                        admission=self.admission,
+                        result_cache=self.result_cache,
+                    )
                 ai_names.append(ai_name)
                 self.runners_pool.append((runner, parent_conn))
             logger.info(
@@ -94,14 +176,14 @@ class BenchmarkManager(object):
             "cases": {},
         }
         for ai_report in report.ai_reports:
-            case_id = ai_report.case_id
+            case_num = ai_report.case_num
             ai_name = ai_report.ai_name
 
-            if case_id not in report_dict["cases"]:
-                report_dict["cases"][case_id] = {}
+            if case_num not in report_dict["cases"]:
+                report_dict["cases"][case_num] = {}
 
-            if ai_name not in report_dict["cases"][case_id][ai_name]:
-                report_dict["cases"][case_id][ai_name] = {
+            if ai_name not in report_dict["cases"][case_num]:
+                report_dict["cases"][case_num][ai_name] = {
                     "status": ai_report.status,
                     "health_checks": ai_report.health_checks,
                     "errors": ai_report.errors,
@@ -114,13 +196,19 @@ class BenchmarkManager(object):
     def finish_execution(self):
         self.__state = ManagerStatuses.IDLE
         self.runners_pool = []
+        self.result_log.close()
+        self.event_log.close()
+        self.log_buffer.close()
 
     def run_benchmark(self):
         # starts runners
         [runner.start() for runner, _ in self.runners_pool]
 
         try:
-            result = self._run_benchmark()
+            if self.execution_mode == ExecutionModes.PIPELINED:
+                result = self._run_pipelined_benchmark()
+            else:
+                result = self._run_benchmark()
         finally:
             for (_, pipe) in self.runners_pool:
                 pipe.send((ProcessSignal.TERMINATE, None))
@@ -129,15 +217,101 @@ class BenchmarkManager(object):
 
         return result
 
+    def _record_connection_stats(self, result):
+        connection_stats = result.pop("connection_stats", None)
+        if connection_stats is not None:
+            self.connection_stats[result["ai_name"]] = connection_stats
+
+    def _append_logs(self, *messages):
+        for message in messages:
+            self.log_buffer.append(message)
+            self.event_log.append("log", {"message": message})
+
+    def _start_case(self, case_num, case_id):
+        self.manager_report = self.db_client.update_manager_report(
+            case_num + 1, case_id, self.manager_report
+        )
+        self.event_log.append(
+            "case-started", {"case_index": case_num + 1, "case_id": case_id}
+        )
+
+    def _record_health_check(self, case_num, case_id, result):
+        self._record_connection_stats(result)
+        self.event_log.append(
+            "health-check",
+            {
+                "case_index": case_num + 1,
+                "case_id": case_id,
+                "ai_name": result["ai_name"],
+                "healthy": result["healthy"],
+                "case_status": result["case_status"],
+            },
+        )
+        self.db_client.create_ai_report(
+            self.manager_report, result["ai_name"], case_num, case_id, result["report"]
+        )
+        if not result["healthy"]:
+            # in this case we need to add the failed ai to the results as
+            # not healthchecked successfully
+            output = {
+                "ai_name": result["ai_name"],
+                "result": result["result"],
+                "error": result["error"],
+                "case_status": result["case_status"],
+                "soft_timeout": result["soft_timeout"],
+                "hard_timeout": result["hard_timeout"],
+                "healthchecked": result["healthchecked"],
+            }
+            self._store_result(case_num, case_id, output)
+        if result["log"]:
+            self._append_logs(*result["log"])
+
+    def _record_solve_case(self, case_num, case_id, result):
+        self._record_connection_stats(result)
+        self._append_logs(*result.pop("log"))
+        self.db_client.update_ai_report(
+            self.manager_report,
+            result["ai_name"],
+            case_num,
+            case_status=result["case_status"],
+            error=result["error"],
+            soft_timeout=result["soft_timeout"],
+            hard_timeout=result["hard_timeout"],
+        )
+        self._store_result(case_num, case_id, result)
+
+    def _store_result(self, case_num, case_id, result):
+        """Appends the final result of an AI for a case to the result log"""
+        ai_name = result["ai_name"]
+        self.event_log.append(
+            "ai-result",
+            {
+                "case_index": case_num + 1,
+                "case_id": case_id,
+                "ai_name": ai_name,
+                "case_status": result["case_status"],
+                "error": result["error"],
+                "soft_timeout": result["soft_timeout"],
+                "hard_timeout": result["hard_timeout"],
+                "result": result["result"],
+            },
+        )
+        self.result_log.append(
+            case_num,
+            case_id,
+            ai_name,
+            result,
+            self.db_client.select_ai_report(self.manager_report, ai_name, case_num),
+        )
+
     def _run_benchmark(self):  # noqa: C901
         # TODO: refactor
         self.__state = ManagerStatuses.RUNNING
-        results = {}
-        burnt_cases_path = os.path.join(DATA_DIR, "burnt_cases")
+        burnt_cases_path = get_data_path("burnt_cases")
         create_dirs(burnt_cases_path)
 
         message = f"Starting run of benchmark with id {self.benchmark_id}"
-        self.accumulated_logs.append(message)
+        self._append_logs(message)
         logger.info(message)
 
         for case_num, case in enumerate(self.case_set):
@@ -146,25 +320,35 @@ class BenchmarkManager(object):
 
             case_index = case_num + 1
             case_id = case["caseData"]["caseId"]
-            results[case_id] = {}
-
-            self.manager_report = self.db_client.update_manager_report(
-                case_index, case_id, self.manager_report
-            )
 
-            runners_pipes = [pipe for (_, pipe) in self.runners_pool]
+            # the AIs done with the case in a previous run are not sent it again
+            runners_pipes = [
+                pipe
+                for (runner, pipe) in self.runners_pool
+                if not self.result_log.is_done(case_num, runner.ai_name)
+            ]
+            if not runners_pipes:
+                continue
             random.shuffle(runners_pipes)
 
+            self._start_case(case_num, case_id)
+
             message = f"Starting health checks for case #{case_index}..."
-            self.accumulated_logs.append(message)
+            self._append_logs(message)
             logger.info(message)
 
             for pipe in runners_pipes:
-                pipe.send((ProcessSignal.HEALTH_CHECK, {"case_id": case_id}))
+                pipe.send(
+                    (
+                        ProcessSignal.HEALTH_CHECK,
+                        {"case_num": case_num, "case_id": case_id},
+                    )
+                )
 
             sentinels = 0
             healthchecked_ai_ids = []
-            while sentinels < len(self.runners_pool):
+            circuit_open_ai_ids = []
+            while sentinels < len(runners_pipes):
                 if self.if_timeout():
                     return
 
@@ -178,30 +362,11 @@ class BenchmarkManager(object):
                 if signal == ProcessSignal.SENTINEL:
                     sentinels += 1
                 elif signal == ProcessSignal.HEALTH_CHECK:
-                    self.db_client.create_ai_report(
-                        self.manager_report,
-                        result["ai_name"],
-                        case_id,
-                        result["report"],
-                    )
+                    self._record_health_check(case_num, case_id, result)
                     if result["healthy"]:
                         healthchecked_ai_ids.append(runner_id)
-                    else:
-                        # in this case we need to add the failed ai to the results as
-                        # not healthchecked successfully
-                        output = {
-                            "ai_name": result["ai_name"],
-                            "result": result["result"],
-                            "error": result["error"],
-                            "case_status": result["case_status"],
-                            "soft_timeout": result["soft_timeout"],
-                            "hard_timeout": result["hard_timeout"],
-                            "healthchecked": result["healthchecked"],
-                        }
-                        results[case_id][result["ai_name"]] = output
-                    if result["log"]:
-                        for log in result["log"]:
-                            self.accumulated_logs.append(log)
+                    elif result["case_status"] == CaseStatuses.CIRCUIT_OPEN:
+                        circuit_open_ai_ids.append(runner_id)
 
             if healthchecked_ai_ids:
                 message = (
@@ -214,7 +379,7 @@ class BenchmarkManager(object):
                         ]
                     )
                 )
-                self.accumulated_logs.append(message)
+                self._append_logs(message)
                 logger.info(message)
 
                 # 'marks' case as 'burnt'
@@ -223,21 +388,34 @@ class BenchmarkManager(object):
                 )
                 open(case_burnt_path, "w").close()
 
+            elif circuit_open_ai_ids:
+                # the AIs whose circuit breaker is open did not fail a health
+                # check, the benchmark goes on without them
+                message = f"No AI was sent case #{case_index}"
+                self._append_logs(message)
+                logger.info(message)
+                continue
+
             else:
                 # if all healthchecks have failed, what to do?
                 # TODO: implement rule for when all healthchecks have failed
                 message = (
                     f"All AIs have failed the health check for " f"case #{case_index}"
                 )
-                self.accumulated_logs.append(message)
+                self._append_logs(message)
                 logger.error(message)
-                return {"runId": self.benchmark_id, "results": results}
+                return {
+                    "benchmark_id": self.benchmark_id,
+                    "results_dir": self.results_dir,
+                }
 
             random.shuffle(healthchecked_ai_ids)
 
             for id_ in healthchecked_ai_ids:
                 pipe = self.runners_pool[id_][1]
-                pipe.send((ProcessSignal.SOLVE_CASE, {"case": case}))
+                pipe.send(
+                    (ProcessSignal.SOLVE_CASE, {"case_num": case_num, "case": case})
+                )
 
             sentinels = 0
             while sentinels < len(healthchecked_ai_ids):
@@ -254,25 +432,88 @@ class BenchmarkManager(object):
                 if signal == ProcessSignal.SENTINEL:
                     sentinels += 1
                 elif signal == ProcessSignal.SOLVE_CASE:
-                    logs = result.pop("log")
-                    for log in logs:
-                        self.accumulated_logs.append(logs)
-                    self.db_client.update_ai_report(
-                        self.manager_report,
-                        result["ai_name"],
-                        case_id,
-                        case_status=result["case_status"],
-                        error=result["error"],
-                        soft_timeout=result["soft_timeout"],
-                        hard_timeout=result["hard_timeout"],
+                    self._record_solve_case(case_num, case_id, result)
+
+        message = (
+            f"Finished running benchmark with id {self.benchmark_id} "
+            f"and case set id {self.case_set_id}"
+        )
+        self._append_logs(message)
+        logger.info(message)
+
+        return {"benchmark_id": self.benchmark_id, "results_dir": self.results_dir}
+
+    def _run_pipelined_benchmark(self):
+        """Lets every runner work through the case set on its own, so that a
+        slow AI does not hold back the others, and collects their results"""
+        self.__state = ManagerStatuses.RUNNING
+        burnt_cases_path = get_data_path("burnt_cases")
+        create_dirs(burnt_cases_path)
+
+        message = f"Starting pipelined run of benchmark with id {self.benchmark_id}"
+        self._append_logs(message)
+        logger.info(message)
+
+        for (runner, pipe) in self.runners_pool:
+            done_case_nums = self.result_log.get_done_case_nums(runner.ai_name)
+            pipe.send((ProcessSignal.RUN_CASE_SET, {"skip_case_nums": done_case_nums}))
+
+        # Results carry the number of their case, they are stored in case set
+        # order whatever order they arrive in
+        burnt_case_nums = set()
+        finished_runner_ids = set()
+        while len(finished_runner_ids) < len(self.runners_pool):
+            if self.if_timeout():
+                return
+
+            try:
+                signal, runner_id, result = self.result_queue.get(
+                    block=True, timeout=1.0
+                )
+            except queue.Empty:
+                # A runner that died will never report being done
+                finished_runner_ids.update(
+                    runner_id
+                    for runner_id, (runner, _) in enumerate(self.runners_pool)
+                    if not runner.is_alive()
+                )
+                continue
+
+            if signal == ProcessSignal.CASE_SET_DONE:
+                finished_runner_ids.add(runner_id)
+                message = (
+                    f"AI {self.runners_pool[runner_id][0].ai_name} has finished "
+                    f"the case set"
+                )
+                self._append_logs(message)
+                logger.info(message)
+
+            elif signal == ProcessSignal.HEALTH_CHECK:
+                case_num = result["case_num"]
+                case_id = result["case_id"]
+
+                # Progress is that of the AI furthest into the case set
+                if case_num + 1 > self.manager_report.current_case_index:
+                    self._start_case(case_num, case_id)
+
+                self._record_health_check(case_num, case_id, result)
+
+                if result["healthy"] and case_num not in burnt_case_nums:
+                    # 'marks' case as 'burnt'
+                    burnt_case_nums.add(case_num)
+                    case_burnt_path = os.path.join(
+                        burnt_cases_path, case_id + "_" + str(case_num)
                     )
-                    results[case_id][result["ai_name"]] = result
+                    open(case_burnt_path, "w").close()
+
+            elif signal == ProcessSignal.SOLVE_CASE:
+                self._record_solve_case(result["case_num"], result["case_id"], result)
 
         message = (
             f"Finished running benchmark with id {self.benchmark_id} "
             f"and case set id {self.case_set_id}"
         )
-        self.accumulated_logs.append(message)
+        self._append_logs(message)
         logger.info(message)
 
-        return {"benchmark_id": self.benchmark_id, "results": results}
+        return {"benchmark_id": self.benchmark_id, "results_dir": self.results_dir}
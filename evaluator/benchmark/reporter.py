@@ -1,5 +1,5 @@
-import time
-from os.path import abspath, dirname, join
+import itertools
+import os
 
 from peewee import (
     CharField,
@@ -9,239 +9,391 @@ from peewee import (
     IntegrityError,
     Model,
     SqliteDatabase,
+    fn,
 )
 
 from evaluator.benchmark.definitions import CaseStatuses
+from evaluator.benchmark.exceptions import SetupError
+from evaluator.case_sets import get_data_path
 
+CASE_STATUS_CHOICES = [(int(status), int(status)) for status in CaseStatuses]
 
-def get_unique_id():
-    return str(time.time()).replace(".", "_")
-
-
-def create_database_client():  # noqa: C901
-    # TODO: refactor it.
-    DATABASE_PATH = join(dirname(dirname(abspath(__file__))), "data")
-    DATABASE = SqliteDatabase(join(DATABASE_PATH, "reports_" + get_unique_id() + ".db"))
-
-    class ManagerReport(Model):
-        benchmark_id = CharField(primary_key=True)
-        case_set_id = CharField()
-        total_cases = IntegerField()
-        current_case_index = IntegerField()
-        current_case_id = CharField(null=True)
-
-        class Meta:
-            database = DATABASE
-            only_save_dirty = True
-
-    class AIReport(Model):
-        manager_report = ForeignKeyField(ManagerReport, backref="ai_reports")
-        ai_name = CharField()
-        case_id = CharField()
-        healthcheck_status = IntegerField(choices=[(-1, -1), (0, 0), (1, 1)])
-        case_status = IntegerField(choices=[(-1, -1), (0, 0), (1, 1)])
-        health_checks = IntegerField()
-        errors = IntegerField()
-        soft_timeouts = IntegerField()
-        hard_timeouts = IntegerField()
-
-        class Meta:
-            database = DATABASE
-            only_save_dirty = True
-            primary_key = CompositeKey("manager_report", "ai_name", "case_id")
-
-    class DatabaseClient:
-        def __init__(self):
-            self.database = DATABASE
-            self.connection = self.database.connect(reuse_if_open=True)
-            self.database.create_tables([ManagerReport, AIReport])
-
-        def shutdown(self):
-            self.database.stop()
-            self.connection.close()
-
-        def create_manager_report(self, benchmark_id, case_set_id, total_cases):
-            with self.database:
-                try:
-                    report = ManagerReport.create(
-                        benchmark_id=benchmark_id,
-                        case_set_id=case_set_id,
-                        total_cases=total_cases,
-                        current_case_index=-1,
-                        current_case_id=None,
-                    )
-                except IntegrityError:
-                    report = self.select_manager_report(benchmark_id)
-
-            return report
-
-        def select_manager_report(self, benchmark_id, prefetch=False):
-            with self.database:
-                query = ManagerReport.select().where(
-                    ManagerReport.benchmark_id == benchmark_id
-                )
-                if prefetch:
-                    try:
-                        report = query.prefetch(AIReport)[0]
-                    except IndexError:
-                        report = None
-                else:
-                    try:
-                        report = query.get()
-                    except ManagerReport.DoesNotExist:
-                        report = None
-
-            return report
-
-        def delete_manager_report(self, report_instance=None, benchmark_id=None):
-            with self.database:
-                if report_instance and isinstance(report_instance, ManagerReport):
-                    report_instance.delete_instance()
-                    return True
-                elif benchmark_id:
-                    deleted = (
-                        ManagerReport.select()
-                        .where(ManagerReport.benchmark_id == benchmark_id)
-                        .execute()
-                    )
-                    if deleted:
-                        return True
+REPORTS_FILE_NAME = "reports.db"
 
-            return False
+# Version of the schema of the report database, kept in its user_version:
+# 1. AI reports keyed by case id (the database was not versioned yet)
+# 2. AI reports keyed by case number
+REPORTS_SCHEMA_VERSION = 2
+# The AI reports of schema 1 are kept in this table, as they were
+LEGACY_AI_REPORTS_TABLE_NAME = "ai_reports_by_case_id"
 
-        def update_manager_report(
-            self,
-            current_case_index,
-            current_case_id,
-            report_instance=None,
-            benchmark_id=None,
-        ):
-            with self.database:
-                if report_instance and isinstance(report_instance, ManagerReport):
-                    report_instance.current_case_index = current_case_index
-                    report_instance.current_case_id = current_case_id
-                    report_instance.save()
-                elif benchmark_id:
-                    ManagerReport.update(
-                        {
-                            ManagerReport.current_case_index: current_case_index,
-                            ManagerReport.current_case_id: current_case_id,
-                        }
-                    ).where(ManagerReport.benchmark_id == benchmark_id).execute()
-                    report_instance = self.select_manager_report(
-                        benchmark_id=benchmark_id
-                    )
-                else:
-                    report_instance = None
-
-            return report_instance
-
-        def create_ai_report(self, manager_report, ai_name, case_id, data):
-            if data["errors"]:
-                case_status = int(CaseStatuses.ERROR)
-            else:
-                case_status = int(CaseStatuses.RUNNING)
-
-            with self.database:
-                try:
-                    AIReport.create(
-                        manager_report=manager_report,
-                        ai_name=ai_name,
-                        case_id=case_id,
-                        healthcheck_status=data["healthcheck_status"],
-                        case_status=case_status,
-                        health_checks=data["health_checks"],
-                        errors=data["errors"],
-                        soft_timeouts=data["soft_timeouts"],
-                        hard_timeouts=data["hard_timeouts"],
-                    )
-                except IntegrityError:
-                    self.update_ai_report(
-                        manager_report,
-                        ai_name,
-                        case_id,
-                        error=data["errors"],
-                        healthcheck_status=data["healthcheck_status"],
-                        case_status=case_status,
-                        health_checks=data["health_checks"],
-                        soft_timeout=data["soft_timeouts"],
-                        hard_timeout=data["hard_timeouts"],
-                    )
-
-        def select_ai_report(self, manager_report, ai_name, case_id):
-            with self.database:
-                query = AIReport.select().where(
-                    AIReport.manager_report == manager_report,
-                    AIReport.ai_name == ai_name,
-                    AIReport.case_id == case_id,
-                )
-                try:
-                    report = query.get()
-                except AIReport.DoesNotExist:
-                    report = None
-
-            return report
-
-        def delete_ai_report(
-            self, report_instance=None, manager_report=None, ai_name=None, case_id=None
-        ):
-            with self.database:
-                if report_instance and isinstance(report_instance, AIReport):
-                    report_instance.delete_instance()
-                    return True
-                elif manager_report and ai_name and case_id:
-                    deleted = (
-                        AIReport.select()
-                        .where(
-                            AIReport.manager_report == manager_report,
-                            AIReport.ai_name == ai_name,
-                            AIReport.case_id == case_id,
-                        )
-                        .execute()
-                    )
-                    if deleted:
-                        return True
+# Reports are written by every benchmark worker and read while they are
+# written. They can be rebuilt from the result logs, so commits are not synced.
+# Opened in the data directory by `open_reports`.
+DATABASE = SqliteDatabase(
+    None, pragmas={"journal_mode": "wal", "synchronous": "normal"}
+)
 
+# Number of rows inserted per statement
+REPORT_INSERT_BATCH_SIZE = 100
+
+# Transactions writing the database take the write lock from the start, so
+# that they wait for the other writers (up to the timeout of the database)
+# instead of failing when they write after reading
+WRITE_LOCK = "IMMEDIATE"
+
+
+class ManagerReport(Model):
+    benchmark_id = CharField(primary_key=True)
+    case_set_id = CharField()
+    total_cases = IntegerField()
+    current_case_index = IntegerField()
+    current_case_id = CharField(null=True)
+
+    class Meta:
+        database = DATABASE
+        table_name = "manager_reports"
+        only_save_dirty = True
+
+
+class AIReport(Model):
+    manager_report = ForeignKeyField(ManagerReport, backref="ai_reports")
+    ai_name = CharField()
+    # Reports are keyed by the index of their case in the case set, the id
+    # of the case is only data: it is not unique in every case set
+    case_num = IntegerField()
+    case_id = CharField()
+    healthcheck_status = IntegerField(choices=CASE_STATUS_CHOICES)
+    case_status = IntegerField(choices=CASE_STATUS_CHOICES)
+    health_checks = IntegerField()
+    errors = IntegerField()
+    soft_timeouts = IntegerField()
+    hard_timeouts = IntegerField()
+    # Set from a counter on every change, so that clients can ask for the
+    # rows changed since the last ones they got
+    sequence = IntegerField()
+
+    class Meta:
+        database = DATABASE
+        table_name = "ai_reports"
+        only_save_dirty = True
+        primary_key = CompositeKey("manager_report", "ai_name", "case_num")
+        indexes = ((("manager_report", "sequence"), False),)
+
+
+def open_reports():
+    DATABASE.init(get_data_path(REPORTS_FILE_NAME))
+
+
+def get_reports_schema_version():
+    """Returns the version of the schema of the open report database, 0 if
+    it has no tables yet"""
+    version = DATABASE.pragma("user_version")
+    table_name = AIReport._meta.table_name
+    if version == 0 and DATABASE.table_exists(table_name):
+        columns = [column.name for column in DATABASE.get_columns(table_name)]
+        version = 2 if "case_num" in columns else 1
+
+    return version
+
+
+def keep_legacy_ai_reports():
+    """Moves the AI reports of schema 1 to a table of their own: they cannot
+    be keyed by case number without their case sets. Their indexes are
+    dropped, the tables of schema 2 have indexes of the same names."""
+    table_name = AIReport._meta.table_name
+    for index in DATABASE.get_indexes(table_name):
+        # The index of the primary key follows the table
+        if index.sql is not None:
+            DATABASE.execute_sql(f'DROP INDEX "{index.name}"')
+
+    DATABASE.execute_sql(
+        f'ALTER TABLE "{table_name}" RENAME TO "{LEGACY_AI_REPORTS_TABLE_NAME}"'
+    )
+
+
+def initialize_reports():
+    """Creates the tables of the report database if they do not exist, and
+    migrates the database of an older evaluator
+
+    Reports are kept across restarts: those of the benchmarks still running
+    when the evaluator stopped are replaced when they are run again. The
+    databases of the evaluators that had a database per benchmark
+    (`reports_*.db`) are left as they are.
+    """
+    os.makedirs(get_data_path(), exist_ok=True)
+    open_reports()
+
+    with DATABASE.connection_context():
+        with DATABASE.atomic(lock_type=WRITE_LOCK):
+            version = get_reports_schema_version()
+            if version > REPORTS_SCHEMA_VERSION:
+                raise SetupError(
+                    f"The report database has schema version {version}, this "
+                    f"evaluator only knows up to {REPORTS_SCHEMA_VERSION}"
+                )
+            elif version == 1:
+                keep_legacy_ai_reports()
+
+            DATABASE.create_tables([ManagerReport, AIReport], safe=True)
+            DATABASE.pragma("user_version", REPORTS_SCHEMA_VERSION)
+
+
+def get_case_status(data):
+    if "case_status" in data:
+        return int(data["case_status"])
+    elif data["errors"]:
+        return int(CaseStatuses.ERROR)
+    else:
+        return int(CaseStatuses.RUNNING)
+
+
+class DatabaseClient(object):
+    """Reads and writes the reports of a benchmark
+
+    All benchmarks share the report database. Each thread keeps its own
+    connection open, so the statements it runs are prepared once.
+    """
+
+    def __init__(self):
+        self.database = DATABASE
+        self.sequence = itertools.count(1)
+
+    def create_manager_report(self, benchmark_id, case_set_id, total_cases):
+        """Creates the report of a benchmark, replacing the one of its
+        previous run if any"""
+        with self.database.atomic(lock_type=WRITE_LOCK):
+            # Clients following the benchmark get the rows of this run
+            last_sequence = (
+                AIReport.select(fn.MAX(AIReport.sequence))
+                .where(AIReport.manager_report == benchmark_id)
+                .scalar()
+            )
+            self.sequence = itertools.count((last_sequence or 0) + 1)
+
+            self.delete_manager_report(benchmark_id=benchmark_id)
+            report = ManagerReport.create(
+                benchmark_id=benchmark_id,
+                case_set_id=case_set_id,
+                total_cases=total_cases,
+                current_case_index=-1,
+                current_case_id=None,
+            )
+
+        return report
+
+    def select_manager_report(self, benchmark_id, prefetch=False):
+        query = ManagerReport.select().where(ManagerReport.benchmark_id == benchmark_id)
+        if prefetch:
+            try:
+                report = query.prefetch(AIReport)[0]
+            except IndexError:
+                report = None
+        else:
+            try:
+                report = query.get()
+            except ManagerReport.DoesNotExist:
+                report = None
+
+        return report
+
+    def delete_manager_report(self, report_instance=None, benchmark_id=None):
+        if report_instance and isinstance(report_instance, ManagerReport):
+            benchmark_id = report_instance.benchmark_id
+
+        if not benchmark_id:
             return False
 
-        def update_ai_report(
-            self,
-            manager_report,
-            ai_name,
-            case_id,
-            case_status,
-            healthcheck_status=None,
-            error=None,
-            health_checks=False,
-            soft_timeout=False,
-            hard_timeout=False,
-        ):
-            with self.database:
-                update_dict = {}
-
-                update_dict[AIReport.case_status] = case_status
-
-                if healthcheck_status is not None:
-                    update_dict[AIReport.healthcheck_status] = healthcheck_status
-
-                if error:
-                    update_dict[AIReport.errors] = AIReport.errors + 1
-
-                if health_checks:
-                    update_dict[AIReport.health_checks] = AIReport.health_checks + 1
-
-                if soft_timeout:
-                    update_dict[AIReport.soft_timeouts] = AIReport.soft_timeouts + 1
-
-                if hard_timeout:
-                    update_dict[AIReport.hard_timeouts] = AIReport.hard_timeouts + 1
-
-                query = AIReport.update(update_dict).where(
+        with self.database.atomic(lock_type=WRITE_LOCK):
+            AIReport.delete().where(AIReport.manager_report == benchmark_id).execute()
+            deleted = (
+                ManagerReport.delete()
+                .where(ManagerReport.benchmark_id == benchmark_id)
+                .execute()
+            )
+
+        return deleted > 0
+
+    def update_manager_report(
+        self,
+        current_case_index,
+        current_case_id,
+        report_instance=None,
+        benchmark_id=None,
+    ):
+        if report_instance and isinstance(report_instance, ManagerReport):
+            report_instance.current_case_index = current_case_index
+            report_instance.current_case_id = current_case_id
+            report_instance.save()
+        elif benchmark_id:
+            ManagerReport.update(
+                {
+                    ManagerReport.current_case_index: current_case_index,
+                    ManagerReport.current_case_id: current_case_id,
+                }
+            ).where(ManagerReport.benchmark_id == benchmark_id).execute()
+            report_instance = self.select_manager_report(benchmark_id=benchmark_id)
+        else:
+            report_instance = None
+
+        return report_instance
+
+    def create_ai_report(self, manager_report, ai_name, case_num, case_id, data):
+        case_status = get_case_status(data)
+
+        try:
+            AIReport.insert(
+                manager_report=manager_report,
+                ai_name=ai_name,
+                case_num=case_num,
+                case_id=case_id,
+                healthcheck_status=data["healthcheck_status"],
+                case_status=case_status,
+                health_checks=data["health_checks"],
+                errors=data["errors"],
+                soft_timeouts=data["soft_timeouts"],
+                hard_timeouts=data["hard_timeouts"],
+                sequence=next(self.sequence),
+            ).execute()
+        except IntegrityError:
+            self.update_ai_report(
+                manager_report,
+                ai_name,
+                case_num,
+                error=data["errors"],
+                healthcheck_status=data["healthcheck_status"],
+                case_status=case_status,
+                health_checks=data["health_checks"],
+                soft_timeout=data["soft_timeouts"],
+                hard_timeout=data["hard_timeouts"],
+            )
+
+    def create_ai_reports(self, manager_report, reports):
+        """Creates the reports of a new manager report from the (AI name,
+        case number, case id, data) of each, in batches"""
+        rows = [
+            {
+                "manager_report": manager_report,
+                "ai_name": ai_name,
+                "case_num": case_num,
+                "case_id": case_id,
+                "healthcheck_status": data["healthcheck_status"],
+                "case_status": get_case_status(data),
+                "health_checks": data["health_checks"],
+                "errors": data["errors"],
+                "soft_timeouts": data["soft_timeouts"],
+                "hard_timeouts": data["hard_timeouts"],
+                "sequence": next(self.sequence),
+            }
+            for (ai_name, case_num, case_id, data) in reports
+        ]
+
+        with self.database.atomic(lock_type=WRITE_LOCK):
+            for start in range(0, len(rows), REPORT_INSERT_BATCH_SIZE):
+                end = start + REPORT_INSERT_BATCH_SIZE
+                AIReport.insert_many(rows[start:end]).on_conflict_replace().execute()
+
+    def select_ai_report(self, manager_report, ai_name, case_num):
+        query = AIReport.select().where(
+            AIReport.manager_report == manager_report,
+            AIReport.ai_name == ai_name,
+            AIReport.case_num == case_num,
+        )
+        try:
+            report = query.get()
+        except AIReport.DoesNotExist:
+            report = None
+
+        return report
+
+    def select_ai_reports_since(self, manager_report, sequence):
+        """Returns the AI reports changed after a given sequence number, in
+        the order they changed"""
+        return list(
+            AIReport.select()
+            .where(
+                AIReport.manager_report == manager_report, AIReport.sequence > sequence
+            )
+            .order_by(AIReport.sequence)
+        )
+
+    def summarize_ai_reports(self, manager_report):
+        """Returns the number of cases done, errors and hard timeouts of
+        every AI"""
+        query = (
+            AIReport.select(
+                AIReport.ai_name,
+                fn.SUM(AIReport.case_status != int(CaseStatuses.RUNNING)),
+                fn.SUM(AIReport.errors),
+                fn.SUM(AIReport.hard_timeouts),
+            )
+            .where(AIReport.manager_report == manager_report)
+            .group_by(AIReport.ai_name)
+            .tuples()
+        )
+
+        return {
+            ai_name: {"cases_done": cases_done, "errors": errors, "timeouts": timeouts}
+            for (ai_name, cases_done, errors, timeouts) in query
+        }
+
+    def delete_ai_report(
+        self, report_instance=None, manager_report=None, ai_name=None, case_num=None
+    ):
+        if report_instance and isinstance(report_instance, AIReport):
+            report_instance.delete_instance()
+            return True
+        elif manager_report and ai_name and case_num is not None:
+            deleted = (
+                AIReport.delete()
+                .where(
                     AIReport.manager_report == manager_report,
                     AIReport.ai_name == ai_name,
-                    AIReport.case_id == case_id,
+                    AIReport.case_num == case_num,
                 )
-
-                query.execute()
-
-    return DatabaseClient
+                .execute()
+            )
+            if deleted:
+                return True
+
+        return False
+
+    def update_ai_report(
+        self,
+        manager_report,
+        ai_name,
+        case_num,
+        case_status,
+        healthcheck_status=None,
+        error=None,
+        health_checks=False,
+        soft_timeout=False,
+        hard_timeout=False,
+    ):
+        update_dict = {}
+
+        update_dict[AIReport.case_status] = case_status
+        update_dict[AIReport.sequence] = next(self.sequence)
+
+        if healthcheck_status is not None:
+            update_dict[AIReport.healthcheck_status] = healthcheck_status
+
+        if error:
+            update_dict[AIReport.errors] = AIReport.errors + 1
+
+        if health_checks:
+            update_dict[AIReport.health_checks] = AIReport.health_checks + 1
+
+        if soft_timeout:
+            update_dict[AIReport.soft_timeouts] = AIReport.soft_timeouts + 1
+
+        if hard_timeout:
+            update_dict[AIReport.hard_timeouts] = AIReport.hard_timeouts + 1
+
+        query = AIReport.update(update_dict).where(
+            AIReport.manager_report == manager_report,
+            AIReport.ai_name == ai_name,
+            AIReport.case_num == case_num,
+        )
+
+        query.execute()
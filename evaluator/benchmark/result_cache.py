@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import time
+
+from peewee import CharField, FloatField, Model, SqliteDatabase, TextField
+
+from evaluator.benchmark.definitions import (
+    RESULT_CACHE_EVICTION_INTERVAL,
+    RESULT_CACHE_MAX_ENTRIES,
+    RESULT_CACHE_TTL,
+)
+from evaluator.case_sets import get_data_path
+
+RESULT_CACHE_FILE_NAME = "result_cache.db"
+
+# Opened in the data directory by `open_result_cache`
+DATABASE = SqliteDatabase(None, pragmas={"journal_mode": "wal"})
+
+# Connections are kept open by the thread that opened them (see
+# `ResultCache`). A forked process must not use those of its parent: it
+# opens its own.
+os.register_at_fork(after_in_child=DATABASE._state.reset)
+
+
+class CachedResult(Model):
+    ai_name = CharField()
+    ai_version = CharField()
+    case_hash = CharField()
+    result = TextField()
+    created = FloatField()
+    last_used = FloatField()
+
+    class Meta:
+        database = DATABASE
+        table_name = "cached_results"
+        indexes = (
+            (("ai_name", "ai_version", "case_hash"), True),
+            (("ai_name", "last_used"), False),
+        )
+
+
+def open_result_cache():
+    DATABASE.init(get_data_path(RESULT_CACHE_FILE_NAME))
+
+
+def initialize_result_cache():
+    os.makedirs(get_data_path(), exist_ok=True)
+    open_result_cache()
+
+    with DATABASE.connection_context():
+        DATABASE.create_tables([CachedResult])
+
+
+def compute_case_hash(case_data):
+    """Returns a hash of the content of a case that does not depend on its
+    id, key order or formatting: the same case in another case set (with
+    another id) gets the same result"""
+    content = {key: value for key, value in case_data.items() if key != "caseId"}
+    canonical = json.dumps(content, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResultCache(object):
+    """Cache of the results of a deterministic AI, shared by all benchmarks
+
+    Results are kept on disk per (AI name, AI version, case data hash), so a
+    new version of the AI does not get the results of the previous one.
+    Results older than `ttl` seconds are not used, and the least recently
+    used ones beyond `max_entries` are evicted every `eviction_interval`
+    results stored.
+
+    Every thread keeps its own connection open, so that the cache can be used
+    from the runner threads and processes without reconnecting for every
+    case. Operations block: the asyncio engine runs them in an executor.
+    """
+
+    def __init__(
+        self,
+        ai_name,
+        ai_version,
+        max_entries=RESULT_CACHE_MAX_ENTRIES,
+        ttl=RESULT_CACHE_TTL,
+        eviction_interval=RESULT_CACHE_EVICTION_INTERVAL,
+    ):
+        self.ai_name = ai_name
+        self.ai_version = str(ai_version)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.eviction_interval = eviction_interval
+        # Number of results stored since the last eviction
+        self.num_puts = 0
+
+    @classmethod
+    def from_ai_config(cls, ai_name, ai_config):
+        """Creates the result cache of an AI, with the settings of the
+        `result_cache` key of its configuration if any, or returns None if the
+        AI is not declared `deterministic` with a `version`"""
+        if not ai_config.get("deterministic") or "version" not in ai_config:
+            return None
+
+        return cls(ai_name, ai_config["version"], **ai_config.get("result_cache", {}))
+
+    def _select(self, case_hash):
+        return CachedResult.get_or_none(
+            CachedResult.ai_name == self.ai_name,
+            CachedResult.ai_version == self.ai_version,
+            CachedResult.case_hash == case_hash,
+        )
+
+    def get(self, case_data):
+        """Returns the cached result of the AI for a case, if any"""
+        now = time.time()
+        entry = self._select(compute_case_hash(case_data))
+        if entry is None:
+            return None
+
+        if now - entry.created > self.ttl:
+            entry.delete_instance()
+            return None
+
+        CachedResult.update(last_used=now).where(CachedResult.id == entry.id).execute()
+
+        return json.loads(entry.result)
+
+    def put(self, case_data, result):
+        now = time.time()
+        CachedResult.replace(
+            ai_name=self.ai_name,
+            ai_version=self.ai_version,
+            case_hash=compute_case_hash(case_data),
+            result=json.dumps(result),
+            created=now,
+            last_used=now,
+        ).execute()
+
+        if self.num_puts % self.eviction_interval == 0:
+            self.evict()
+        self.num_puts += 1
+
+    def evict(self):
+        """Deletes the least recently used results of the AI beyond
+        `max_entries`, skipping the others along the (AI name, last used)
+        index instead of counting them"""
+        least_recently_used = (
+            CachedResult.select(CachedResult.id)
+            .where(CachedResult.ai_name == self.ai_name)
+            .order_by(CachedResult.last_used.desc())
+            .limit(-1)
+            .offset(self.max_entries)
+        )
+        CachedResult.delete().where(CachedResult.id.in_(least_recently_used)).execute()
@@ -0,0 +1,170 @@
+import json
+import os
+
+from evaluator.case_sets import get_case_set_path
+
+RESULTS_FILE_NAME = "results.jsonl"
+RESULTS_INDEX_FILE_NAME = "results.index.jsonl"
+
+AI_REPORT_FIELDS = [
+    "healthcheck_status",
+    "case_status",
+    "health_checks",
+    "errors",
+    "soft_timeouts",
+    "hard_timeouts",
+]
+
+
+def get_results_dir(case_set_id, benchmark_id):
+    return os.path.join(get_case_set_path(case_set_id), benchmark_id)
+
+
+def read_record(log_file, offset, length):
+    log_file.seek(offset)
+    return json.loads(log_file.read(length))
+
+
+class BenchmarkResultLog(object):
+    """Append-only log of the results of a benchmark
+
+    There is one record per (case, AI) pair, with its result and its AI
+    report. Each record is appended (and fsynced) as soon as the pair is
+    done, so the log doubles as the checkpoint of the benchmark: a benchmark
+    that was interrupted (evaluator restart, worker crash, timeout) is
+    resumed without sending those cases to those AIs again.
+
+    The position of every record is kept in an index (in memory and in a
+    file next to the log), so that results can be read without loading the
+    whole log (see `read_results_by_ai`).
+    """
+
+    def __init__(self, results_dir, resume=True):
+        self.path = os.path.join(results_dir, RESULTS_FILE_NAME)
+        self.index_path = os.path.join(results_dir, RESULTS_INDEX_FILE_NAME)
+        # (case number, AI name) -> [case number, case id, AI name, offset,
+        # length]. Case ids are only data: they are not unique in every case
+        # set
+        self.index = {}
+        self.file = None
+        self.index_file = None
+
+        os.makedirs(results_dir, exist_ok=True)
+        if resume:
+            self._load()
+        else:
+            for path in [self.path, self.index_path]:
+                if os.path.isfile(path):
+                    os.remove(path)
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+
+        offset = 0
+        with open(self.path, "rb") as log_file:
+            for line in log_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last pair was being written when the run stopped
+                    break
+
+                self._add_to_index(record, offset, len(line))
+                offset += len(line)
+
+        # A truncated last line would corrupt the next pair appended
+        if offset < os.path.getsize(self.path):
+            os.truncate(self.path, offset)
+
+        # The index file may be behind the log
+        with open(self.index_path, "w") as index_file:
+            for entry in self.index.values():
+                index_file.write(json.dumps(entry) + "\n")
+
+    def _add_to_index(self, record, offset, length):
+        entry = [
+            record["case_num"],
+            record["case_id"],
+            record["ai_name"],
+            offset,
+            length,
+        ]
+        self.index[(record["case_num"], record["ai_name"])] = entry
+        return entry
+
+    def __len__(self):
+        return len(self.index)
+
+    def is_done(self, case_num, ai_name):
+        return (case_num, ai_name) in self.index
+
+    def get_done_case_nums(self, ai_name):
+        return [case_num for (case_num, name) in self.index if name == ai_name]
+
+    def iter_records(self):
+        if not self.index:
+            return
+
+        with open(self.path, "rb") as log_file:
+            for (_, _, _, offset, length) in list(self.index.values()):
+                yield read_record(log_file, offset, length)
+
+    def append(self, case_num, case_id, ai_name, result, ai_report):
+        record = {
+            "case_num": case_num,
+            "case_id": case_id,
+            "ai_name": ai_name,
+            "result": result,
+            "report": {field: getattr(ai_report, field) for field in AI_REPORT_FIELDS},
+        }
+        line = (json.dumps(record) + "\n").encode()
+
+        if self.file is None:
+            self.file = open(self.path, "ab")
+            self.index_file = open(self.index_path, "a")
+
+        offset = self.file.tell()
+        self.file.write(line)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        # The index can be rebuilt from the log, it is not fsynced
+        entry = self._add_to_index(record, offset, len(line))
+        self.index_file.write(json.dumps(entry) + "\n")
+        self.index_file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.index_file.close()
+            self.file = None
+            self.index_file = None
+
+
+def read_results_by_ai(results_dir):
+    """Returns the results of every AI in case set order, reading only their
+    records of the log of a benchmark"""
+    index_path = os.path.join(results_dir, RESULTS_INDEX_FILE_NAME)
+    if not os.path.isfile(index_path):
+        return {}
+
+    entries_by_ai = {}
+    with open(index_path) as index_file:
+        for line in index_file:
+            try:
+                case_num, _, ai_name, offset, length = json.loads(line)
+            except ValueError:
+                break
+
+            entries_by_ai.setdefault(ai_name, {})[case_num] = (offset, length)
+
+    results_by_ai = {}
+    with open(os.path.join(results_dir, RESULTS_FILE_NAME), "rb") as log_file:
+        for ai_name, entries in entries_by_ai.items():
+            results_by_ai[ai_name] = [
+                read_record(log_file, *entries[case_num])["result"]["result"]
+                for case_num in sorted(entries)
+            ]
+
+    return results_by_ai
@@ -1,20 +1,34 @@
 import json
+import os
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
 from multiprocessing import Process
+from threading import Event, Lock, Thread
 from timeit import default_timer as timer
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectTimeout, Timeout
 from retrying import retry
 
 from evaluator.benchmark.definitions import (
+    DEFAULT_HTTP_POOL_SIZE,
+    DEFAULT_SOLVE_CASE_CONCURRENCY,
+    HEALTH_MONITOR_INTERVAL,
     MAX_NUM_ATTEMPTS,
     MAX_WAIT_BETWEEN_RETRIES,
-    SOLVE_CASE_HARD_TIMEOUT,
-    SOLVE_CASE_SOFT_TIMEOUT,
     CaseStatuses,
+    HealthCheckPolicies,
+)
+from evaluator.benchmark.exceptions import SetupError, UnhealthyAIError
+from evaluator.benchmark.runner_policy import (
+    RunnerPolicy,
+    SolveRequest,
+    build_health_check_result,
+    is_healthy_response,
 )
-from evaluator.benchmark.exceptions import UnhealthyAIError
 from evaluator.benchmark.signals import ProcessSignal
 from evaluator.constants import MAX_BENCHMARK_RUN_TIME
 from logs.logger import get_logger
@@ -22,6 +36,50 @@ from logs.logger import get_logger
 logger = get_logger()
 
 
+class ConnectionCountingAdapter(HTTPAdapter):
+    """HTTP adapter counting the requests it sends and the connections it
+    opens for them (including re-opened ones, when a server closed them)"""
+
+    def __init__(self, *args, **kwargs):
+        self.num_requests = 0
+        self.num_connections = 0
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        # Connections are counted through internals of urllib3: they have to
+        # be checked, as they would otherwise silently stop being counted
+        pool_classes = getattr(self.poolmanager, "pool_classes_by_scheme", None)
+        if not isinstance(pool_classes, dict) or not all(
+            hasattr(pool_class, "ConnectionCls") for pool_class in pool_classes.values()
+        ):
+            raise SetupError(
+                "Connections cannot be counted with this version of urllib3 "
+                "(no pool_classes_by_scheme or ConnectionCls)"
+            )
+
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: self._make_counting_pool_class(pool_class)
+            for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+    def _make_counting_pool_class(self, pool_class):
+        adapter = self
+
+        class CountingConnection(pool_class.ConnectionCls):
+            def connect(self):
+                super().connect()
+                adapter.num_connections += 1
+
+        return type(
+            pool_class.__name__, (pool_class,), {"ConnectionCls": CountingConnection}
+        )
+
+    def send(self, request, *args, **kwargs):
+        self.num_requests += 1
+        return super().send(request, *args, **kwargs)
+
+
 class BenchmarkRunner(Process):
     """
     Helper class to run each step required for a benchmark
@@ -29,7 +87,18 @@ class BenchmarkRunner(Process):
     """
 
     def __init__(
-        self, ai_name, ai_config, in_pipe, out_queue, runner_id, benchmark_start_time
+        self,
+        ai_name,
+        ai_config,
+        in_pipe,
+        out_queue,
+        runner_id,
+        benchmark_start_time,
+        case_set=None,
+        health_check_policy=HealthCheckPolicies.PER_CASE,
+        circuit_breaker=False,
+        admission=None,
+        result_cache=False,
     ):
         super().__init__()
         self.ai_name = ai_name
@@ -40,14 +109,48 @@ class BenchmarkRunner(Process):
         self.in_pipe = in_pipe
         self.out_queue = out_queue
         self.benchmark_start_time = benchmark_start_time
+        # Only needed in pipelined mode, where the runner works through the
+        # case set on its own
+        self.case_set = case_set
+        # Kept-alive sessions, one per AI endpoint host (created in the
+        # runner process)
+        self.sessions = {}
+        self.sessions_lock = Lock()
+        self.health_check_policy = health_check_policy
+        # Health checks, circuit breaker, result cache and batching, as in
+        # the other runner engines
+        self.policy = RunnerPolicy(
+            ai_name,
+            ai_config,
+            health_check_policy=health_check_policy,
+            circuit_breaker=circuit_breaker,
+            result_cache=result_cache,
+        )
+        self.stop_health_monitor = Event()
+        # Admission of the requests to the AI across benchmarks, if any (see
+        # `AdmissionController`)
+        self.admission = admission
+        # The runner stops if the process of its manager is killed
+        self.manager_pid = os.getpid()
 
     def if_timeout(self):
         return time.time() - self.benchmark_start_time > MAX_BENCHMARK_RUN_TIME
 
+    def is_orphaned(self):
+        if os.getppid() == self.manager_pid:
+            return False
+
+        # Nobody reads the results anymore, exiting must not wait for them
+        self.out_queue.cancel_join_thread()
+        return True
+
     def run(self):
         try:
+            if self.health_check_policy == HealthCheckPolicies.CACHED:
+                Thread(target=self.monitor_health, daemon=True).start()
+
             while True:
-                if self.if_timeout():
+                if self.if_timeout() or self.is_orphaned():
                     return
 
                 if self.in_pipe.poll(timeout=1.0):
@@ -57,21 +160,27 @@ class BenchmarkRunner(Process):
                         break
 
                     elif signal == ProcessSignal.HEALTH_CHECK:
-                        self.is_healthy(parameters["case_id"])
+                        self.check_health(parameters["case_num"], parameters["case_id"])
 
                     elif signal == ProcessSignal.SOLVE_CASE:
-                        solvecase_result = self.solve_case(parameters["case"])
+                        solvecase_result = self.solve_batch(
+                            [(parameters["case_num"], parameters["case"])]
+                        )[0]
                         self.out_queue.put((signal, self.runner_id, solvecase_result))
                         self.out_queue.put(
                             (ProcessSignal.SENTINEL, self.runner_id, None)
                         )
 
+                    elif signal == ProcessSignal.RUN_CASE_SET:
+                        self.run_case_set(parameters["skip_case_nums"])
+
                     elif signal == ProcessSignal.SENTINEL:
                         raise ValueError(f"Unexpected signal {signal} received")
 
                 else:
                     continue
         finally:
+            self.stop_health_monitor.set()
             self.out_queue.put(
                 (
                     ProcessSignal.SENTINEL,
@@ -81,6 +190,102 @@ class BenchmarkRunner(Process):
             )
         return
 
+    def run_case_set(self, skip_case_nums=()):
+        """Health-checks the AI and solves every case of the case set,
+        reporting each result as soon as it is available
+
+        Up to `concurrency` (see the AI configuration) solve-case requests
+        are in flight at once. AIs supporting it are sent batches of cases
+        (see `get_batch_size`). Results carry their case number, so the
+        manager can put them back in case set order. The cases numbered in
+        `skip_case_nums` (done in a previous run of the benchmark) are
+        skipped.
+        """
+        skip_case_nums = set(skip_case_nums)
+        concurrency = self.ai_config.get("concurrency", DEFAULT_SOLVE_CASE_CONCURRENCY)
+
+        in_flight = set()
+        batch = []
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for case_num, case in enumerate(self.case_set):
+                if self.if_timeout() or self.is_orphaned():
+                    break
+
+                if case_num in skip_case_nums:
+                    continue
+
+                if self.check_health(case_num, case["caseData"]["caseId"]):
+                    batch.append((case_num, case))
+
+                if not self.policy.is_batch_ready(batch):
+                    continue
+
+                in_flight.add(executor.submit(self.solve_batch, batch))
+                batch = []
+
+                if len(in_flight) >= concurrency:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    self._report_solved_cases(done)
+
+            if batch:
+                in_flight.add(executor.submit(self.solve_batch, batch))
+
+            self._report_solved_cases(wait(in_flight).done)
+
+        self.out_queue.put((ProcessSignal.CASE_SET_DONE, self.runner_id, None))
+
+    def solve_batch(self, cases):
+        """Solves (case number, case) pairs, all at once if there are several
+        of them. The cases found in the result cache of the AI are not sent
+        to it"""
+        cached_results, cases = self.policy.get_cached_results(cases)
+
+        solvecase_results = self.solve_cases(cases) if cases else []
+
+        self.policy.cache_results(cases, solvecase_results)
+
+        return list(cached_results.values()) + solvecase_results
+
+    def _report_solved_cases(self, futures):
+        for future in futures:
+            for solvecase_result in future.result():
+                if solvecase_result is not None:
+                    self.out_queue.put(
+                        (ProcessSignal.SOLVE_CASE, self.runner_id, solvecase_result)
+                    )
+
+    def _get_session(self, url):
+        scheme, host = urlsplit(url)[:2]
+        with self.sessions_lock:
+            if (scheme, host) not in self.sessions:
+                pool_size = max(
+                    self.ai_config.get("pool_size", DEFAULT_HTTP_POOL_SIZE),
+                    self.ai_config.get("concurrency", DEFAULT_SOLVE_CASE_CONCURRENCY),
+                )
+                session = requests.Session()
+                session.mount(
+                    f"{scheme}://",
+                    ConnectionCountingAdapter(
+                        pool_connections=1, pool_maxsize=pool_size
+                    ),
+                )
+                self.sessions[(scheme, host)] = session
+
+            return self.sessions[(scheme, host)]
+
+    def get_connection_stats(self):
+        """Returns how many requests were sent to the AI and how many
+        connections had to be opened for them"""
+        stats = {"requests": 0, "connections": 0}
+        with self.sessions_lock:
+            for (scheme, _), session in self.sessions.items():
+                adapter = session.get_adapter(f"{scheme}://")
+                stats["requests"] += adapter.num_requests
+                stats["connections"] += adapter.num_connections
+
+        stats["reused_connections"] = stats["requests"] - stats["connections"]
+        return stats
+
     def _perform_request(
         self, url, method="GET", parameters=None, data=None, timeout=3, headers=None
     ):
@@ -88,7 +293,7 @@ class BenchmarkRunner(Process):
         data = data or {}
         headers = headers or {}
 
-        response = requests.request(
+        response = self._get_session(url).request(
             method,
             url,
             params=parameters,
@@ -98,6 +303,14 @@ class BenchmarkRunner(Process):
         )
         return response
 
+    def _admit(self):
+        """Waits until a request can be sent to the AI, which is released when
+        leaving the returned context"""
+        if self.admission is None:
+            return nullcontext()
+
+        return self.admission.admit(self.ai_name)
+
     def _update_attempts(self):
         if self.healthcheck_attempts >= MAX_NUM_ATTEMPTS:
             self.healthcheck_attempts = 1
@@ -141,48 +354,67 @@ class BenchmarkRunner(Process):
         logger.info(message)
 
     def _respond_healthcheck_signal(self, result, send_sentinel=False):
+        result["connection_stats"] = self.get_connection_stats()
         self.out_queue.put((ProcessSignal.HEALTH_CHECK, self.runner_id, result))
 
         if send_sentinel:
             self.out_queue.put((ProcessSignal.SENTINEL, self.runner_id, None))
 
+    def check_health(self, case_num, case_id):
+        """Health-checks the AI before a case, following the health check
+        policy, and returns whether it is healthy (and the case can be sent)"""
+        result = self.policy.check_health_without_request(case_num, case_id)
+        if result is not None:
+            self._respond_healthcheck_signal(result, send_sentinel=True)
+            return result["healthy"]
+
+        healthy = bool(self.is_healthy(case_num, case_id))
+        self.policy.record_health_check(healthy)
+        return healthy
+
+    def monitor_health(self):
+        """Keeps the cached health status fresh, independently of the cases
+        being solved"""
+        while not self.stop_health_monitor.wait(HEALTH_MONITOR_INTERVAL):
+            try:
+                with self._admit():
+                    response = self._perform_request(
+                        self.ai_config["health_check"],
+                        method="POST",
+                        data={"aiImplementation": self.ai_name},
+                        headers={"Content-Type": "application/json"},
+                    )
+                healthy = is_healthy_response(response.status_code, response.json())
+            except Exception as exc:
+                self._log_info(
+                    message=f"Health monitor check failed for {self.ai_name}. "
+                    f"Got {str(exc)}"
+                )
+                healthy = False
+
+            self.policy.cache_health(healthy)
+
     @retry(
         stop_max_attempt_number=MAX_NUM_ATTEMPTS,
         wait_exponential_multiplier=50,
         wait_exponential_max=MAX_WAIT_BETWEEN_RETRIES * 1000,
     )
-    def is_healthy(self, case_id):
+    def is_healthy(self, case_num, case_id):
         if self.if_timeout():
             return
 
-        result = {
-            "ai_name": self.ai_name,
-            "result": {},
-            "healthy": False,
-            "error": None,
-            "case_status": CaseStatuses.ERROR,
-            "soft_timeout": False,
-            "hard_timeout": False,
-            "healthchecked": False,
-            "report": {
-                "health_checks": 1,
-                "healthcheck_status": CaseStatuses.RUNNING,
-                "errors": 0,
-                "soft_timeouts": 0,
-                "hard_timeouts": 0,
-            },
-            "log": [],
-        }
+        result = build_health_check_result(self.ai_name, case_num, case_id)
 
         healthcheck_endpoint = self.ai_config["health_check"]
 
         try:
-            response = self._perform_request(
-                healthcheck_endpoint,
-                method="POST",
-                data={"aiImplementation": self.ai_name},
-                headers={"Content-Type": "application/json"},
-            )
+            with self._admit():
+                response = self._perform_request(
+                    healthcheck_endpoint,
+                    method="POST",
+                    data={"aiImplementation": self.ai_name},
+                    headers={"Content-Type": "application/json"},
+                )
 
         except Exception as exc:
             should_retry = self._update_attempts()
@@ -269,88 +501,42 @@ class BenchmarkRunner(Process):
                     self._log_info(message=message)
                     result["healthy"] = True
                     result["report"]["healthcheck_status"] = CaseStatuses.OK
+                    self.policy.capabilities = data.get("capabilities", [])
                     self._respond_healthcheck_signal(result, send_sentinel=True)
 
-    def solve_case(self, case):
-        if self.if_timeout():
-            return
+        return result["healthy"]
 
-        return_dict = {
-            "ai_name": self.ai_name,
-            "result": {},
-            "error": None,
-            "case_status": CaseStatuses.RUNNING,
-            "healthchecked": True,
-            "soft_timeout": False,
-            "hard_timeout": False,
-            "log": [],
-        }
-
-        case_data = case["caseData"]
-
-        solve_case_endpoint = self.ai_config["solve_case"]
-
-        data = {"caseData": case_data, "aiImplementation": self.ai_name}
+    def solve_cases(self, cases):
+        """Solves cases with a single request to the AI: its solve-case
+        endpoint for a single case, its solve-cases endpoint for a batch"""
+        if self.if_timeout():
+            return [None] * len(cases)
 
-        message = f"Starting call to solve-case endpoint of AI {self.ai_name}"
-        return_dict["log"].append(message)
-        self._log_info(message)
+        request = SolveRequest(self.ai_name, self.ai_config, cases)
         try:
-            start = timer()
-            response = self._perform_request(
-                solve_case_endpoint,
-                method="POST",
-                data=data,
-                timeout=SOLVE_CASE_HARD_TIMEOUT,
-                headers={"Content-Type": "application/json"},
-            )
-            end = timer()
+            with self._admit():
+                start = timer()
+                response = self._perform_request(
+                    request.url,
+                    method="POST",
+                    data=request.data,
+                    timeout=request.timeout,
+                    headers={"Content-Type": "application/json"},
+                )
+                end = timer()
         except (Timeout, ConnectTimeout) as exc:
-            return_dict["error"] = str(exc)
-            return_dict["case_status"] = CaseStatuses.ERROR
-            return_dict["hard_timeout"] = True
-            message = (
-                f"Hard timeout ({SOLVE_CASE_HARD_TIMEOUT}sec) "
-                f"solving case for {self.ai_name}"
-            )
-            return_dict["log"].append(message)
-            self._log_error(message=message)
+            request.fail(exc, timeout=True)
         except Exception as exc:
-            return_dict["error"] = str(exc)
-            return_dict["case_status"] = CaseStatuses.ERROR
-            message = f"Error solving case for {self.ai_name}. Got {str(exc)}"
-
-            return_dict["log"].append(message)
-            self._log_error(message=message)
+            request.fail(exc)
         else:
-            elapsed_time = end - start
-            if elapsed_time > SOLVE_CASE_SOFT_TIMEOUT:
-                return_dict["soft_timeout"] = True
-                message = (
-                    f"Soft timeout ({SOLVE_CASE_SOFT_TIMEOUT}sec) "
-                    f"solving case for {self.ai_name}"
-                )
-
-                return_dict["log"].append(message)
-                self._log_info(message=message)
+            request.complete(response.status_code, response.text, end - start)
 
-            if response.status_code != 200:
-                message = (
-                    f"AI {self.ai_name} responded with unexpected HTTP "
-                    f"status {response.status_code} and data={response}"
-                )
-                return_dict["error"] = message
-                return_dict["case_status"] = CaseStatuses.ERROR
+        return [
+            self._finish_solve_case(return_dict) for return_dict in request.return_dicts
+        ]
 
-                return_dict["log"].append(message)
-                self._log_error(message=message)
-            else:
-                return_dict["result"] = response.json()
-                return_dict["case_status"] = CaseStatuses.OK
-                message = (
-                    f"Successfuly called solve-case endpoint of AI "
-                    f"{self.ai_name}. Took {elapsed_time:.1f}sec"
-                )
-                self._log_info(message=message)
+    def _finish_solve_case(self, return_dict):
+        self.policy.finish_solve_case(return_dict)
+        return_dict["connection_stats"] = self.get_connection_stats()
 
         return return_dict
@@ -0,0 +1,448 @@
+import json
+import time
+
+from evaluator.benchmark.circuit_breaker import CircuitBreaker
+from evaluator.benchmark.definitions import (
+    DEFAULT_SOLVE_CASES_BATCH_SIZE,
+    HEALTH_CHECK_TTL,
+    SOLVE_CASE_HARD_TIMEOUT,
+    SOLVE_CASE_SOFT_TIMEOUT,
+    SOLVE_CASES_CAPABILITY,
+    SOLVE_CASES_MAX_HARD_TIMEOUT,
+    CaseStatuses,
+    CircuitStates,
+    HealthCheckPolicies,
+)
+from evaluator.benchmark.result_cache import ResultCache
+from logs.logger import get_logger
+
+logger = get_logger()
+
+
+def build_health_check_result(ai_name, case_num, case_id):
+    """Returns the (initially failed) result of a health check, as reported
+    to the benchmark manager by every runner engine"""
+    return {
+        "ai_name": ai_name,
+        "case_num": case_num,
+        "case_id": case_id,
+        "result": {},
+        "healthy": False,
+        "error": None,
+        "case_status": CaseStatuses.ERROR,
+        "soft_timeout": False,
+        "hard_timeout": False,
+        "healthchecked": False,
+        "report": {
+            "health_checks": 1,
+            "healthcheck_status": CaseStatuses.RUNNING,
+            "errors": 0,
+            "soft_timeouts": 0,
+            "hard_timeouts": 0,
+        },
+        "log": [],
+    }
+
+
+def build_cached_health_check_result(ai_name, case_num, case_id):
+    """Returns the result of a health check answered from the cached health
+    status (no health check request is sent for it)"""
+    result = build_health_check_result(ai_name, case_num, case_id)
+    result["healthy"] = True
+    result["report"]["health_checks"] = 0
+    result["report"]["healthcheck_status"] = CaseStatuses.OK
+    return result
+
+
+def build_circuit_open_result(ai_name, case_num, case_id):
+    """Returns the result of a case not sent to the AI because its circuit
+    breaker is open"""
+    result = build_health_check_result(ai_name, case_num, case_id)
+    result["case_status"] = CaseStatuses.CIRCUIT_OPEN
+    result["error"] = f"Circuit breaker open for AI {ai_name}"
+    result["report"]["health_checks"] = 0
+    result["report"]["healthcheck_status"] = CaseStatuses.CIRCUIT_OPEN
+    result["report"]["case_status"] = CaseStatuses.CIRCUIT_OPEN
+    return result
+
+
+def is_healthy_response(status_code, data):
+    return status_code == 200 and data.get("status", "Error") == "OK"
+
+
+def build_solve_case_result(ai_name, case_num, case_id):
+    """Returns the (initially running) result of solving a case, as reported
+    to the benchmark manager by every runner engine"""
+    return {
+        "ai_name": ai_name,
+        "case_num": case_num,
+        "case_id": case_id,
+        "result": {},
+        "error": None,
+        "case_status": CaseStatuses.RUNNING,
+        "healthchecked": True,
+        "soft_timeout": False,
+        "hard_timeout": False,
+        "cached": False,
+        "log": [],
+    }
+
+
+def get_cached_results(result_cache, ai_name, cases):
+    """Returns the results of the (case number, case) pairs found in the
+    result cache of an AI (if enabled), by case number"""
+    if result_cache is None:
+        return {}
+
+    cached_results = {}
+    for case_num, case in cases:
+        result = result_cache.get(case["caseData"])
+        if result is not None:
+            case_id = case["caseData"]["caseId"]
+            return_dict = build_solve_case_result(ai_name, case_num, case_id)
+            return_dict["result"] = result
+            return_dict["case_status"] = CaseStatuses.OK
+            return_dict["cached"] = True
+            return_dict["log"].append(
+                f"Got the result of case {case_id} for AI {ai_name} from the cache"
+            )
+            cached_results[case_num] = return_dict
+
+    return cached_results
+
+
+def cache_solved_results(result_cache, cases, solvecase_results):
+    """Stores the successful results of the (case number, case) pairs solved
+    by an AI in its result cache (if enabled)"""
+    if result_cache is None:
+        return
+
+    for (_, case), return_dict in zip(cases, solvecase_results):
+        if return_dict is not None and return_dict["case_status"] == CaseStatuses.OK:
+            result_cache.put(case["caseData"], return_dict["result"])
+
+
+def get_batch_size(ai_config, capabilities):
+    """Returns the number of cases to send an AI per request: its `batch_size`
+    if it has a solve-cases endpoint and advertises the capability (or is
+    configured with it), 1 otherwise"""
+    capabilities = capabilities or ai_config.get("capabilities", [])
+    if "solve_cases" in ai_config and SOLVE_CASES_CAPABILITY in capabilities:
+        return ai_config.get("batch_size", DEFAULT_SOLVE_CASES_BATCH_SIZE)
+
+    return 1
+
+
+def is_batch_ready(batch, batch_size, circuit_breaker):
+    """Returns whether a batch of cases is to be sent: once it is full, or at
+    once while the circuit breaker of the AI is not closed, as the trial case
+    of a half-open circuit would otherwise wait for cases it does not let
+    through"""
+    if not batch:
+        return False
+
+    if circuit_breaker is not None and circuit_breaker.state != CircuitStates.CLOSED:
+        return True
+
+    return len(batch) >= batch_size
+
+
+def fail_solve_case_results(return_dicts, message, hard_timeout=False):
+    """Marks every case of a failed solve-case(s) request as failed"""
+    logger.error(message)
+    for return_dict in return_dicts:
+        return_dict["error"] = message
+        return_dict["case_status"] = CaseStatuses.ERROR
+        return_dict["hard_timeout"] = hard_timeout
+        return_dict["log"].append(message)
+
+
+def fill_solve_case_result(return_dict, status_code, response_data, elapsed_time):
+    """Fills the result of a case from the response of the solve-case
+    endpoint of the AI"""
+    ai_name = return_dict["ai_name"]
+
+    if elapsed_time > SOLVE_CASE_SOFT_TIMEOUT:
+        return_dict["soft_timeout"] = True
+        message = (
+            f"Soft timeout ({SOLVE_CASE_SOFT_TIMEOUT}sec) "
+            f"solving case for {ai_name}"
+        )
+        return_dict["log"].append(message)
+        logger.info(message)
+
+    try:
+        if status_code != 200:
+            raise ValueError(
+                f"unexpected HTTP status {status_code} and data={response_data}"
+            )
+        return_dict["result"] = json.loads(response_data)
+    except ValueError as exc:
+        message = f"AI {ai_name} responded with {str(exc)}"
+        return_dict["error"] = message
+        return_dict["case_status"] = CaseStatuses.ERROR
+        return_dict["log"].append(message)
+        logger.error(message)
+    else:
+        return_dict["case_status"] = CaseStatuses.OK
+        logger.info(
+            f"Successfuly called solve-case endpoint of AI "
+            f"{ai_name}. Took {elapsed_time:.1f}sec"
+        )
+
+
+def fill_solve_cases_item_result(return_dict, item, elapsed_time):
+    """Fills the result of a case from its item of a solve-cases response
+
+    `elapsed_time` is the share of the case in the time the evaluator
+    measured for the whole request. Timeouts are accounted for with the
+    longest of it and the time the AI reports having spent on the case, so
+    that a slow case is not hidden by the fast ones of its batch.
+    """
+    ai_name = return_dict["ai_name"]
+    reported_elapsed_time = item.get("elapsedTime")
+    if isinstance(reported_elapsed_time, (int, float)):
+        return_dict["reported_elapsed_time"] = reported_elapsed_time
+        elapsed_time = max(elapsed_time, reported_elapsed_time)
+
+    if elapsed_time > SOLVE_CASE_HARD_TIMEOUT:
+        message = (
+            f"Hard timeout ({SOLVE_CASE_HARD_TIMEOUT}sec) "
+            f"solving case for {ai_name}"
+        )
+        return_dict["error"] = message
+        return_dict["case_status"] = CaseStatuses.ERROR
+        return_dict["hard_timeout"] = True
+        return_dict["log"].append(message)
+        logger.error(message)
+        return
+
+    if elapsed_time > SOLVE_CASE_SOFT_TIMEOUT:
+        return_dict["soft_timeout"] = True
+        message = (
+            f"Soft timeout ({SOLVE_CASE_SOFT_TIMEOUT}sec) "
+            f"solving case for {ai_name}"
+        )
+        return_dict["log"].append(message)
+        logger.info(message)
+
+    if "result" not in item:
+        message = f"Error solving case for {ai_name}. Got {item.get('error')}"
+        return_dict["error"] = message
+        return_dict["case_status"] = CaseStatuses.ERROR
+        return_dict["log"].append(message)
+        logger.error(message)
+    else:
+        return_dict["result"] = item["result"]
+        return_dict["case_status"] = CaseStatuses.OK
+
+
+def fill_solve_cases_results(return_dicts, status_code, response_data, elapsed_time):
+    """Fills the results of a batch of cases from the response of the
+    solve-cases endpoint of the AI"""
+    ai_name = return_dicts[0]["ai_name"]
+
+    items = []
+    if status_code == 200:
+        try:
+            items = json.loads(response_data).get("results", [])
+        except (ValueError, AttributeError):
+            pass
+
+    if len(items) != len(return_dicts):
+        fail_solve_case_results(
+            return_dicts,
+            f"AI {ai_name} responded with HTTP status {status_code} "
+            f"and {len(items)} results for {len(return_dicts)} cases",
+        )
+        return
+
+    for return_dict, item in zip(return_dicts, items):
+        fill_solve_cases_item_result(
+            return_dict, item, elapsed_time / len(return_dicts)
+        )
+    logger.info(
+        f"Successfuly called solve-cases endpoint of AI "
+        f"{ai_name}. Took {elapsed_time:.1f}sec"
+    )
+
+
+class SolveRequest(object):
+    """Request solving one case (solve-case endpoint) or a batch of cases
+    (solve-cases endpoint) of an AI, whatever the runner engine sending it
+
+    Cases are given as (case number, case) pairs. Engines send `data` to
+    `url`, then call `complete` with the response or `fail` with the
+    exception the request raised.
+    """
+
+    def __init__(self, ai_name, ai_config, cases):
+        self.ai_name = ai_name
+        self.is_batch = len(cases) > 1
+        self.return_dicts = [
+            build_solve_case_result(ai_name, case_num, case["caseData"]["caseId"])
+            for case_num, case in cases
+        ]
+
+        if self.is_batch:
+            self.url = ai_config["solve_cases"]
+            self.data = {
+                "cases": [case["caseData"] for _, case in cases],
+                "aiImplementation": ai_name,
+            }
+            message = (
+                f"Starting call to solve-cases endpoint of AI {ai_name} "
+                f"with {len(cases)} cases"
+            )
+        else:
+            self.url = ai_config["solve_case"]
+            self.data = {
+                "caseData": cases[0][1]["caseData"],
+                "aiImplementation": ai_name,
+            }
+            message = f"Starting call to solve-case endpoint of AI {ai_name}"
+
+        # The timeout of a batch grows with its number of cases, up to a cap
+        self.timeout = min(
+            SOLVE_CASE_HARD_TIMEOUT * len(cases), SOLVE_CASES_MAX_HARD_TIMEOUT
+        )
+
+        self.return_dicts[0]["log"].append(message)
+        logger.info(message)
+
+    def complete(self, status_code, response_data, elapsed_time):
+        if self.is_batch and elapsed_time > self.timeout:
+            # The timeout of the request only bounds the wait for each read
+            self.fail(None, timeout=True)
+        elif self.is_batch:
+            fill_solve_cases_results(
+                self.return_dicts, status_code, response_data, elapsed_time
+            )
+        else:
+            fill_solve_case_result(
+                self.return_dicts[0], status_code, response_data, elapsed_time
+            )
+
+    def fail(self, exception, timeout=False):
+        """Fails every case of the request: none of the cases of a batch that
+        timed out was answered in time, they are all hard timeouts"""
+        if timeout and self.is_batch:
+            message = (
+                f"Hard timeout ({self.timeout}sec) solving "
+                f"{len(self.return_dicts)} cases for {self.ai_name}"
+            )
+        elif timeout:
+            message = (
+                f"Hard timeout ({SOLVE_CASE_HARD_TIMEOUT}sec) "
+                f"solving case for {self.ai_name}"
+            )
+        elif self.is_batch:
+            message = f"Error solving cases for {self.ai_name}. Got {str(exception)}"
+        else:
+            message = f"Error solving case for {self.ai_name}. Got {str(exception)}"
+
+        fail_solve_case_results(self.return_dicts, message, hard_timeout=timeout)
+
+
+class RunnerPolicy(object):
+    """Per-case policy of the runner of an AI, shared by the runner engines:
+    health checks (following the health check policy), circuit breaker,
+    result cache and batching
+
+    Engines only send the requests and report the results.
+    """
+
+    def __init__(
+        self,
+        ai_name,
+        ai_config,
+        health_check_policy=HealthCheckPolicies.PER_CASE,
+        circuit_breaker=False,
+        result_cache=False,
+    ):
+        self.ai_name = ai_name
+        self.ai_config = ai_config
+        self.health_check_policy = health_check_policy
+        # Capabilities advertised by the AI in its health check responses
+        self.capabilities = []
+        self.circuit_breaker = (
+            CircuitBreaker.from_ai_config(ai_config) if circuit_breaker else None
+        )
+        # Time until which the AI is known to be healthy (cached policy)
+        self.healthy_until = 0
+        # Results of the AI kept across benchmarks, if it is deterministic
+        # (see `ResultCache`)
+        self.result_cache = (
+            ResultCache.from_ai_config(ai_name, ai_config) if result_cache else None
+        )
+
+    def check_health_without_request(self, case_num, case_id):
+        """Returns the result of the health check before a case if it does
+        not need a health check request: the circuit breaker of the AI is
+        open, or its last health status is still valid (cached policy)"""
+        if self.circuit_breaker is not None and not self.circuit_breaker.allow_case():
+            return build_circuit_open_result(self.ai_name, case_num, case_id)
+
+        if (
+            self.health_check_policy == HealthCheckPolicies.CACHED
+            and time.time() < self.healthy_until
+        ):
+            return build_cached_health_check_result(self.ai_name, case_num, case_id)
+
+        return None
+
+    def record_health_check(self, healthy):
+        self.cache_health(healthy)
+        if not healthy:
+            self.record_case_outcome([], error=True)
+
+    def cache_health(self, healthy):
+        self.healthy_until = time.time() + HEALTH_CHECK_TTL if healthy else 0
+
+    def record_case_outcome(self, log, error=False, timeout=False):
+        if self.circuit_breaker is None:
+            return
+
+        previous_state = self.circuit_breaker.state
+        state = self.circuit_breaker.record(error=error, timeout=timeout)
+        if state != previous_state:
+            message = (
+                f"Circuit breaker for AI {self.ai_name} is now "
+                f"{CircuitStates(state).name.lower()}"
+            )
+            log.append(message)
+            logger.info(message)
+
+    def is_batch_ready(self, batch):
+        return is_batch_ready(
+            batch,
+            get_batch_size(self.ai_config, self.capabilities),
+            self.circuit_breaker,
+        )
+
+    def get_cached_results(self, cases):
+        """Returns the results of the (case number, case) pairs found in the
+        result cache, by case number, and the pairs to send the AI"""
+        cached_results = get_cached_results(self.result_cache, self.ai_name, cases)
+        cases = [
+            (case_num, case)
+            for case_num, case in cases
+            if case_num not in cached_results
+        ]
+        return cached_results, cases
+
+    def cache_results(self, cases, solvecase_results):
+        cache_solved_results(self.result_cache, cases, solvecase_results)
+
+    def finish_solve_case(self, return_dict):
+        if return_dict["case_status"] == CaseStatuses.ERROR:
+            self.cache_health(False)
+
+        self.record_case_outcome(
+            return_dict["log"],
+            error=return_dict["case_status"] == CaseStatuses.ERROR
+            and not return_dict["hard_timeout"],
+            timeout=return_dict["soft_timeout"] or return_dict["hard_timeout"],
+        )
+
+        return return_dict
@@ -5,4 +5,6 @@ class ProcessSignal(IntEnum):
     HEALTH_CHECK = 1
     SOLVE_CASE = 2
     SENTINEL = 3
+    RUN_CASE_SET = 4
+    CASE_SET_DONE = 5
     TERMINATE = -1
@@ -0,0 +1,355 @@
+import hashlib
+import itertools
+import json
+import mmap
+import os
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+# Looked up by every function building a path in it (see `get_data_path`),
+# so that the evaluator can be pointed to another directory
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+# Small case sets are stored as a single (indented) JSON array, larger ones
+# as newline-delimited JSON with one case per line
+CASES_JSON_FILE_NAME = "cases.json"
+CASES_NDJSON_FILE_NAME = "cases.ndjson"
+# Byte offsets of the cases in `cases.ndjson` (one more than there are cases,
+# the last one being the file size), so that any case can be read directly
+CASES_INDEX_FILE_NAME = "cases.index.npy"
+
+INDEX_BUILD_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Bounds of the case set cache of each process. Parsed (JSON) case sets count
+# for their number of cases, memory-mapped ones for a single case.
+MAX_CACHED_CASES = 100000
+MAX_CACHED_CASE_SETS = 64
+
+
+def get_data_path(*names):
+    return os.path.join(DATA_DIR, *names)
+
+
+def set_data_dir(data_dir):
+    global DATA_DIR
+
+    DATA_DIR = data_dir
+
+
+def get_case_set_path(case_set_id):
+    return get_data_path(case_set_id)
+
+
+def get_cases_file_path(case_set_id):
+    """Returns the path to the file holding the cases of a case set"""
+    ndjson_path = os.path.join(get_case_set_path(case_set_id), CASES_NDJSON_FILE_NAME)
+    if os.path.isfile(ndjson_path):
+        return ndjson_path
+
+    return os.path.join(get_case_set_path(case_set_id), CASES_JSON_FILE_NAME)
+
+
+def get_line_end_offsets(chunk, chunk_offset):
+    """Returns the offsets just after each newline of a chunk of a file"""
+    return np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord("\n")) + (
+        chunk_offset + 1
+    )
+
+
+def save_index(case_set_id, line_end_offsets):
+    path = os.path.join(get_case_set_path(case_set_id), CASES_INDEX_FILE_NAME)
+    partial_path = path + ".partial.npy"
+    np.save(partial_path, np.concatenate([[0]] + line_end_offsets).astype(np.int64))
+    os.replace(partial_path, path)
+
+
+def build_index(case_set_id):
+    """Builds the offset index of an NDJSON case set without parsing it"""
+    path = os.path.join(get_case_set_path(case_set_id), CASES_NDJSON_FILE_NAME)
+
+    line_end_offsets = []
+    chunk_offset = 0
+    with open(path, "rb") as cases_file:
+        for chunk in iter(lambda: cases_file.read(INDEX_BUILD_CHUNK_SIZE), b""):
+            line_end_offsets.append(get_line_end_offsets(chunk, chunk_offset))
+            chunk_offset += len(chunk)
+
+    save_index(case_set_id, line_end_offsets)
+
+
+class CaseSetReader(object):
+    """Read-only, lazy view on an NDJSON case set
+
+    The case file and its offset index are memory-mapped, so opening a case
+    set does not parse it, case N is read without parsing the other cases,
+    and processes reading the same case set share the OS page cache.
+    """
+
+    def __init__(self, case_set_id):
+        self.case_set_id = case_set_id
+        self._open()
+
+    def _open(self):
+        path = get_case_set_path(self.case_set_id)
+        self.offsets = np.load(os.path.join(path, CASES_INDEX_FILE_NAME), mmap_mode="r")
+
+        self.cases_mmap = None
+        if self.offsets[-1] > 0:
+            with open(os.path.join(path, CASES_NDJSON_FILE_NAME), "rb") as cases_file:
+                self.cases_mmap = mmap.mmap(
+                    cases_file.fileno(), 0, access=mmap.ACCESS_READ
+                )
+
+    def __getstate__(self):
+        # Memory maps cannot be pickled, they are re-opened instead
+        return {"case_set_id": self.case_set_id}
+
+    def __setstate__(self, state):
+        self.case_set_id = state["case_set_id"]
+        self._open()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("case index out of range")
+
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        return json.loads(self.cases_mmap[start:end])
+
+    def __iter__(self):
+        return self.iter_range(0, len(self))
+
+    def iter_range(self, start, stop):
+        for index in range(max(start, 0), min(stop, len(self))):
+            yield self[index]
+
+
+def open_case_set(case_set_id):
+    """Opens a case set for reading
+
+    NDJSON case sets are opened lazily (see `CaseSetReader`), building their
+    offset index first if needed. Small JSON case sets are loaded as a list.
+    """
+    path = get_cases_file_path(case_set_id)
+
+    if path.endswith(CASES_NDJSON_FILE_NAME):
+        index_path = os.path.join(get_case_set_path(case_set_id), CASES_INDEX_FILE_NAME)
+        if not os.path.isfile(index_path) or os.path.getmtime(
+            index_path
+        ) < os.path.getmtime(path):
+            build_index(case_set_id)
+
+        return CaseSetReader(case_set_id)
+
+    with open(path, "r") as cases_file:
+        return json.load(cases_file)
+
+
+class CaseSetCache(object):
+    """Size-bounded LRU cache of open case sets
+
+    Entries are keyed by case set id and invalidated when the cases file
+    changes (modification time or size).
+
+    Every process has its own cache: the evaluator, and each benchmark worker
+    (started by a fork server, workers do not inherit the evaluator's). What
+    the workers share is the memory maps of NDJSON case sets, through the OS
+    page cache (see `CaseSetReader`): each worker only opens the case set and
+    its offset index. A JSON case set is parsed by every worker that runs it,
+    and takes up to MAX_CACHED_CASES cases of memory in each of them.
+    """
+
+    def __init__(self, max_cases=MAX_CACHED_CASES, max_case_sets=MAX_CACHED_CASE_SETS):
+        self.max_cases = max_cases
+        self.max_case_sets = max_case_sets
+        self.entries = OrderedDict()
+        self.num_cached_cases = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    @staticmethod
+    def get_version(case_set_id):
+        stat = os.stat(get_cases_file_path(case_set_id))
+        return stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def get_weight(case_set):
+        return 1 if isinstance(case_set, CaseSetReader) else len(case_set)
+
+    def get(self, case_set_id):
+        version = self.get_version(case_set_id)
+
+        with self.lock:
+            entry = self.entries.get(case_set_id)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(case_set_id)
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+
+        case_set = open_case_set(case_set_id)
+        weight = self.get_weight(case_set)
+
+        with self.lock:
+            self._remove(case_set_id)
+            if weight <= self.max_cases:
+                self.entries[case_set_id] = (version, case_set, weight)
+                self.num_cached_cases += weight
+
+            while (
+                self.num_cached_cases > self.max_cases
+                or len(self.entries) > self.max_case_sets
+            ):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+        return case_set
+
+    def _remove(self, case_set_id):
+        entry = self.entries.pop(case_set_id, None)
+        if entry is not None:
+            self.num_cached_cases -= entry[2]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "cached_case_sets": len(self.entries),
+                "cached_cases": self.num_cached_cases,
+            }
+
+
+def case_matches_filters(
+    case,
+    biological_sex=None,
+    min_age=None,
+    max_age=None,
+    presenting_complaint=None,
+    expected_triage_level=None,
+):
+    case_data = case["caseData"]
+    profile_information = case_data["profileInformation"]
+
+    if biological_sex is not None:
+        if profile_information["biologicalSex"] != biological_sex:
+            return False
+
+    if min_age is not None and profile_information["age"] < min_age:
+        return False
+
+    if max_age is not None and profile_information["age"] > max_age:
+        return False
+
+    if presenting_complaint is not None:
+        if presenting_complaint not in [
+            complaint["id"] for complaint in case_data["presentingComplaints"]
+        ]:
+            return False
+
+    if expected_triage_level is not None:
+        values_to_predict = case.get("valuesToPredict", {})
+        if values_to_predict.get("expectedTriageLevel") != expected_triage_level:
+            return False
+
+    return True
+
+
+def select_cases(case_set, offset=0, limit=None, fields=None, **filters):
+    """Returns a page of the cases of an open case set matching the filters
+
+    `offset` and `limit` count matching cases. `fields` restricts cases to
+    the given top-level keys (e.g. `caseData`). Cases are read lazily, so
+    unfiltered pages of a `CaseSetReader` only parse the cases returned.
+    """
+    filters = {key: value for key, value in filters.items() if value is not None}
+
+    if filters:
+        cases = (case for case in case_set if case_matches_filters(case, **filters))
+        cases = itertools.islice(cases, offset, None)
+    elif isinstance(case_set, CaseSetReader):
+        cases = case_set.iter_range(offset, len(case_set))
+    else:
+        cases = iter(case_set[offset:])
+
+    page = list(itertools.islice(cases, limit))
+
+    if fields:
+        page = [{key: case[key] for key in fields if key in case} for case in page]
+
+    return page
+
+
+def iter_cases(case_set_id):
+    """Yields the cases of a case set one by one"""
+    yield from open_case_set(case_set_id)
+
+
+def load_cases(case_set_id):
+    return list(iter_cases(case_set_id))
+
+
+def write_cases_ndjson(case_set_id, chunks, expected_num_cases=None):
+    """Writes an iterable of raw NDJSON byte chunks as a case set
+
+    Chunks are written to disk as they arrive, so memory usage does not
+    depend on the size of the case set. The file is only moved into place
+    once complete, followed by its offset index. Returns the number of cases
+    written and the MD5 checksum of the file.
+
+    Raises a ValueError if the last case is truncated or, when given, the
+    number of cases is not `expected_num_cases`. Nothing is left behind if
+    the case set is not complete (or iterating the chunks raises).
+    """
+    path = get_case_set_path(case_set_id)
+    created_path = not os.path.isdir(path)
+    os.makedirs(path, exist_ok=True)
+
+    final_path = os.path.join(path, CASES_NDJSON_FILE_NAME)
+    partial_path = final_path + ".partial"
+
+    # The offset index and the checksum are built as the chunks are written
+    line_end_offsets = []
+    chunk_offset = 0
+    checksum = hashlib.md5()
+    last_byte = b"\n"
+    try:
+        with open(partial_path, "wb") as cases_file:
+            for chunk in chunks:
+                cases_file.write(chunk)
+                line_end_offsets.append(get_line_end_offsets(chunk, chunk_offset))
+                chunk_offset += len(chunk)
+                checksum.update(chunk)
+                last_byte = chunk[-1:] or last_byte
+
+        if last_byte != b"\n":
+            raise ValueError(f"Case set {case_set_id} ends with a truncated case")
+
+        num_cases = sum(len(offsets) for offsets in line_end_offsets)
+
+        if expected_num_cases is not None and num_cases != expected_num_cases:
+            raise ValueError(
+                f"Case set {case_set_id} has {num_cases} cases instead of "
+                f"{expected_num_cases}"
+            )
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        if created_path:
+            os.rmdir(path)
+        raise
+
+    os.replace(partial_path, final_path)
+    save_index(case_set_id, line_end_offsets)
+
+    return num_cases, checksum.hexdigest()
@@ -0,0 +1,120 @@
+import hashlib
+import os
+import time
+
+from peewee import CharField, FloatField, IntegerField, Model, SqliteDatabase
+
+from evaluator.case_sets import (
+    CASES_JSON_FILE_NAME,
+    CASES_NDJSON_FILE_NAME,
+    get_cases_file_path,
+    get_data_path,
+    open_case_set,
+)
+
+CATALOG_FILE_NAME = "catalog.db"
+
+CASE_SET_SOURCE_SYNTHETIC = "synthetic"
+CASE_SET_SOURCE_DOCTOR_CASES = "doctor_cases"
+DOCTOR_CASE_SET_IDS = {"london_model2019_cases_v1": CASE_SET_SOURCE_DOCTOR_CASES}
+
+CHECKSUM_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Opened in the data directory by `initialize_catalog`
+DATABASE = SqliteDatabase(None, pragmas={"journal_mode": "wal"})
+
+
+class CaseSetEntry(Model):
+    case_set_id = CharField(primary_key=True)
+    num_cases = IntegerField()
+    byte_size = IntegerField()
+    created = FloatField(index=True)
+    source = CharField(index=True)
+    checksum = CharField()
+
+    class Meta:
+        database = DATABASE
+        table_name = "case_sets"
+
+    def to_dict(self):
+        return {
+            "id": self.case_set_id,
+            "num_cases": self.num_cases,
+            "byte_size": self.byte_size,
+            "created": self.created,
+            "source": self.source,
+            "checksum": self.checksum,
+        }
+
+
+def compute_checksum(path):
+    checksum = hashlib.md5()
+    with open(path, "rb") as cases_file:
+        for chunk in iter(lambda: cases_file.read(CHECKSUM_CHUNK_SIZE), b""):
+            checksum.update(chunk)
+
+    return checksum.hexdigest()
+
+
+def register_case_set(case_set_id, source=None, checksum=None, created=None):
+    """Adds (or refreshes) a case set in the catalog
+
+    The checksum is computed from the cases file unless it is given, e.g.
+    when it was already computed while the case set was being written.
+    """
+    path = get_cases_file_path(case_set_id)
+
+    entry = {
+        "case_set_id": case_set_id,
+        "num_cases": len(open_case_set(case_set_id)),
+        "byte_size": os.path.getsize(path),
+        "created": created or time.time(),
+        "source": source
+        or DOCTOR_CASE_SET_IDS.get(case_set_id, CASE_SET_SOURCE_SYNTHETIC),
+        "checksum": checksum or compute_checksum(path),
+    }
+    CaseSetEntry.insert(**entry).on_conflict_replace().execute()
+
+    return entry
+
+
+def backfill_catalog():
+    """Registers the case sets that were created before the catalog existed"""
+    for element in os.scandir(get_data_path()):
+        if not element.is_dir():
+            continue
+
+        for file_name in [CASES_NDJSON_FILE_NAME, CASES_JSON_FILE_NAME]:
+            path = os.path.join(element.path, file_name)
+            if os.path.isfile(path):
+                register_case_set(element.name, created=os.path.getmtime(path))
+                break
+
+
+def initialize_catalog():
+    os.makedirs(get_data_path(), exist_ok=True)
+    is_new = not os.path.isfile(get_data_path(CATALOG_FILE_NAME))
+    DATABASE.init(get_data_path(CATALOG_FILE_NAME))
+
+    with DATABASE.connection_context():
+        DATABASE.create_tables([CaseSetEntry])
+
+        if is_new:
+            backfill_catalog()
+
+
+def select_case_set(case_set_id):
+    return CaseSetEntry.get_or_none(CaseSetEntry.case_set_id == case_set_id)
+
+
+def select_case_sets(offset=0, limit=None, source=None):
+    """Returns the total number of matching case sets and a page of them,
+    most recently created first"""
+    query = CaseSetEntry.select()
+    if source is not None:
+        query = query.where(CaseSetEntry.source == source)
+
+    total = query.count()
+    page = query.order_by(CaseSetEntry.created.desc()).offset(offset).limit(limit)
+
+    return total, [entry.to_dict() for entry in page]
@@ -0,0 +1,106 @@
+import json
+import os
+import time
+
+import peewee
+from peewee import CharField, FloatField, IntegerField, Model, TextField
+
+from evaluator.case_sets import get_data_path
+
+JOBS_FILE_NAME = "jobs.db"
+
+JOB_STATUS_QUEUED = "queued"
+JOB_STATUS_RUNNING = "running"
+JOB_STATUS_FINISHED = "finished"
+JOB_STATUS_FAILED = "failed"
+
+# Opened in the data directory by `initialize_jobs`
+DATABASE = peewee.SqliteDatabase(None, pragmas={"journal_mode": "wal"})
+
+
+class BenchmarkJob(Model):
+    benchmark_id = CharField(primary_key=True)
+    request = TextField()
+    status = CharField(index=True)
+    submitted = FloatField(index=True)
+    started = FloatField(null=True)
+    worker_index = IntegerField(null=True)
+
+    class Meta:
+        database = DATABASE
+        table_name = "benchmark_jobs"
+
+    @property
+    def request_data(self):
+        return json.loads(self.request)
+
+
+def initialize_jobs():
+    """Creates the job queue, queueing again the benchmarks that were still
+    running when the evaluator stopped"""
+    os.makedirs(get_data_path(), exist_ok=True)
+    DATABASE.init(get_data_path(JOBS_FILE_NAME))
+
+    with DATABASE.connection_context():
+        DATABASE.create_tables([BenchmarkJob])
+
+        BenchmarkJob.update(
+            status=JOB_STATUS_QUEUED, started=None, worker_index=None
+        ).where(BenchmarkJob.status == JOB_STATUS_RUNNING).execute()
+
+
+def enqueue_job(benchmark_id, request):
+    BenchmarkJob.create(
+        benchmark_id=benchmark_id,
+        request=json.dumps(request),
+        status=JOB_STATUS_QUEUED,
+        submitted=time.time(),
+    )
+
+
+def select_job(benchmark_id):
+    return BenchmarkJob.get_or_none(BenchmarkJob.benchmark_id == benchmark_id)
+
+
+def select_next_queued_job():
+    return (
+        BenchmarkJob.select()
+        .where(BenchmarkJob.status == JOB_STATUS_QUEUED)
+        .order_by(BenchmarkJob.submitted)
+        .first()
+    )
+
+
+def count_jobs(status):
+    return BenchmarkJob.select().where(BenchmarkJob.status == status).count()
+
+
+def get_queue_position(job):
+    """Returns the (1-based) position of a queued job in the queue"""
+    return (
+        BenchmarkJob.select()
+        .where(
+            BenchmarkJob.status == JOB_STATUS_QUEUED,
+            BenchmarkJob.submitted < job.submitted,
+        )
+        .count()
+        + 1
+    )
+
+
+def requeue_job(benchmark_id):
+    """Queues a benchmark that is done again, e.g. to resume it"""
+    BenchmarkJob.update(
+        status=JOB_STATUS_QUEUED, submitted=time.time(), started=None, worker_index=None
+    ).where(BenchmarkJob.benchmark_id == benchmark_id).execute()
+
+
+def update_job_status(benchmark_id, status, worker_index=None):
+    update = {BenchmarkJob.status: status}
+    if status == JOB_STATUS_RUNNING:
+        update[BenchmarkJob.started] = time.time()
+        update[BenchmarkJob.worker_index] = worker_index
+
+    BenchmarkJob.update(update).where(
+        BenchmarkJob.benchmark_id == benchmark_id
+    ).execute()
@@ -88,7 +88,7 @@ def health_check(request):
 
     assert ai_implementation == "babylon_toy_ai"
 
-    return {"status": "OK"}
+    return {"status": "OK", "capabilities": ["solve-cases"]}
 
 
 def solve_case(request):
@@ -98,3 +98,22 @@ def solve_case(request):
     assert ai_implementation == "babylon_toy_ai"
 
     return solve_case_by_symptom_intersection(case_data=case_data)
+
+
+def solve_cases(request):
+    """Solves a batch of cases, returning a result (or an error) for each of
+    them, in the same order"""
+    ai_implementation = request["aiImplementation"]
+
+    assert ai_implementation == "babylon_toy_ai"
+
+    results = []
+    for case_data in request["cases"]:
+        try:
+            results.append(
+                {"result": solve_case_by_symptom_intersection(case_data=case_data)}
+            )
+        except Exception as exc:
+            results.append({"error": {"code": type(exc).__name__, "message": str(exc)}})
+
+    return {"results": results}
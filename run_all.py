@@ -15,8 +15,10 @@ def change_directory(new_directory):
 def start_case_generator():
     change_directory(ORIGINAL_DIRECTORY + "/case_generator/")
     from app import create_app as case_generator__create_app
+    from app import start_shard_pool
 
     case_generator = case_generator__create_app()
+    start_shard_pool()
     case_generator.run(port=5001, host=CONFIG_DEFAULT_HOST)
 
 
@@ -31,8 +33,10 @@ def start_toy_ai():
 def start_evaluator():
     change_directory(ORIGINAL_DIRECTORY + "/evaluator/")
     from app import create_app as evaluator__create_app
+    from app import start_benchmark_service
 
     evaluator = evaluator__create_app()
+    start_benchmark_service()
     evaluator.run(port=5003, host=CONFIG_DEFAULT_HOST)
 
 
@@ -1,3 +1,4 @@
+import json
 import random
 
 import numpy as np
@@ -32,3 +33,131 @@ def test_generate_case():
     }
 
     assert DeepDiff(res, comp) == {}
+
+
+def test_generate_cases_batch():
+    cases = api.generate_cases_batch(1000, np.random.RandomState(42))
+
+    assert len(cases) == 1000
+    assert (
+        DeepDiff(cases, api.generate_cases_batch(1000, np.random.RandomState(42))) == {}
+    )
+
+    condition_probabilities = {
+        condition["id"]: condition["probability"]
+        for condition in api.DATA["conditions"]
+    }
+    for case in cases:
+        case_data = case["caseData"]
+        biological_sex = case_data["profileInformation"]["biologicalSex"]
+        condition_id = case["valuesToPredict"]["condition"]["id"]
+
+        assert api.MIN_AGE <= case_data["profileInformation"]["age"] <= api.MAX_AGE
+        assert condition_probabilities[condition_id][biological_sex] > 0.0
+        assert [
+            complaint["state"] for complaint in case_data["presentingComplaints"]
+        ] == ["present"]
+        assert all(
+            feature["state"] in api.EVIDENCE_STATES + ["unsure"]
+            for feature in case_data["otherFeatures"]
+        )
+
+
+def test_generate_cases_stream_is_reproducible():
+    def stream(num_workers):
+        response = api.generate_cases_stream(2500, seed=42, numWorkers=num_workers)
+        return "".join(response.response)
+
+    cases = stream(num_workers=1)
+
+    assert len(cases.splitlines()) == 2500
+
+    api.start_shard_pool()
+    try:
+        assert stream(num_workers=3) == cases
+        # More workers than CPUs is the same as one per CPU
+        assert stream(num_workers=api.MAX_NUM_WORKERS + 1) == cases
+    finally:
+        api.stop_shard_pool()
+
+
+def test_case_ids_are_unique():
+    response = api.generate_cases_stream(2500, seed=42, numWorkers=1)
+    case_ids = [
+        json.loads(line)["caseData"]["caseId"]
+        for line in "".join(response.response).splitlines()
+    ]
+
+    # Ids are derived from the seed and the index of the case, across shards
+    assert len(set(case_ids)) == len(case_ids)
+    assert (
+        case_ids[api.CASES_PER_SHARD] == api.get_case_ids(42, api.CASES_PER_SHARD, 1)[0]
+    )
+
+    cases = api.generate_cases_batch(1000)
+    assert len({case["caseData"]["caseId"] for case in cases}) == len(cases)
+
+
+def test_build_strata():
+    strata = api.build_strata(10, [(18, 49), (50, 80)])
+    num_strata = len(strata["counts"])
+
+    # Ectopic pregnancy is never sampled for male patients
+    assert num_strata == (2 * len(api.DATA["conditions"]) - 1) * 2
+    assert (strata["counts"] == 10).all()
+    assert np.isclose(strata["weights"].sum(), num_strata)
+
+    cases = api.generate_stratified_cases_batch(
+        strata, np.arange(num_strata), np.random.RandomState(42)
+    )
+    for case, min_age, max_age, weight in zip(
+        cases, strata["min_ages"], strata["max_ages"], strata["weights"]
+    ):
+        assert min_age <= case["caseData"]["profileInformation"]["age"] <= max_age
+        assert case["valuesToPredict"]["caseWeight"] == weight
+
+
+def test_build_strata_with_counts():
+    condition_id = api.DATA["conditions"][0]["id"]
+    stratum_counts = {
+        (condition_id, "female", (18, 49)): 30,
+        (condition_id, "male", (50, 80)): 0,
+    }
+    strata = api.build_strata(10, [(18, 49), (50, 80)], stratum_counts)
+    num_strata = len(strata["counts"])
+
+    assert strata["counts"][:4].tolist() == [10, 0, 30, 10]
+    assert strata["counts"].sum() == 10 * (num_strata - 2) + 30
+    # Weighted, the cases still add up to the prevalence of the strata they
+    # were generated for
+    assert strata["weights"][1] == 0
+    assert np.isclose(
+        (strata["weights"] * strata["counts"]).sum(), strata["counts"].sum()
+    )
+    uniform_strata = api.build_strata(10, [(18, 49), (50, 80)])
+    assert np.isclose(
+        strata["weights"][2] * 30 / (strata["weights"][3] * 10),
+        uniform_strata["weights"][2] / uniform_strata["weights"][3],
+    )
+
+    _, status = api.generate_stratified_cases_stream(
+        10, stratumCounts=[f"{condition_id}:male:18-30=5"]
+    )
+    assert status == 400
+    _, status = api.generate_stratified_cases_stream(
+        0, ageBands=["18-80"], stratumCounts=[f"{condition_id}:male:18-80=0"]
+    )
+    assert status == 400
+
+    response = api.generate_stratified_cases_stream(
+        0,
+        ageBands=["18-80"],
+        stratumCounts=[f"{condition_id}:male:18-80=3"],
+        seed=1,
+        numWorkers=1,
+    )
+    assert response.headers["X-Case-Count"] == "3"
+    cases = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert {case["valuesToPredict"]["condition"]["id"] for case in cases} == {
+        condition_id
+    }
@@ -1,15 +1,59 @@
+import heapq
 import json
 import os
 import random
+import shutil
+import sqlite3
 import sys
 import time
-from multiprocessing import Process
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Pipe, Process, Queue
+from threading import Event, Lock, Thread
 
 import numpy as np
+import pytest
+import requests
 from deepdiff import DeepDiff
 
 from config import CONFIG_DEFAULT_HOST
-from evaluator import api
+from evaluator import api, case_sets, catalog, jobs
+from evaluator.benchmark import result_log
+from evaluator.benchmark.admission import AdmissionController
+from evaluator.benchmark.circuit_breaker import CircuitBreaker
+from evaluator.benchmark.definitions import (
+    SOLVE_CASE_HARD_TIMEOUT,
+    SOLVE_CASES_CAPABILITY,
+    SOLVE_CASES_MAX_HARD_TIMEOUT,
+    CaseStatuses,
+    CircuitStates,
+    ExecutionModes,
+    HealthCheckPolicies,
+    RunnerEngines,
+)
+from evaluator.benchmark.event_log import BenchmarkEventLog, read_events
+from evaluator.benchmark.exceptions import AdmissionError, SetupError
+from evaluator.benchmark.log_buffer import LogBuffer
+from evaluator.benchmark.manager import BenchmarkManager
+from evaluator.benchmark.reporter import (
+    LEGACY_AI_REPORTS_TABLE_NAME,
+    DatabaseClient,
+    initialize_reports,
+)
+from evaluator.benchmark.result_cache import (
+    ResultCache,
+    compute_case_hash,
+    initialize_result_cache,
+)
+from evaluator.benchmark.runner import BenchmarkRunner
+from evaluator.benchmark.runner_policy import (
+    SolveRequest,
+    build_solve_case_result,
+    cache_solved_results,
+    fill_solve_cases_item_result,
+    get_cached_results,
+)
+from evaluator.benchmark.signals import ProcessSignal
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -90,6 +134,156 @@ AI_RESULTS = [
 ]
 
 
+def make_case_set(num_cases):
+    """Returns a case set of `num_cases` copies of the test cases, with
+    distinct case ids"""
+    return [
+        dict(
+            TEST_CASES[index % len(TEST_CASES)],
+            caseData=dict(
+                TEST_CASES[index % len(TEST_CASES)]["caseData"], caseId=f"case_{index}"
+            ),
+        )
+        for index in range(num_cases)
+    ]
+
+
+def solve_stub_case(case_data):
+    """Returns the answer of the stub AI to a case, always the same"""
+    return {
+        "triage": "PC",
+        "conditions": [{"id": case_data["caseId"], "name": "stub condition"}],
+    }
+
+
+class StubAIHandler(BaseHTTPRequestHandler):
+    """Answers the requests of the benchmark runners as an AI would, keeping
+    track of them and of the most solve requests in flight at once (by AI).
+    Solve requests take `delay` seconds, those of the cases whose id is in
+    `failing_case_ids` fail"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        data = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        endpoint = self.path.rsplit("/", 1)[-1]
+        ai_name = data["aiImplementation"]
+
+        with server.lock:
+            server.requests.append((endpoint, ai_name))
+
+        if endpoint == "health-check":
+            self.send_json({"status": "OK", "capabilities": [SOLVE_CASES_CAPABILITY]})
+            return
+
+        with server.lock:
+            server.in_flight[ai_name] = server.in_flight.get(ai_name, 0) + 1
+            server.max_in_flight[ai_name] = max(
+                server.max_in_flight.get(ai_name, 0), server.in_flight[ai_name]
+            )
+
+        time.sleep(server.delay)
+        status = 200
+        if endpoint == "solve-case":
+            response = solve_stub_case(data["caseData"])
+            if data["caseData"]["caseId"] in server.failing_case_ids:
+                status, response = 500, {"error": "Failed"}
+        else:
+            response = {
+                "results": [
+                    {"result": solve_stub_case(case_data), "elapsedTime": 0}
+                    for case_data in data["cases"]
+                ]
+            }
+
+        with server.lock:
+            server.in_flight[ai_name] -= 1
+
+        self.send_json(response, status)
+
+    def send_json(self, response, status=200):
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_ai():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubAIHandler)
+    server.daemon_threads = True
+    server.lock = Lock()
+    server.requests = []
+    server.in_flight = {}
+    server.max_in_flight = {}
+    server.delay = 0
+    server.failing_case_ids = set()
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def get_stub_ai_config(server, **options):
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    return dict(
+        {
+            "health_check": url + "health-check",
+            "solve_case": url + "solve-case",
+            "solve_cases": url + "solve-cases",
+        },
+        **options,
+    )
+
+
+def get_endpoints(server, ai_name):
+    return [endpoint for (endpoint, name) in server.requests if name == ai_name]
+
+
+def run_benchmark_manager(ai_configs, case_set, **options):
+    """Runs a benchmark in this process, returning its manager"""
+    manager = BenchmarkManager(time.time())
+    manager.setup(
+        "test_benchmark_" + api.get_unique_id(),
+        "test_case_set",
+        case_set,
+        ai_configs,
+        **options,
+    )
+    assert manager.run_benchmark() is not None
+
+    return manager
+
+
+def run_benchmark(ai_configs, case_set, **options):
+    """Runs a benchmark in this process, returning the results by AI"""
+    manager = run_benchmark_manager(ai_configs, case_set, **options)
+
+    return result_log.read_results_by_ai(manager.results_dir)
+
+
+class ResultQueue(list):
+    """Stands in for the result queue of the runners of a benchmark"""
+
+    def put(self, message):
+        self.append(message)
+
+
+@pytest.fixture(autouse=True)
+def evaluator_data_dir(tmp_path, monkeypatch):
+    """Every test gets a data directory (and databases) of its own"""
+    monkeypatch.setattr(case_sets, "DATA_DIR", str(tmp_path / "data"))
+    api.initialize_databases()
+
+
 def start_case_generator_server():
     sys.path.append(os.path.join(ROOT_DIR, "case_generator"))
     import case_generator.app
@@ -117,15 +311,901 @@ def test_generate_case_set():
         time.sleep(1)
         case_info = {"numCases": 2}
         res = api.generate_case_set(case_info)
-        with open(
-            os.path.join(
-                ROOT_DIR, "evaluator", "data", res["case_set_id"], "cases.json"
-            ),
-            "r",
-        ) as f:
+        with open(case_sets.get_cases_file_path(res["case_set_id"]), "r") as f:
             res = json.load(f)
         assert DeepDiff(res, TEST_CASES) == dict()
         p.terminate()
     except AssertionError:
         p.terminate()
         raise
+
+
+def test_streamed_case_set_storage():
+    case_set_id = "test_streamed_" + api.get_unique_id()
+    chunks = [
+        "".join(json.dumps(case) + "\n" for case in TEST_CASES[:1]).encode(),
+        "".join(json.dumps(case) + "\n" for case in TEST_CASES[1:]).encode(),
+    ]
+    try:
+        num_cases, checksum = case_sets.write_cases_ndjson(case_set_id, chunks)
+        assert num_cases == len(TEST_CASES)
+        assert checksum == api.md5(b"".join(chunks).decode())
+        assert DeepDiff(case_sets.load_cases(case_set_id), TEST_CASES) == dict()
+
+        case_set = case_sets.open_case_set(case_set_id)
+        assert isinstance(case_set, case_sets.CaseSetReader)
+        assert len(case_set) == len(TEST_CASES)
+        assert DeepDiff(case_set[1], TEST_CASES[1]) == dict()
+    finally:
+        shutil.rmtree(case_sets.get_case_set_path(case_set_id))
+
+
+def test_partial_streamed_case_set():
+    case_set_id = "test_partial_" + api.get_unique_id()
+    chunks = ["".join(json.dumps(case) + "\n" for case in TEST_CASES).encode()]
+
+    with pytest.raises(ValueError):
+        case_sets.write_cases_ndjson(
+            case_set_id, chunks, expected_num_cases=len(TEST_CASES) + 1
+        )
+    assert not os.path.exists(case_sets.get_case_set_path(case_set_id))
+
+    # Truncated in the middle of a case
+    with pytest.raises(ValueError):
+        case_sets.write_cases_ndjson(case_set_id, [chunks[0][:-10]])
+    assert not os.path.exists(case_sets.get_case_set_path(case_set_id))
+
+    def failing_chunks():
+        yield chunks[0]
+        raise IOError("Connection lost")
+
+    with pytest.raises(IOError):
+        case_sets.write_cases_ndjson(case_set_id, failing_chunks())
+    assert not os.path.exists(case_sets.get_case_set_path(case_set_id))
+
+
+def test_case_set_catalog():
+    case_set_id = "test_catalog_" + api.get_unique_id()
+    chunks = ["".join(json.dumps(case) + "\n" for case in TEST_CASES).encode()]
+    try:
+        _, checksum = case_sets.write_cases_ndjson(case_set_id, chunks)
+        catalog.register_case_set(case_set_id, checksum=checksum)
+
+        entry = catalog.select_case_set(case_set_id).to_dict()
+        assert entry["num_cases"] == len(TEST_CASES)
+        assert entry["byte_size"] == len(chunks[0])
+        assert entry["source"] == catalog.CASE_SET_SOURCE_SYNTHETIC
+        assert entry["checksum"] == catalog.compute_checksum(
+            case_sets.get_cases_file_path(case_set_id)
+        )
+
+        listed = api.list_case_sets(limit=1, source=catalog.CASE_SET_SOURCE_SYNTHETIC)
+        assert listed["existing_case_sets"] == [entry]
+
+        listed = api.list_case_sets(source=catalog.CASE_SET_SOURCE_DOCTOR_CASES)
+        assert [element["id"] for element in listed["existing_case_sets"]] == [
+            "london_model2019_cases_v1"
+        ]
+    finally:
+        catalog.CaseSetEntry.delete_by_id(case_set_id)
+        shutil.rmtree(case_sets.get_case_set_path(case_set_id))
+
+
+def test_benchmark_job_errors():
+    _, status = api.run_case_set_against_ais(
+        {"caseSetId": "london_model2019_cases_v1", "aiImplementations": ["no_ai"]}
+    )
+    assert status == 400
+
+    _, status = api.report_update({"benchmarkId": "no_benchmark"})
+    assert status == 404
+
+    _, status = api.stream_benchmark_events("no_benchmark")
+    assert status == 404
+
+
+def test_generate_case_set_errors():
+    _, status = api.generate_case_set({"casesPerStratum": 2})
+    assert status == 400
+
+    _, status = api.generate_case_set({"sampling": "stratified", "numCases": 2})
+    assert status == 400
+
+    _, status = api.generate_case_set({"numCases": 2, "seed": 1, "streamed": False})
+    assert status == 400
+
+
+def test_streamed_case_set_generator_errors(monkeypatch):
+    # Nothing listens on the port
+    monkeypatch.setattr(api, "SERVER_HOST_FOR_CASE_GENERATION", "http://127.0.0.1:9")
+    _, status = api.generate_case_set({"numCases": 2, "seed": 1})
+    assert status == 503
+
+    def get_response(status_code, content):
+        def get(url, **kwargs):
+            response = requests.Response()
+            response.status_code = status_code
+            response._content = content
+            return response
+
+        return get
+
+    # Requests the case generator rejects are answered with its status
+    monkeypatch.setattr(
+        api.requests,
+        "get",
+        get_response(400, b'{"code": "400", "message": "Invalid age bands"}'),
+    )
+    response, status = api.generate_case_set(
+        {"sampling": "stratified", "casesPerStratum": 1, "ageBands": ["60-18"]}
+    )
+    assert status == 400
+    assert response["message"] == "Case set not generated: Invalid age bands"
+
+    monkeypatch.setattr(api.requests, "get", get_response(500, b"Crashed"))
+    response, status = api.generate_case_set({"numCases": 2, "seed": 1})
+    assert status == 502
+    assert response["message"] == "Case set not generated: Crashed"
+
+
+def test_report_update_of_done_benchmarks(monkeypatch):
+    benchmark_id = "test_update_" + api.get_unique_id()
+    request = {"caseSetId": "london_model2019_cases_v1", "aiImplementations": []}
+    commands = []
+
+    def send_worker_command(worker, command):
+        commands.append(command)
+        return "Unknown"
+
+    monkeypatch.setattr(api, "BENCHMARK_WORKERS", [{}])
+    monkeypatch.setattr(api, "send_worker_command", send_worker_command)
+    try:
+        jobs.enqueue_job(benchmark_id, request)
+        jobs.update_job_status(benchmark_id, jobs.JOB_STATUS_RUNNING, 0)
+
+        # E.g. its worker was killed before it reported anything
+        jobs.update_job_status(benchmark_id, jobs.JOB_STATUS_FAILED)
+        update = api.report_update({"benchmarkId": benchmark_id})
+        assert update["status"] == jobs.JOB_STATUS_FAILED
+        assert update["message"] == f"Benchmark {benchmark_id} failed"
+        assert update["results_by_ai"] == {}
+
+        # Its results were sent with its last update
+        jobs.update_job_status(benchmark_id, jobs.JOB_STATUS_FINISHED)
+        _, status = api.report_update({"benchmarkId": benchmark_id})
+        assert status == 410
+        assert [command[0] for command in commands] == ["GetUpdate", "GetUpdate"]
+    finally:
+        jobs.BenchmarkJob.delete_by_id(benchmark_id)
+
+
+def test_select_cases():
+    page = case_sets.select_cases(TEST_CASES, offset=1, limit=1, fields=["caseData"])
+    assert DeepDiff(page, [{"caseData": TEST_CASES[1]["caseData"]}]) == dict()
+
+    page = case_sets.select_cases(TEST_CASES, biological_sex="male", max_age=30)
+    assert DeepDiff(page, TEST_CASES[:1]) == dict()
+
+    page = case_sets.select_cases(
+        TEST_CASES, presenting_complaint="1e400ff9b77134121117183e3fc9b7a2"
+    )
+    assert DeepDiff(page, TEST_CASES[1:]) == dict()
+
+    assert case_sets.select_cases(TEST_CASES, min_age=26) == []
+
+
+def test_case_set_cache():
+    case_set_ids = [
+        "test_cache_" + str(index) + api.get_unique_id() for index in range(2)
+    ]
+    cache = case_sets.CaseSetCache(max_cases=len(TEST_CASES))
+    try:
+        for case_set_id in case_set_ids:
+            os.makedirs(case_sets.get_case_set_path(case_set_id))
+            with open(case_sets.get_cases_file_path(case_set_id), "w") as cases_file:
+                json.dump(TEST_CASES, cases_file)
+
+        case_set = cache.get(case_set_ids[0])
+        assert cache.get(case_set_ids[0]) is case_set
+        assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+        # Both case sets do not fit in the cache at the same time
+        cache.get(case_set_ids[1])
+        assert cache.stats()["evictions"] == 1
+        assert cache.get(case_set_ids[0]) is not case_set
+        assert cache.stats() == {
+            "hits": 1,
+            "misses": 3,
+            "evictions": 2,
+            "cached_case_sets": 1,
+            "cached_cases": len(TEST_CASES),
+        }
+    finally:
+        for case_set_id in case_set_ids:
+            shutil.rmtree(case_sets.get_case_set_path(case_set_id))
+
+
+def test_circuit_breaker():
+    circuit_breaker = CircuitBreaker(
+        window_size=4, min_cases=4, max_error_rate=0.5, cooldown=0.1
+    )
+
+    for error in [False, True, False]:
+        assert circuit_breaker.allow_case()
+        assert circuit_breaker.record(error=error) == CircuitStates.CLOSED
+
+    # 2 errors out of the last 4 cases
+    assert circuit_breaker.record(error=True) == CircuitStates.OPEN
+    assert not circuit_breaker.allow_case()
+
+    # A single trial case is let through once the cooldown is over
+    time.sleep(0.1)
+    assert circuit_breaker.allow_case()
+    assert circuit_breaker.state == CircuitStates.HALF_OPEN
+    assert not circuit_breaker.allow_case()
+    assert circuit_breaker.record(timeout=True) == CircuitStates.OPEN
+
+    time.sleep(0.1)
+    assert circuit_breaker.allow_case()
+    assert circuit_breaker.record() == CircuitStates.CLOSED
+    assert circuit_breaker.allow_case()
+
+
+def test_admission_controller():
+    controller = AdmissionController(
+        {"limited_ai": {"max_in_flight": 1}, "unlimited_ai": {}}, num_slots=2
+    )
+    admitted = []
+
+    def admit(slot):
+        admitted.append((slot, controller.acquire("limited_ai", slot)))
+
+    ticket = controller.acquire("limited_ai", 0)
+    assert controller.acquire("unlimited_ai", 0) is None
+
+    # Slot 0 waits first, but slot 1 is admitted first as it is its turn
+    waiters = [Thread(target=admit, args=(slot,)) for slot in [0, 1]]
+    for waiter in waiters:
+        waiter.start()
+        time.sleep(0.1)
+    assert controller.get_stats()["limited_ai"] == {"in_flight": 1, "waiting": 2}
+
+    controller.release("limited_ai", 0, ticket)
+    waiters[1].join(timeout=1)
+    assert [slot for (slot, _) in admitted] == [1]
+
+    controller.release("limited_ai", 1, admitted[0][1])
+    waiters[0].join(timeout=1)
+    assert [slot for (slot, _) in admitted] == [1, 0]
+
+    controller.reset_slot(0)
+    assert controller.get_stats()["limited_ai"] == {"in_flight": 0, "waiting": 0}
+
+    # Requests of a slot from before it was reset are not accounted for in
+    # the next benchmark run in it: released...
+    ticket = controller.acquire("limited_ai", 1)
+    controller.release("limited_ai", 0, admitted[1][1])
+    assert controller.get_stats()["limited_ai"] == {"in_flight": 1, "waiting": 0}
+
+    # ... or still waiting
+    errors = []
+
+    def wait(slot, cancelled=None):
+        try:
+            controller.acquire("limited_ai", slot, cancelled)
+        except AdmissionError as exc:
+            errors.append(str(exc))
+
+    waiter = Thread(target=wait, args=(0,))
+    waiter.start()
+    time.sleep(0.1)
+    controller.reset_slot(0)
+    waiter.join(timeout=1)
+    assert errors == ["Slot 0 was reset"]
+
+    # Cancelled requests stop waiting
+    cancelled = Event()
+    waiter = Thread(target=wait, args=(0, cancelled))
+    waiter.start()
+    time.sleep(0.1)
+    cancelled.set()
+    controller.wake_up(0)
+    waiter.join(timeout=1)
+    assert errors[1] == "Request to AI limited_ai cancelled"
+    assert controller.get_stats()["limited_ai"] == {"in_flight": 1, "waiting": 0}
+
+    # The state locked by a killed process is unlocked
+    def lock_and_die():
+        controller.states["limited_ai"].lock.acquire()
+        controller.states["limited_ai"].lock_owner.value = os.getpid()
+        os._exit(0)
+
+    process = Process(target=lock_and_die)
+    process.start()
+    process.join()
+    controller.release_abandoned_locks()
+    controller.release("limited_ai", 1, ticket)
+    assert controller.get_stats()["limited_ai"] == {"in_flight": 0, "waiting": 0}
+
+    # 1 request, then 1 more every 1/20 sec
+    controller = AdmissionController({"ai": {"rate_limit": 20}}, num_slots=1)
+    start = time.time()
+    for _ in range(3):
+        controller.acquire("ai", 0)
+    assert time.time() - start >= 0.09
+
+
+def test_benchmark_result_log(tmp_path):
+    class AIReport(object):
+        healthcheck_status = CaseStatuses.OK
+        case_status = CaseStatuses.OK
+        health_checks = 1
+        errors = 0
+        soft_timeouts = 0
+        hard_timeouts = 0
+
+    results_dir = str(tmp_path / "benchmark")
+    case_ids = [case["caseData"]["caseId"] for case in TEST_CASES]
+    log = result_log.BenchmarkResultLog(results_dir)
+    # Results are appended as they arrive, not in case set order
+    for case_num in reversed(range(len(TEST_CASES))):
+        log.append(
+            case_num,
+            case_ids[case_num],
+            "toy_ai",
+            {"result": AI_RESULTS[case_num]},
+            AIReport(),
+        )
+    log.close()
+
+    # The run stopped while a pair was being written
+    with open(log.path, "a") as log_file:
+        log_file.write('{"case_num": 0, "case_')
+
+    log = result_log.BenchmarkResultLog(results_dir)
+    assert len(log) == len(TEST_CASES)
+    assert log.is_done(0, "toy_ai")
+    assert not log.is_done(0, "other_ai")
+    assert sorted(log.get_done_case_nums("toy_ai")) == [0, 1]
+    records = list(log.iter_records())
+    assert [record["case_num"] for record in records] == [1, 0]
+    assert records[0]["report"]["health_checks"] == AIReport.health_checks
+
+    log.append(0, case_ids[0], "other_ai", {"result": {}}, AIReport())
+    log.close()
+    assert result_log.read_results_by_ai(results_dir) == {
+        "toy_ai": AI_RESULTS,
+        "other_ai": [{}],
+    }
+
+    assert len(result_log.BenchmarkResultLog(results_dir, resume=False)) == 0
+    assert result_log.read_results_by_ai(results_dir) == {}
+
+
+def test_benchmark_event_log(tmp_path):
+    results_dir = str(tmp_path / "benchmark")
+    event_log = BenchmarkEventLog(results_dir)
+    event_log.append("case-started", {"case_index": 1})
+    event_log.append("log", {"message": "Starting health checks"})
+    event_log.close()
+
+    with open(event_log.path, "rb") as events_file:
+        events = list(read_events(events_file, 0))
+        assert [event for (_, event, _) in events] == ["case-started", "log"]
+        assert events[0][2] == {"case_index": 1}
+
+        # The id of an event is where the events after it start
+        next_events = list(read_events(events_file, events[0][0]))
+        assert [event for (_, event, _) in next_events] == ["log"]
+
+    # The run stopped while an event was being written
+    with open(event_log.path, "a") as events_file:
+        events_file.write('{"event": "lo')
+
+    event_log = BenchmarkEventLog(results_dir)
+    event_log.append("ai-result", {"case_index": 1})
+    event_log.close()
+    with open(event_log.path, "rb") as events_file:
+        resumed_events = list(read_events(events_file, events[-1][0]))
+        assert [event for (_, event, _) in resumed_events] == ["ai-result"]
+
+
+def test_log_buffer(tmp_path):
+    results_dir = str(tmp_path / "benchmark")
+    messages = [f"message #{index}" for index in range(10)]
+    log_buffer = LogBuffer(results_dir, size=3)
+    for message in messages:
+        log_buffer.append(message)
+
+    # Only the last lines are kept in memory, the others are read from disk
+    assert list(log_buffer.lines) == messages[7:]
+    assert log_buffer.read(0) == messages
+    assert log_buffer.read(4, limit=4) == messages[4:8]
+    assert log_buffer.read(8) == messages[8:]
+    assert log_buffer.read(10) == []
+    log_buffer.close()
+
+    # The lines of a resumed benchmark come after those of its previous runs
+    log_buffer = LogBuffer(results_dir, size=3)
+    log_buffer.append("resumed")
+    assert len(log_buffer) == 11
+    assert log_buffer.read(9) == [messages[9], "resumed"]
+    log_buffer.close()
+
+    assert len(LogBuffer(results_dir, resume=False)) == 0
+
+
+def test_result_cache():
+    assert ResultCache.from_ai_config("toy_ai", {"version": "1"}) is None
+
+    case_data = TEST_CASES[0]["caseData"]
+    reordered_case_data = json.loads(json.dumps(case_data, sort_keys=True))
+    assert compute_case_hash(reordered_case_data) == compute_case_hash(case_data)
+
+    initialize_result_cache()
+    ai_name = "test_cache_ai_" + api.get_unique_id()
+    result_cache = ResultCache.from_ai_config(
+        ai_name, {"deterministic": True, "version": "1", "result_cache": {"ttl": 1}}
+    )
+    cases = list(enumerate(TEST_CASES))
+    assert get_cached_results(result_cache, ai_name, cases) == {}
+
+    return_dicts = [
+        build_solve_case_result(ai_name, case_num, "case") for case_num, _ in cases
+    ]
+    for (return_dict, result) in zip(return_dicts, AI_RESULTS):
+        return_dict["result"] = result
+    return_dicts[0]["case_status"] = CaseStatuses.OK
+    return_dicts[1]["case_status"] = CaseStatuses.ERROR
+    cache_solved_results(result_cache, cases, return_dicts)
+
+    # Only successful results are cached, and only for this version of the AI
+    cached_results = get_cached_results(result_cache, ai_name, cases)
+    assert list(cached_results) == [0]
+    assert cached_results[0]["cached"]
+    assert cached_results[0]["result"] == AI_RESULTS[0]
+    assert ResultCache(ai_name, "2").get(case_data) is None
+
+    # The same case in another case set has the same result
+    assert result_cache.get(dict(case_data, caseId="other_case")) == AI_RESULTS[0]
+
+    # Least recently used results are evicted
+    ResultCache(ai_name, "1", max_entries=1).put(TEST_CASES[1]["caseData"], {})
+    assert result_cache.get(case_data) is None
+    assert result_cache.get(TEST_CASES[1]["caseData"]) == {}
+
+    time.sleep(1)
+    assert result_cache.get(TEST_CASES[1]["caseData"]) is None
+
+
+def test_ai_reports_since_cursor():
+    database_client = DatabaseClient()
+    benchmark_id = "test_benchmark_" + api.get_unique_id()
+    manager_report = database_client.create_manager_report(benchmark_id, "case_set", 2)
+    report_data = {
+        "healthcheck_status": CaseStatuses.OK,
+        "health_checks": 1,
+        "errors": 0,
+        "soft_timeouts": 0,
+        "hard_timeouts": 0,
+    }
+    # Reports are keyed by case number, case ids are not unique in every
+    # case set
+    for case_num in [0, 1]:
+        database_client.create_ai_report(
+            manager_report, "toy_ai", case_num, "case", report_data
+        )
+
+    reports = database_client.select_ai_reports_since(manager_report, 0)
+    assert [report.case_num for report in reports] == [0, 1]
+    cursor = reports[-1].sequence
+    assert database_client.select_ai_reports_since(manager_report, cursor) == []
+
+    database_client.update_ai_report(
+        manager_report, "toy_ai", 0, CaseStatuses.ERROR, error=True
+    )
+    reports = database_client.select_ai_reports_since(manager_report, cursor)
+    assert [report.case_num for report in reports] == [0]
+    assert database_client.summarize_ai_reports(manager_report) == {
+        "toy_ai": {"cases_done": 1, "errors": 1, "timeouts": 0}
+    }
+
+    # The report of a resumed benchmark is rebuilt, after the rows of the
+    # previous run
+    cursor = reports[-1].sequence
+    database_client = DatabaseClient()
+    manager_report = database_client.create_manager_report(benchmark_id, "case_set", 2)
+    database_client.create_ai_reports(
+        manager_report, [("toy_ai", 0, "case", dict(report_data, errors=1))]
+    )
+    reports = database_client.select_ai_reports_since(manager_report, cursor)
+    assert [report.case_num for report in reports] == [0]
+    assert reports[0].case_status == CaseStatuses.ERROR
+
+    assert database_client.delete_manager_report(benchmark_id=benchmark_id)
+    assert database_client.select_manager_report(benchmark_id) is None
+    assert database_client.select_ai_reports_since(benchmark_id, 0) == []
+
+
+def test_report_database_migration(tmp_path, monkeypatch):
+    # Restarting the evaluator keeps the reports
+    database_client = DatabaseClient()
+    benchmark_id = "test_benchmark_" + api.get_unique_id()
+    database_client.create_manager_report(benchmark_id, "case_set", 2)
+    initialize_reports()
+    assert database_client.select_manager_report(benchmark_id) is not None
+
+    # A database of the first shared schema, keyed by case id, and one of the
+    # databases per benchmark that came before it
+    data_dir = tmp_path / "legacy_data"
+    data_dir.mkdir()
+    monkeypatch.setattr(case_sets, "DATA_DIR", str(data_dir))
+    connection = sqlite3.connect(str(data_dir / "reports.db"))
+    connection.executescript(
+        """
+        CREATE TABLE manager_reports (
+            benchmark_id VARCHAR(255) NOT NULL PRIMARY KEY,
+            case_set_id VARCHAR(255) NOT NULL,
+            total_cases INTEGER NOT NULL,
+            current_case_index INTEGER NOT NULL,
+            current_case_id VARCHAR(255));
+        CREATE TABLE ai_reports (
+            manager_report_id VARCHAR(255) NOT NULL,
+            ai_name VARCHAR(255) NOT NULL,
+            case_id VARCHAR(255) NOT NULL,
+            healthcheck_status INTEGER NOT NULL,
+            case_status INTEGER NOT NULL,
+            health_checks INTEGER NOT NULL,
+            errors INTEGER NOT NULL,
+            soft_timeouts INTEGER NOT NULL,
+            hard_timeouts INTEGER NOT NULL,
+            sequence INTEGER NOT NULL,
+            PRIMARY KEY (manager_report_id, ai_name, case_id));
+        CREATE INDEX aireport_manager_report_id ON ai_reports (manager_report_id);
+        CREATE INDEX aireport_manager_report_id_sequence
+            ON ai_reports (manager_report_id, sequence);
+        INSERT INTO manager_reports VALUES ('old', 'case_set', 1, 0, 'case');
+        INSERT INTO ai_reports VALUES ('old', 'toy_ai', 'case', 1, 1, 1, 0, 0, 0, 1);
+        """
+    )
+    connection.commit()
+    connection.close()
+    (data_dir / "reports_1_5.db").write_bytes(b"")
+
+    initialize_reports()
+    initialize_reports()
+    assert os.path.isfile(data_dir / "reports_1_5.db")
+    assert database_client.select_manager_report("old") is not None
+    assert database_client.select_ai_reports_since("old", 0) == []
+    connection = sqlite3.connect(str(data_dir / "reports.db"))
+    assert connection.execute("PRAGMA user_version").fetchone() == (2,)
+    assert connection.execute(
+        f"SELECT ai_name, case_id FROM {LEGACY_AI_REPORTS_TABLE_NAME}"
+    ).fetchall() == [("toy_ai", "case")]
+    connection.close()
+
+    # The reports of the next runs are keyed by case number
+    report_data = {
+        "healthcheck_status": CaseStatuses.OK,
+        "health_checks": 1,
+        "errors": 0,
+        "soft_timeouts": 0,
+        "hard_timeouts": 0,
+    }
+    manager_report = database_client.create_manager_report("old", "case_set", 2)
+    database_client.create_ai_reports(
+        manager_report,
+        [("toy_ai", case_num, "case", report_data) for case_num in [0, 1]],
+    )
+    reports = database_client.select_ai_reports_since(manager_report, 0)
+    assert [report.case_num for report in reports] == [0, 1]
+
+
+def test_fill_solve_cases_item_result():
+    # Timeouts follow the longest of the time the AI reports and the share of
+    # the case in the time measured by the evaluator
+    items = [
+        {"result": {"triage": "PC", "conditions": []}, "elapsedTime": 11},
+        {"result": {"triage": "SC", "conditions": []}, "elapsedTime": 0.1},
+        {"result": {"triage": "EC", "conditions": []}, "elapsedTime": 0.1},
+        {"error": {"code": "Error", "message": "Failed"}},
+        {"result": {"triage": "SC", "conditions": []}, "elapsedTime": 6},
+        {"result": {"triage": "SC", "conditions": []}, "elapsedTime": "slow"},
+    ]
+    elapsed_times = [1, 6, 11, 1, 1, 1]
+    return_dicts = [
+        build_solve_case_result("toy_ai", index, "case_" + str(index))
+        for index in range(len(items))
+    ]
+    for return_dict, item, elapsed_time in zip(return_dicts, items, elapsed_times):
+        fill_solve_cases_item_result(return_dict, item, elapsed_time)
+
+    assert [return_dict["case_status"] for return_dict in return_dicts] == [
+        CaseStatuses.ERROR,
+        CaseStatuses.OK,
+        CaseStatuses.ERROR,
+        CaseStatuses.ERROR,
+        CaseStatuses.OK,
+        CaseStatuses.OK,
+    ]
+    assert return_dicts[0]["hard_timeout"] and return_dicts[0]["result"] == {}
+    assert return_dicts[0]["reported_elapsed_time"] == 11
+    assert return_dicts[1]["soft_timeout"] and not return_dicts[1]["hard_timeout"]
+    assert return_dicts[2]["hard_timeout"] and return_dicts[2]["result"] == {}
+    assert not return_dicts[3]["soft_timeout"] and return_dicts[3]["error"]
+    assert return_dicts[4]["soft_timeout"] and not return_dicts[4]["hard_timeout"]
+    assert return_dicts[4]["result"] == items[4]["result"]
+    assert not return_dicts[5]["soft_timeout"] and not return_dicts[5]["hard_timeout"]
+    assert "reported_elapsed_time" not in return_dicts[5]
+
+
+def test_solve_request_batch_timeout():
+    ai_config = {
+        "solve_case": "http://ai/solve-case",
+        "solve_cases": "http://ai/solve-cases",
+    }
+    cases = list(enumerate(make_case_set(50)))
+
+    # The deadline of a batch grows with its number of cases, up to a cap
+    assert SolveRequest("toy_ai", ai_config, cases[:1]).timeout == (
+        SOLVE_CASE_HARD_TIMEOUT
+    )
+    assert SolveRequest("toy_ai", ai_config, cases[:2]).timeout == (
+        2 * SOLVE_CASE_HARD_TIMEOUT
+    )
+    assert SolveRequest("toy_ai", ai_config, cases).timeout == (
+        SOLVE_CASES_MAX_HARD_TIMEOUT
+    )
+
+    # A batch answered after its deadline is a hard timeout for every case,
+    # even though the share of each case is below the timeout of a case
+    request = SolveRequest("toy_ai", ai_config, cases[:10])
+    response_data = json.dumps(
+        {
+            "results": [
+                {"result": {"triage": "SC", "conditions": []}, "elapsedTime": 0.1}
+                for _ in range(10)
+            ]
+        }
+    )
+    request.complete(200, response_data, SOLVE_CASES_MAX_HARD_TIMEOUT + 1)
+    assert all(
+        return_dict["hard_timeout"] and return_dict["case_status"] == CaseStatuses.ERROR
+        for return_dict in request.return_dicts
+    )
+
+    request = SolveRequest("toy_ai", ai_config, cases[:10])
+    request.complete(200, response_data, SOLVE_CASES_MAX_HARD_TIMEOUT - 1)
+    assert [return_dict["case_status"] for return_dict in request.return_dicts] == [
+        CaseStatuses.OK
+    ] * 10
+
+
+def test_circuit_breaker_with_batches(monkeypatch):
+    ai_config = {
+        "health_check": "http://ai/health-check",
+        "solve_case": "http://ai/solve-case",
+        "solve_cases": "http://ai/solve-cases",
+        "capabilities": [SOLVE_CASES_CAPABILITY],
+        "batch_size": 10,
+        "circuit_breaker": {"cooldown": 0},
+    }
+    out_queue = ResultQueue()
+    runner = BenchmarkRunner(
+        "faulty_ai",
+        ai_config,
+        None,
+        out_queue,
+        0,
+        time.time(),
+        case_set=make_case_set(200),
+        circuit_breaker=True,
+    )
+
+    batch_sizes = []
+
+    def perform_request(url, data=None, **kwargs):
+        batch_sizes.append(len(data.get("cases", [data])))
+        raise requests.ConnectionError("AI unreachable")
+
+    monkeypatch.setattr(runner, "is_healthy", lambda case_num, case_id: True)
+    monkeypatch.setattr(runner, "is_orphaned", lambda: False)
+    monkeypatch.setattr(runner, "_perform_request", perform_request)
+    runner.run_case_set()
+
+    # Once the circuit opened, each trial case is sent on its own instead of
+    # waiting for a batch the circuit never lets fill up
+    assert batch_sizes == [10] + [1] * 190
+    results = [result for (signal, _, result) in out_queue if result is not None]
+    assert CaseStatuses.CIRCUIT_OPEN not in [
+        result["case_status"] for result in results
+    ]
+    assert out_queue[-1][0] == ProcessSignal.CASE_SET_DONE
+
+
+@pytest.mark.parametrize("runner_engine", RunnerEngines)
+def test_pipelined_and_lockstep_results(stub_ai, runner_engine):
+    case_set = make_case_set(25)
+    ai_configs = {
+        "stub_ai": get_stub_ai_config(stub_ai),
+        "other_stub_ai": get_stub_ai_config(stub_ai),
+    }
+    expected_results = [solve_stub_case(case["caseData"]) for case in case_set]
+
+    # Both modes get the same results, in case set order
+    for execution_mode in ExecutionModes:
+        stub_ai.requests.clear()
+        results_by_ai = run_benchmark(
+            ai_configs,
+            case_set,
+            execution_mode=execution_mode,
+            runner_engine=runner_engine,
+        )
+        assert results_by_ai == {ai_name: expected_results for ai_name in ai_configs}
+
+        # Lockstep runners send the cases one at a time, pipelined ones in
+        # batches to the AIs that can solve them
+        endpoints = get_endpoints(stub_ai, "stub_ai")
+        if execution_mode == ExecutionModes.LOCKSTEP:
+            assert endpoints.count("solve-case") == len(case_set)
+            assert "solve-cases" not in endpoints
+        else:
+            assert endpoints.count("solve-cases") == 3
+
+
+@pytest.mark.parametrize("runner_engine", RunnerEngines)
+def test_solve_case_concurrency(stub_ai, runner_engine):
+    stub_ai.delay = 0.1
+    case_set = make_case_set(16)
+    ai_configs = {
+        "stub_ai": get_stub_ai_config(stub_ai, concurrency=4, batch_size=1),
+        "other_stub_ai": get_stub_ai_config(stub_ai, batch_size=1),
+    }
+
+    results_by_ai = run_benchmark(
+        ai_configs,
+        case_set,
+        execution_mode=ExecutionModes.PIPELINED,
+        runner_engine=runner_engine,
+    )
+    assert results_by_ai["stub_ai"] == results_by_ai["other_stub_ai"]
+    assert results_by_ai["stub_ai"] == [
+        solve_stub_case(case["caseData"]) for case in case_set
+    ]
+
+    # Each AI is sent up to its own number of requests at once
+    assert 1 < stub_ai.max_in_flight["stub_ai"] <= 4
+    assert stub_ai.max_in_flight["other_stub_ai"] == 1
+
+
+@pytest.mark.parametrize("runner_engine", RunnerEngines)
+def test_connection_reuse(stub_ai, runner_engine):
+    stub_ai.delay = 0.05
+    case_set = make_case_set(24)
+    ai_configs = {
+        "stub_ai": get_stub_ai_config(stub_ai, concurrency=2, pool_size=3, batch_size=1)
+    }
+
+    manager = run_benchmark_manager(
+        ai_configs,
+        case_set,
+        execution_mode=ExecutionModes.PIPELINED,
+        runner_engine=runner_engine,
+    )
+
+    # Every request of the session goes over one of at most `pool_size`
+    # connections, kept alive between requests
+    connection_stats = manager.connection_stats["stub_ai"]
+    assert connection_stats["requests"] == len(stub_ai.requests)
+    assert 1 <= connection_stats["connections"] <= 3
+    assert connection_stats["reused_connections"] >= len(case_set) - 3
+
+
+def test_connection_counting_urllib3_internals(monkeypatch):
+    class PoolManager(object):
+        def __init__(self, *args, **kwargs):
+            pass
+
+    runner = BenchmarkRunner(
+        "toy_ai",
+        {"solve_case": "http://ai/solve-case"},
+        None,
+        ResultQueue(),
+        0,
+        time.time(),
+        case_set=make_case_set(1),
+    )
+
+    # Connections could not be counted
+    monkeypatch.setattr(requests.adapters, "PoolManager", PoolManager)
+    with pytest.raises(SetupError):
+        runner._get_session("http://ai/solve-case")
+
+
+@pytest.mark.parametrize("runner_engine", RunnerEngines)
+def test_health_check_policies(stub_ai, runner_engine):
+    stub_ai.failing_case_ids = {"case_2"}
+    case_set = make_case_set(6)
+    ai_configs = {"stub_ai": get_stub_ai_config(stub_ai)}
+
+    for health_check_policy in HealthCheckPolicies:
+        stub_ai.requests.clear()
+        results_by_ai = run_benchmark(
+            ai_configs,
+            case_set,
+            runner_engine=runner_engine,
+            health_check_policy=health_check_policy,
+        )
+        assert len(results_by_ai["stub_ai"]) == len(case_set)
+
+        # The cached health status is reused until a case fails
+        num_health_checks = get_endpoints(stub_ai, "stub_ai").count("health-check")
+        if health_check_policy == HealthCheckPolicies.PER_CASE:
+            assert num_health_checks == len(case_set)
+        else:
+            assert num_health_checks == 2
+
+
+def test_benchmark_deadlines(monkeypatch):
+    benchmark_id = "test_deadline_" + api.get_unique_id()
+    jobs.enqueue_job(benchmark_id, {"caseSetId": "case_set"})
+    jobs.update_job_status(benchmark_id, jobs.JOB_STATUS_RUNNING, 0)
+
+    process = Process(target=time.sleep, args=(60,))
+    process.start()
+    events_reader, events_writer = Pipe(duplex=False)
+    events_writer.close()
+    worker = {
+        "process": process,
+        "exit_handle": process.sentinel,
+        "events": events_reader,
+        "events_open": True,
+        "benchmark_id": benchmark_id,
+    }
+    monkeypatch.setattr(api, "BENCHMARK_WORKERS", [worker])
+    monkeypatch.setattr(api, "BENCHMARK_DEADLINES", [])
+    monkeypatch.setattr(api, "LIFECYCLE_METRICS", Counter())
+    monkeypatch.setattr(api, "ADMISSION_CONTROLLER", AdmissionController({}, 1))
+    monkeypatch.setattr(api, "start_benchmark_worker", lambda worker_index: None)
+
+    # The deadline of a benchmark that already finished on the worker is
+    # dropped
+    heapq.heappush(api.BENCHMARK_DEADLINES, (time.time() - 1, "finished", 0))
+    heapq.heappush(api.BENCHMARK_DEADLINES, (time.time() + 60, benchmark_id, 0))
+    assert 50 < api.expire_deadlines() <= 60
+    assert process.is_alive()
+
+    api.BENCHMARK_DEADLINES[:] = [(time.time() - 1, benchmark_id, 0)]
+    assert api.expire_deadlines() is None
+    process.join(timeout=10)
+    assert process.exitcode is not None
+    assert api.LIFECYCLE_METRICS["deadlines_expired"] == 1
+
+    # The worker is restarted and its benchmark failed
+    api.handle_worker_exit(0)
+    assert jobs.select_job(benchmark_id).status == jobs.JOB_STATUS_FAILED
+    assert api.LIFECYCLE_METRICS["worker_exits"] == 1
+    assert api.BENCHMARK_WORKERS == [None]
+
+
+def run_orphaned_runner(exit_writer):
+    """Starts a runner, then exits without terminating it, as a killed
+    benchmark worker would"""
+    _, runner_conn = Pipe()
+    runner = BenchmarkRunner("stub_ai", {}, runner_conn, Queue(), 0, time.time())
+    runner.start()
+    os._exit(0)
+
+
+def test_orphaned_runner_exits():
+    exit_reader, exit_writer = Pipe(duplex=False)
+    worker = Process(target=run_orphaned_runner, args=(exit_writer,))
+    worker.start()
+    exit_writer.close()
+    worker.join()
+
+    # The runner inherited the pipe: its end is closed once the runner exited
+    # as well
+    assert exit_reader.poll(timeout=10)
+    with pytest.raises(EOFError):
+        exit_reader.recv()
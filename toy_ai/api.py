@@ -6,6 +6,7 @@
 import json
 import os
 import random
+from timeit import default_timer as timer
 
 import numpy
 
@@ -18,6 +19,8 @@ from toy_ai.utils import (
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+CAPABILITIES = ["solve-cases"]
+
 MAX_RETURNED_CONDITIONS = 5
 
 
@@ -168,6 +171,9 @@ def health_check(request):
     else:
         response = {"status": "OK"}
 
+    if response["status"] == "OK":
+        response["capabilities"] = CAPABILITIES
+
     return response
 
 
@@ -201,3 +207,26 @@ def solve_case(request):
             "AI Module: Selected AI implementation cannot be "
             f"handled: {ai_implementation}"
         )
+
+
+def solve_cases(request):
+    """Solves a batch of cases, returning a result (or an error) and the time
+    spent for each of them, in the same order"""
+    results = []
+    for case_data in request["cases"]:
+        start = timer()
+        try:
+            item = {
+                "result": solve_case(
+                    {
+                        "caseData": case_data,
+                        "aiImplementation": request["aiImplementation"],
+                    }
+                )
+            }
+        except Exception as exc:
+            item = {"error": {"code": type(exc).__name__, "message": str(exc)}}
+        item["elapsedTime"] = timer() - start
+        results.append(item)
+
+    return {"results": results}